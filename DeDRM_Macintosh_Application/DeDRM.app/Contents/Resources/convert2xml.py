@@ -12,11 +12,11 @@ class Unbuffered:
         return getattr(self.stream, attr)
 
 import sys
-sys.stdout=Unbuffered(sys.stdout)
-
 import csv
 import os
 import getopt
+from array import array
+from bisect import bisect_left
 from struct import pack
 from struct import unpack
 
@@ -25,33 +25,41 @@ class TpzDRMError(Exception):
 
 # Get a 7 bit encoded number from string. The most
 # significant byte comes first and has the high bit (8th) set
+# A leading 0xFF byte marks a negative number.
+# Returns the number and the position just after it, or
+# None and the end of the string if the number is cut short
 
-def readEncodedNumber(file):
-    flag = False
-    c = file.read(1)
-    if (len(c) == 0):
-        return None
-    data = ord(c)
-
-    if data == 0xFF:
-        flag = True
-        c = file.read(1)
-        if (len(c) == 0):
-            return None
-        data = ord(c)
-
-    if data >= 0x80:
-        datax = (data & 0x7F)
-        while data >= 0x80 :
-            c = file.read(1)
-            if (len(c) == 0):
-                return None
-            data = ord(c)
-            datax = (datax <<7) + (data & 0x7F)
-        data = datax
-
+def decodeNumber(data, pos=0):
+    try:
+        c = ord(data[pos])
+        pos += 1
+        flag = (c == 0xFF)
+        if flag:
+            c = ord(data[pos])
+            pos += 1
+        if c >= 0x80:
+            datax = (c & 0x7F)
+            while c >= 0x80 :
+                c = ord(data[pos])
+                pos += 1
+                datax = (datax <<7) + (c & 0x7F)
+            c = datax
+    except IndexError:
+        return None, len(data)
     if flag:
-        data = -data
+        c = -c
+    return c, pos
+
+# longest encoded number we expect: a sign byte and a 64 bit value
+maxEncodedLength = 11
+
+# Get a 7 bit encoded number from a file, leaving the file
+# positioned just after it
+
+def readEncodedNumber(file):
+    start = file.tell()
+    data, pos = decodeNumber(file.read(maxEncodedLength))
+    file.seek(start + pos)
     return data
 
 
@@ -99,6 +107,18 @@ def readString(file):
         return ""
     return unpack(str(stringLength)+"s",sv)[0]
 
+# same for a string at position pos of data, returns the
+# string and the position just after it
+
+def decodeString(data, pos=0):
+    stringLength, pos = decodeNumber(data, pos)
+    if (stringLength == None):
+        return "", pos
+    sv = data[pos:pos+stringLength]
+    if (len(sv)  != stringLength):
+        return "", len(data)
+    return sv, pos+stringLength
+
 
 # convert a binary string generated by encodeNumber (7 bit encoded number)
 # to the value you would find inside the page*.dat files to be processed
@@ -117,14 +137,16 @@ def convert(i):
 # as well as the xml tokens and values that make sense out of it
 
 class Dictionary(object):
-    def __init__(self, dictFile):
+    def __init__(self, dictFile, data=None):
         self.filename = dictFile
         self.size = 0
-        self.fo = file(dictFile,'rb')
+        if data is None:
+            data = file(dictFile,'rb').read()
         self.stable = []
-        self.size = readEncodedNumber(self.fo)
+        self.size, pos = decodeNumber(data)
         for i in xrange(self.size):
-            self.stable.append(self.escapestr(readString(self.fo)))
+            sv, pos = decodeString(data, pos)
+            self.stable.append(self.escapestr(sv))
         self.pos = 0
 
     def escapestr(self, str):
@@ -159,8 +181,13 @@ class Dictionary(object):
 # and information used to inject the xml snippets into page*.dat files
 
 class PageParser(object):
-    def __init__(self, filename, dict, debug, flat_xml):
-        self.fo = file(filename,'rb')
+    def __init__(self, filename, dict, debug, flat_xml, data=None):
+        # the whole file is decoded from one string, self.pos
+        # is the offset of the next value to read
+        if data is None:
+            data = file(filename,'rb').read()
+        self.data = data
+        self.pos = 0
         self.id = os.path.basename(filename).replace('.dat','')
         self.dict = dict
         self.debug = debug
@@ -431,23 +458,54 @@ class PageParser(object):
 
     # peek at and return 1 byte that is ahead by i bytes
     def peek(self, aheadi):
-        c = self.fo.read(aheadi)
-        if (len(c) == 0):
+        pos = self.pos + aheadi - 1
+        if pos >= len(self.data):
             return None
-        self.fo.seek(-aheadi,1)
-        c = c[-1:]
-        return ord(c)
+        return ord(self.data[pos])
 
 
-    # get the next value from the file being processed
-    def getNext(self):
-        nbyte = self.peek(1);
-        if (nbyte == None):
+    # read the next 7 bit encoded number, most values are a single byte
+    def readNumber(self):
+        pos = self.pos
+        try:
+            c = ord(self.data[pos])
+        except IndexError:
             return None
-        val = readEncodedNumber(self.fo)
+        if c < 0x80:
+            self.pos = pos + 1
+            return c
+        val, self.pos = decodeNumber(self.data, pos)
         return val
 
 
+    # read a vector of cnt encoded numbers
+    def readNumbers(self, cnt):
+        data = self.data
+        pos = self.pos
+        result = []
+        append = result.append
+        try:
+            for i in xrange(cnt):
+                c = ord(data[pos])
+                if c < 0x80:
+                    pos += 1
+                    append(c)
+                else:
+                    val, pos = decodeNumber(data, pos)
+                    append(val)
+        except IndexError:
+            # out of data, as with readNumber the missing values are None
+            result.extend([None] * (cnt - len(result)))
+            pos = len(data)
+        self.pos = pos
+        return result
+
+
+    # get the next value from the file being processed
+    def getNext(self):
+        return self.readNumber()
+
+
     # format an arg by argtype
     def formatArg(self, arg, argtype):
         if (argtype == 'text') or (argtype == 'scalar_text') :
@@ -489,15 +547,15 @@ class PageParser(object):
             if (splcase == 1):
                 # this type of tag uses of escape marker 0x74 indicate subtag count
                 if self.peek(1) == 0x74:
-                    skip = readEncodedNumber(self.fo)
+                    skip = self.readNumber()
                     subtags = 1
                     num_args = 0
 
             if (subtags == 1):
-                ntags = readEncodedNumber(self.fo)
+                ntags = self.readNumber()
                 if self.debug : print 'subtags: ' + token + ' has ' + str(ntags)
                 for j in xrange(ntags):
-                    val = readEncodedNumber(self.fo)
+                    val = self.readNumber()
                     subtagres.append(self.procToken(self.dict.lookup(val)))
 
             # arguments can be scalars or vectors of text or numbers
@@ -506,12 +564,12 @@ class PageParser(object):
                 firstarg = self.peek(1)
                 if (firstarg in self.cmd_list) and (argtype != 'scalar_number') and (argtype != 'scalar_text'):
                     # single argument is a variable length vector of data
-                    arg = readEncodedNumber(self.fo)
+                    arg = self.readNumber()
                     argres = self.decodeCMD(arg,argtype)
                 else :
                     # num_arg scalar arguments
                     for i in xrange(num_args):
-                        argres.append(self.formatArg(readEncodedNumber(self.fo), argtype))
+                        argres.append(self.formatArg(self.readNumber(), argtype))
 
             # build the return tag
             result = []
@@ -539,7 +597,7 @@ class PageParser(object):
     # it is NEVER used to format arguments.
     # builds the snippetList
     def doLoop72(self, argtype):
-        cnt = readEncodedNumber(self.fo)
+        cnt = self.readNumber()
         if self.debug :
             result = 'Set of '+ str(cnt) + ' xml snippets. The overall structure \n'
             result += 'of the document is indicated by snippet number sets at the\n'
@@ -549,7 +607,7 @@ class PageParser(object):
             if self.debug: print 'Snippet:',str(i)
             snippet = []
             snippet.append(i)
-            val = readEncodedNumber(self.fo)
+            val = self.readNumber()
             snippet.append(self.procToken(self.dict.lookup(val)))
             self.snippetList.append(snippet)
         return
@@ -561,14 +619,20 @@ class PageParser(object):
         result = []
         adj = 0
         if mode & 1:
-            adj = readEncodedNumber(self.fo)
+            adj = self.readNumber()
         mode = mode >> 1
-        x = []
-        for i in xrange(cnt):
-            x.append(readEncodedNumber(self.fo) - adj)
+        x = self.readNumbers(cnt)
+        if adj:
+            x = [v - adj for v in x]
+        # each mode level is a running sum of the level before
         for i in xrange(mode):
-            for j in xrange(1, cnt):
-                x[j] = x[j] + x[j - 1]
+            total = 0
+            for j in xrange(cnt):
+                total += x[j]
+                x[j] = total
+        # numbers are their own formatted value
+        if (argtype == 'raw') or (argtype == 'number') or (argtype == 'snippets'):
+            return x
         for i in xrange(cnt):
             result.append(self.formatArg(x[i],argtype))
         return result
@@ -585,8 +649,8 @@ class PageParser(object):
         if (cmd == 0x76):
 
             # loop with cnt, and mode to control loop styles
-            cnt = readEncodedNumber(self.fo)
-            mode = readEncodedNumber(self.fo)
+            cnt = self.readNumber()
+            mode = self.readNumber()
 
             if self.debug : print 'Loop for', cnt, 'with  mode', mode,  ':  '
             return self.doLoop76Mode(argtype, cnt, mode)
@@ -710,6 +774,29 @@ class PageParser(object):
         return "".join(rlst)
 
 
+    # add a tag and its subtags to a FlatDoc, keeping numbers as numbers
+    def flattenTagDoc(self, node, doc):
+        name = node[0]
+        subtagList = node[1]
+        argtype = node[2]
+        argList = node[3]
+        if (len(argList) > 0) and (argtype == 'snippets'):
+            name += '.snippets'
+        doc.addTag(name, argtype, argList)
+        for j in subtagList:
+            if len(j) > 0 :
+                self.flattenTagDoc(j, doc)
+
+
+    # build the FlatDoc of the page directly from the document tree
+    def formatFlatDoc(self):
+        doc = FlatDoc()
+        for j in self.doc :
+            if len(j) > 0:
+                self.flattenTagDoc(j, doc)
+        return doc
+
+
     # reduce create xml output
     def formatDoc(self, flat_xml):
         rlst = []
@@ -733,24 +820,25 @@ class PageParser(object):
     # every dictionary and seems close to what is meant
     # The alternative is to special case the last _ "0x5f" to mean something
 
-    def process(self):
+    def parse(self):
 
         # peek at the first bytes to see what type of file it is
-        magic = self.fo.read(9)
+        magic = self.data[0:9]
+        self.pos = 9
         if (magic[0:1] == 'p') and (magic[2:9] == 'marker_'):
             first_token = 'info'
         elif (magic[0:1] == 'p') and (magic[2:9] == '__PAGE_'):
-            skip = self.fo.read(2)
+            self.pos += 2
             first_token = 'info'
         elif (magic[0:1] == 'p') and (magic[2:8] == '_PAGE_'):
             first_token = 'info'
         elif (magic[0:1] == 'g') and (magic[2:9] == '__GLYPH'):
-            skip = self.fo.read(3)
+            self.pos += 3
             first_token = 'info'
         else :
             # other0.dat file
             first_token = None
-            self.fo.seek(-9,1)
+            self.pos = 0
 
 
         # main loop to read and build the document tree
@@ -778,7 +866,7 @@ class PageParser(object):
                     print "Main Loop:  Unknown value: %x" % v
                 if (v == 0):
                     if (self.peek(1) == 0x5f):
-                        skip = self.fo.read(1)
+                        self.pos += 1
                         first_token = 'info'
 
         # now do snippet injection
@@ -791,23 +879,165 @@ class PageParser(object):
             if len(tag_add) > 0:
                 self.doc.append(tag_add)
 
+
+    def process(self):
+        self.parse()
+
         # handle generation of xml output
         xmlpage = self.formatDoc(self.flat_xml)
 
         return xmlpage
 
 
-def fromData(dict, fname):
+# parsed form of a flat xml page description, as used by the renderers:
+# the tag path and value of every line, with the line numbers of each tag
+# path (and of each tag path suffix asked for) indexed so lookups do not
+# rescan the whole document.  Built by PageParser (see getDoc) numeric
+# values stay integer arrays; built from flat xml text they are split once.
+
+class FlatDoc(object):
+    def __init__(self, flatxml=None):
+        self.names = []
+        self.values = []
+        self.tags = {}
+        self.size = 0
+        self.suffixes = {}
+        self.vectors = {}
+        self.strings = {}
+        if flatxml != None:
+            for item in flatxml.split('\n'):
+                if item.find('=') >= 0:
+                    (name, argres) = item.split('=',1)
+                else :
+                    name = item
+                    argres = ''
+                self.addLine(name, argres)
+
+    # the lookup caches are rebuilt on demand, so do not pickle them
+    def __getstate__(self):
+        return (self.names, self.values, self.tags)
+
+    def __setstate__(self, state):
+        (self.names, self.values, self.tags) = state
+        self.size = len(self.names)
+        self.suffixes = {}
+        self.vectors = {}
+        self.strings = {}
+
+    def addLine(self, name, value):
+        self.tags.setdefault(name, []).append(self.size)
+        self.names.append(name)
+        self.values.append(value)
+        self.size += 1
+        self.suffixes = {}
+
+    # add a tag with its arguments as given by PageParser
+    def addTag(self, name, argtype, argList):
+        if len(argList) == 0:
+            value = ''
+        elif (argtype == 'text') or (argtype == 'scalar_text'):
+            value = '|'.join(argList)
+        else:
+            try:
+                value = array('i', argList)
+            except (OverflowError, TypeError):
+                value = '|'.join([str(j) for j in argList])
+        self.addLine(name, value)
+
+    # append the lines of another FlatDoc
+    def extend(self, other):
+        for pos in xrange(other.size):
+            self.addLine(other.names[pos], other.values[pos])
+
+    # returns the value at line pos as text
+    def getText(self, pos):
+        value = self.values[pos]
+        if isinstance(value, str):
+            return value
+        result = self.strings.get(pos)
+        if result == None:
+            result = '|'.join([str(j) for j in value])
+            self.strings[pos] = result
+        return result
+
+    # sorted line numbers of all tags whose path ends with tagpath
+    def positions(self, tagpath):
+        result = self.suffixes.get(tagpath)
+        if result == None:
+            result = []
+            for name in self.tags:
+                if name.endswith(tagpath):
+                    result.extend(self.tags[name])
+            result.sort()
+            self.suffixes[tagpath] = result
+        return result
+
+    # return tag at line pos in document
+    def lineinDoc(self, pos):
+        return self.names[pos], self.getText(pos)
+
+    # find tag in doc if within pos to end inclusive
+    def findinDoc(self, tagpath, pos, end):
+        if end == -1 :
+            end = self.size
+        else:
+            end = min(self.size, end)
+        positions = self.positions(tagpath)
+        i = bisect_left(positions, max(pos, 0))
+        if (i < len(positions)) and (positions[i] < end):
+            foundat = positions[i]
+            return foundat, self.getText(foundat)
+        return -1, None
+
+    # return list of start positions for the tagpath
+    def posinDoc(self, tagpath):
+        return list(self.positions(tagpath))
+
+    # return list of positions of the exact tag path
+    def exactposinDoc(self, name):
+        return list(self.tags.get(name, []))
+
+    # returns the value at line pos as a vector of integers
+    def getInts(self, pos):
+        argres = self.values[pos]
+        if not isinstance(argres, str):
+            return argres.tolist()
+        result = self.vectors.get(pos)
+        if result == None:
+            if len(argres) > 0:
+                result = [int(strval) for strval in argres.split('|')]
+            else:
+                result = []
+            self.vectors[pos] = result
+        return list(result)
+
+
+# accepts either flat xml text or a FlatDoc
+def getFlatDoc(flatxml):
+    if isinstance(flatxml, FlatDoc):
+        return flatxml
+    return FlatDoc(flatxml)
+
+
+# fname names the page (and is read from disk when no data is given)
+def fromData(dict, fname, data=None):
     flat_xml = True
     debug = False
-    pp = PageParser(fname, dict, debug, flat_xml)
+    pp = PageParser(fname, dict, debug, flat_xml, data)
     xmlpage = pp.process()
     return xmlpage
 
-def getXML(dict, fname):
+def getDoc(dict, fname, data=None):
+    flat_xml = True
+    debug = False
+    pp = PageParser(fname, dict, debug, flat_xml, data)
+    pp.parse()
+    return pp.formatFlatDoc()
+
+def getXML(dict, fname, data=None):
     flat_xml = False
     debug = False
-    pp = PageParser(fname, dict, debug, flat_xml)
+    pp = PageParser(fname, dict, debug, flat_xml, data)
     xmlpage = pp.process()
     return xmlpage
 
@@ -881,4 +1111,5 @@ def main(argv):
     return xmlpage
 
 if __name__ == '__main__':
+    sys.stdout=Unbuffered(sys.stdout)
     sys.exit(main(''))
@@ -10,15 +10,20 @@ import getopt
 from struct import pack
 from struct import unpack
 
+if 'calibre' in sys.modules:
+    from calibre_plugins.dedrm import convert2xml
+else:
+    import convert2xml
+
 
 class DocParser(object):
-    def __init__(self, flatxml, classlst, fileid, bookDir, gdict, fixedimage):
+    def __init__(self, flatxml, classlst, fileid, bookFiles, gdict, fixedimage):
         self.id = os.path.basename(fileid).replace('.dat','')
         self.svgcount = 0
-        self.docList = flatxml.split('\n')
-        self.docSize = len(self.docList)
+        self.doc = convert2xml.getFlatDoc(flatxml)
+        self.docSize = self.doc.size
         self.classList = {}
-        self.bookDir = bookDir
+        self.bookFiles = bookFiles
         self.gdict = gdict
         tmpList = classlst.split('\n')
         for pclass in tmpList:
@@ -43,6 +48,10 @@ class DocParser(object):
         id='id="gl%d"' % gid
         return self.gdict.lookup(id)
 
+    def getGlyphDim(self, gid):
+        id='id="gl%d"' % gid
+        return self.gdict.lookupDim(id)
+
     def glyphs_to_image(self, glyphList):
 
         def extract(path, key):
@@ -50,11 +59,7 @@ class DocParser(object):
             e = path.find(' ',b)
             return int(path[b:e])
 
-        svgDir = os.path.join(self.bookDir,'svg')
-
-        imgDir = os.path.join(self.bookDir,'img')
         imgname = self.id + '_%04d.svg' % self.svgcount
-        imgfile = os.path.join(imgDir,imgname)
 
         # get glyph information
         gxList = self.getData('info.glyph.x',0,-1)
@@ -87,8 +92,12 @@ class DocParser(object):
             path = self.getGlyph(gid)
             gdefs.append(path)
 
-            maxws.append(extract(path,'width='))
-            maxhs.append(extract(path,'height='))
+            # glyph dimensions are cached in the glyph dictionary
+            dim = self.getGlyphDim(gid)
+            if dim == None:
+                dim = (extract(path,'width='), extract(path,'height='))
+            maxws.append(dim[0])
+            maxhs.append(dim[1])
 
 
         # change the origin to minx, miny and calc max height and width
@@ -100,19 +109,21 @@ class DocParser(object):
             maxw = max( maxw, (maxws[j] + xs[j]) )
             maxh = max( maxh, (maxhs[j] + ys[j]) )
 
-        # open the image file for output
-        ifile = open(imgfile,'w')
-        ifile.write('<?xml version="1.0" standalone="no"?>\n')
-        ifile.write('<!DOCTYPE svg PUBLIC "-//W3C/DTD SVG 1.1//EN" "http://www.w3.org/Graphics/SVG/1.1/DTD/svg11.dtd">\n')
-        ifile.write('<svg width="%dpx" height="%dpx" viewBox="0 0 %d %d" xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" version="1.1">\n' % (math.floor(maxw/10), math.floor(maxh/10), maxw, maxh))
-        ifile.write('<defs>\n')
+        # build the image and add it to the book's img directory
+        ilst = []
+        ilst.append('<?xml version="1.0" standalone="no"?>\n')
+        ilst.append('<!DOCTYPE svg PUBLIC "-//W3C/DTD SVG 1.1//EN" "http://www.w3.org/Graphics/SVG/1.1/DTD/svg11.dtd">\n')
+        ilst.append('<svg width="%dpx" height="%dpx" viewBox="0 0 %d %d" xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" version="1.1">\n' % (math.floor(maxw/10), math.floor(maxh/10), maxw, maxh))
+        # always self-contained: an svg shown through <img> may not load
+        # anything else, so a shared glyph atlas would never be drawn
+        ilst.append('<defs>\n')
         for j in xrange(0,len(gdefs)):
-            ifile.write(gdefs[j])
-        ifile.write('</defs>\n')
+            ilst.append(gdefs[j])
+        ilst.append('</defs>\n')
         for j in xrange(0,len(gids)):
-            ifile.write('<use xlink:href="#gl%d" x="%d" y="%d" />\n' % (gids[j], xs[j], ys[j]))
-        ifile.write('</svg>')
-        ifile.close()
+            ilst.append('<use xlink:href="#gl%d" x="%d" y="%d" />\n' % (gids[j], xs[j], ys[j]))
+        ilst.append('</svg>')
+        self.bookFiles.write('img/' + imgname, "".join(ilst))
 
         return 0
 
@@ -121,58 +132,26 @@ class DocParser(object):
     # return tag at line pos in document
     def lineinDoc(self, pos) :
         if (pos >= 0) and (pos < self.docSize) :
-            item = self.docList[pos]
-            if item.find('=') >= 0:
-                (name, argres) = item.split('=',1)
-            else :
-                name = item
-                argres = ''
+            (name, argres) = self.doc.lineinDoc(pos)
         return name, argres
 
 
     # find tag in doc if within pos to end inclusive
     def findinDoc(self, tagpath, pos, end) :
-        result = None
-        if end == -1 :
-            end = self.docSize
-        else:
-            end = min(self.docSize, end)
-        foundat = -1
-        for j in xrange(pos, end):
-            item = self.docList[j]
-            if item.find('=') >= 0:
-                (name, argres) = item.split('=',1)
-            else :
-                name = item
-                argres = ''
-            if name.endswith(tagpath) :
-                result = argres
-                foundat = j
-                break
-        return foundat, result
+        return self.doc.findinDoc(tagpath, pos, end)
 
 
     # return list of start positions for the tagpath
     def posinDoc(self, tagpath):
-        startpos = []
-        pos = 0
-        res = ""
-        while res != None :
-            (foundpos, res) = self.findinDoc(tagpath, pos, -1)
-            if res != None :
-                startpos.append(foundpos)
-            pos = foundpos + 1
-        return startpos
+        return self.doc.posinDoc(tagpath)
 
 
     # returns a vector of integers for the tagpath
     def getData(self, tagpath, pos, end):
-        argres=[]
-        (foundat, argt) = self.findinDoc(tagpath, pos, end)
-        if (argt != None) and (len(argt) > 0) :
-            argList = argt.split('|')
-            argres = [ int(strval) for strval in argList]
-        return argres
+        (foundat, argt) = self.doc.findinDoc(tagpath, pos, end)
+        if foundat < 0:
+            return []
+        return self.doc.getInts(foundat)
 
 
     # get the class
@@ -794,8 +773,9 @@ class DocParser(object):
         return htmlpage, tocinfo
 
 
-def convert2HTML(flatxml, classlst, fileid, bookDir, gdict, fixedimage):
+# bookFiles is the genbook.BookFiles store the svg images are written into
+def convert2HTML(flatxml, classlst, fileid, bookFiles, gdict, fixedimage):
     # create a document parser
-    dp = DocParser(flatxml, classlst, fileid, bookDir, gdict, fixedimage)
+    dp = DocParser(flatxml, classlst, fileid, bookFiles, gdict, fixedimage)
     htmlpage, tocinfo = dp.process()
     return htmlpage, tocinfo
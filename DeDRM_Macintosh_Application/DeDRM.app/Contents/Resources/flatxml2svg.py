@@ -8,13 +8,17 @@ import getopt
 from struct import pack
 from struct import unpack
 
+if 'calibre' in sys.modules:
+    from calibre_plugins.dedrm import convert2xml
+else:
+    import convert2xml
+
 
 class PParser(object):
     def __init__(self, gd, flatxml, meta_array):
         self.gd = gd
-        self.flatdoc = flatxml.split('\n')
-        self.docSize = len(self.flatdoc)
-        self.temp = []
+        self.doc = convert2xml.getFlatDoc(flatxml)
+        self.docSize = self.doc.size
 
         self.ph = -1
         self.pw = -1
@@ -57,111 +61,43 @@ class PParser(object):
     # return tag at line pos in document
     def lineinDoc(self, pos) :
         if (pos >= 0) and (pos < self.docSize) :
-            item = self.flatdoc[pos]
-            if item.find('=') >= 0:
-                (name, argres) = item.split('=',1)
-            else :
-                name = item
-                argres = ''
+            (name, argres) = self.doc.lineinDoc(pos)
         return name, argres
 
     # find tag in doc if within pos to end inclusive
     def findinDoc(self, tagpath, pos, end) :
-        result = None
-        if end == -1 :
-            end = self.docSize
-        else:
-            end = min(self.docSize, end)
-        foundat = -1
-        for j in xrange(pos, end):
-            item = self.flatdoc[j]
-            if item.find('=') >= 0:
-                (name, argres) = item.split('=',1)
-            else :
-                name = item
-                argres = ''
-            if name.endswith(tagpath) :
-                result = argres
-                foundat = j
-                break
-        return foundat, result
+        return self.doc.findinDoc(tagpath, pos, end)
 
     # return list of start positions for the tagpath
     def posinDoc(self, tagpath):
-        startpos = []
-        pos = 0
-        res = ""
-        while res != None :
-            (foundpos, res) = self.findinDoc(tagpath, pos, -1)
-            if res != None :
-                startpos.append(foundpos)
-            pos = foundpos + 1
-        return startpos
+        return self.doc.posinDoc(tagpath)
 
     def getData(self, path):
-        result = None
-        cnt = len(self.flatdoc)
-        for j in xrange(cnt):
-            item = self.flatdoc[j]
-            if item.find('=') >= 0:
-                (name, argt) = item.split('=')
-                argres = argt.split('|')
-            else:
-                name = item
-                argres = []
-            if (name.endswith(path)):
-                result = argres
-                break
-        if (len(argres) > 0) :
-            for j in xrange(0,len(argres)):
-                argres[j] = int(argres[j])
-        return result
+        positions = self.doc.positions(path)
+        if len(positions) == 0:
+            return None
+        return self.doc.getInts(positions[0])
 
     def getDataatPos(self, path, pos):
-        result = None
-        item = self.flatdoc[pos]
-        if item.find('=') >= 0:
-            (name, argt) = item.split('=')
-            argres = argt.split('|')
-        else:
-            name = item
-            argres = []
-        if (len(argres) > 0) :
-            for j in xrange(0,len(argres)):
-                argres[j] = int(argres[j])
+        (name, argres) = self.doc.lineinDoc(pos)
         if (name.endswith(path)):
-            result = argres
-        return result
-
-    def getDataTemp(self, path):
-        result = None
-        cnt = len(self.temp)
-        for j in xrange(cnt):
-            item = self.temp[j]
-            if item.find('=') >= 0:
-                (name, argt) = item.split('=')
-                argres = argt.split('|')
-            else:
-                name = item
-                argres = []
-            if (name.endswith(path)):
-                result = argres
-                self.temp.pop(j)
-                break
-        if (len(argres) > 0) :
-            for j in xrange(0,len(argres)):
-                argres[j] = int(argres[j])
-        return result
+            return self.doc.getInts(pos)
+        return None
 
     def getImages(self):
         result = []
-        self.temp = self.flatdoc
-        while (self.getDataTemp('img') != None):
-            h = self.getDataTemp('img.h')[0]
-            w = self.getDataTemp('img.w')[0]
-            x = self.getDataTemp('img.x')[0]
-            y = self.getDataTemp('img.y')[0]
-            src = self.getDataTemp('img.src')[0]
+        # the nth img tag goes with the nth of each of its attributes
+        hpos = self.doc.positions('img.h')
+        wpos = self.doc.positions('img.w')
+        xpos = self.doc.positions('img.x')
+        ypos = self.doc.positions('img.y')
+        srcpos = self.doc.positions('img.src')
+        for j in xrange(len(self.doc.positions('img'))):
+            h = self.doc.getInts(hpos[j])[0]
+            w = self.doc.getInts(wpos[j])[0]
+            x = self.doc.getInts(xpos[j])[0]
+            y = self.doc.getInts(ypos[j])[0]
+            src = self.doc.getInts(srcpos[j])[0]
             result.append('<image xlink:href="../img/img%04d.jpg" x="%d" y="%d" width="%d" height="%d" />\n' % (src, x, y, w, h))
         return result
 
@@ -180,7 +116,8 @@ class PParser(object):
         return result
 
 
-def convert2SVG(gdict, flat_xml, pageid, previd, nextid, svgDir, raw, meta_array, scaledpi):
+# with glyphatlas the page refers to the glyph paths in the glyphs.svg next to it
+def convert2SVG(gdict, flat_xml, pageid, previd, nextid, svgDir, raw, meta_array, scaledpi, glyphatlas=False):
     mlst = []
     pp = PParser(gdict, flat_xml, meta_array)
     mlst.append('<?xml version="1.0" standalone="no"?>\n')
@@ -217,7 +154,10 @@ def convert2SVG(gdict, flat_xml, pageid, previd, nextid, svgDir, raw, meta_array
             mlst.append('<a href="javascript:ppage();"><svg id="prevsvg" viewBox="0 0 100 300" xmlns="http://www.w3.org/2000/svg" version="1.1" style="background-color:#777"><polygon points="5,150,95,5,95,295" fill="#AAAAAA" /></svg></a>\n')
 
         mlst.append('<a href="javascript:npage();"><svg id="svgimg" viewBox="0 0 %d %d" xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" version="1.1" style="background-color:#FFF;border:1px solid black;">' % (pp.pw, pp.ph))
-    if (pp.gid != None):
+    href = '#gl%d'
+    if glyphatlas:
+        href = 'glyphs.svg#gl%d'
+    elif (pp.gid != None):
         mlst.append('<defs>\n')
         gdefs = pp.getGlyphs()
         for j in xrange(0,len(gdefs)):
@@ -229,7 +169,7 @@ def convert2SVG(gdict, flat_xml, pageid, previd, nextid, svgDir, raw, meta_array
             mlst.append(img[j])
     if (pp.gid != None):
         for j in xrange(0,len(pp.gid)):
-            mlst.append('<use xlink:href="#gl%d" x="%d" y="%d" />\n' % (pp.gid[j], pp.gx[j], pp.gy[j]))
+            mlst.append(('<use xlink:href="' + href + '" x="%d" y="%d" />\n') % (pp.gid[j], pp.gx[j], pp.gy[j]))
     if (img == None or len(img) == 0) and (pp.gid == None or len(pp.gid) == 0):
         xpos = "%d" % (pp.pw // 3)
         ypos = "%d" % (pp.ph // 3)
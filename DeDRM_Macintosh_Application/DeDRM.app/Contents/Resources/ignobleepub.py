@@ -37,16 +37,18 @@ from __future__ import with_statement
 #   3.9 - moved unicode_argv call inside main for Windows DeDRM compatibility
 #   4.0 - Work if TkInter is missing
 #   4.1 - Import tkFileDialog, don't assume something else will import it.
+#   4.2 - Record decrypt and recompress times for instrument.py
 
 """
 Decrypt Barnes & Noble encrypted ePub books.
 """
 
 __license__ = 'GPL v3'
-__version__ = "4.1"
+__version__ = "4.2"
 
 import sys
 import os
+import time
 import traceback
 import zlib
 import zipfile
@@ -54,6 +56,11 @@ from zipfile import ZipInfo, ZipFile, ZIP_STORED, ZIP_DEFLATED
 from contextlib import closing
 import xml.etree.ElementTree as etree
 
+try:
+    from calibre_plugins.dedrm import instrument
+except ImportError:
+    import instrument
+
 # Wrap a stream so that output gets flushed immediately
 # and also make sure that any unicode strings get
 # encoded using "replace" before writing them.
@@ -296,6 +303,10 @@ def decryptBook(keyb64, inpath, outpath):
                 except:
                     pass
                 outf.writestr(zi, inf.read('mimetype'))
+                # decrypt and recompress are timed per file and recorded once
+                started = time.time()
+                decrypttime = recompresstime = 0.0
+                nbytes = 0
                 for path in namelist:
                     data = inf.read(path)
                     zi = ZipInfo(path)
@@ -313,7 +324,15 @@ def decryptBook(keyb64, inpath, outpath):
                         zi.create_system = oldzi.create_system
                     except:
                         pass
-                    outf.writestr(zi, decryptor.decrypt(path, data))
+                    start = time.time()
+                    data = decryptor.decrypt(path, data)
+                    decrypted = time.time()
+                    outf.writestr(zi, data)
+                    decrypttime += decrypted - start
+                    recompresstime += time.time() - decrypted
+                    nbytes += len(data)
+                instrument.recorder.addspan('decrypt', started, decrypttime, nbytes=nbytes, calls=len(namelist))
+                instrument.recorder.addspan('recompress', started, recompresstime, nbytes=nbytes, calls=len(namelist))
         except:
             print u"Could not decrypt {0:s} because of an exception:\n{1:s}".format(os.path.basename(inpath), traceback.format_exc())
             return 2
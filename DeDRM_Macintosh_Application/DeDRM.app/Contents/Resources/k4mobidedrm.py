@@ -7,7 +7,7 @@ from __future__ import with_statement
 # Copyright © 2008-2017 by Apprentice Harper et al.
 
 __license__ = 'GPL v3'
-__version__ = '5.5'
+__version__ = '5.7'
 
 # Engine to remove drm from Kindle and Mobipocket ebooks
 # for personal use for archiving and converting your ebooks
@@ -61,6 +61,8 @@ __version__ = '5.5'
 #  5.4 - Recognise KFX files masquerading as azw, even if we can't decrypt them yet.
 #  5.5 - Added GPL v3 licence explicitly.
 #  5.x - Invoke KFXZipBook to handle zipped KFX files
+#  5.6 - Record stage timings and key counts for instrument.py
+#  5.7 - Optionally decrypt KFX and Topaz pages with a pool of worker processes (-j)
 
 import sys, os, re
 import csv
@@ -85,12 +87,14 @@ if inCalibre:
     from calibre_plugins.dedrm import kgenpids
     from calibre_plugins.dedrm import androidkindlekey
     from calibre_plugins.dedrm import kfxdedrm
+    from calibre_plugins.dedrm import instrument
 else:
     import mobidedrm
     import topazextract
     import kgenpids
     import androidkindlekey
     import kfxdedrm
+    import instrument
 
 # Wrap a stream so that output gets flushed immediately
 # and also make sure that any unicode strings get
@@ -192,7 +196,7 @@ def unescape(text):
         return text # leave as is
     return re.sub(u"&#?\w+;", fixup, text)
 
-def GetDecryptedBook(infile, kDatabases, androidFiles, serials, pids, starttime = time.time()):
+def GetDecryptedBook(infile, kDatabases, androidFiles, serials, pids, starttime = time.time(), workers = 0):
     # handle the obvious cases at the beginning
     if not os.path.isfile(infile):
         raise DrmException(u"Input file does not exist.")
@@ -206,31 +210,40 @@ def GetDecryptedBook(infile, kDatabases, androidFiles, serials, pids, starttime
     if magic3 == 'TPZ':
         mobi = False
 
-    if magic8[:4] == 'PK\x03\x04':
-        mb = kfxdedrm.KFXZipBook(infile)
-    elif mobi:
-        mb = mobidedrm.MobiBook(infile)
-    else:
-        mb = topazextract.TopazBook(infile)
+    with instrument.recorder.span('open'):
+        if magic8[:4] == 'PK\x03\x04':
+            mb = kfxdedrm.KFXZipBook(infile)
+        elif mobi:
+            mb = mobidedrm.MobiBook(infile)
+        else:
+            mb = topazextract.TopazBook(infile)
 
     bookname = unescape(mb.getBookTitle())
     print u"Decrypting {1} ebook: {0}".format(bookname, mb.getBookType())
 
-    # copy list of pids
-    totalpids = list(pids)
-    # extend list of serials with serials from android databases
-    for aFile in androidFiles:
-        serials.extend(androidkindlekey.get_serials(aFile))
-    # extend PID list with book-specific PIDs from seriala and kDatabases
-    md1, md2 = mb.getPIDMetaInfo()
-    totalpids.extend(kgenpids.getPidList(md1, md2, serials, kDatabases))
-    # remove any duplicates
-    totalpids = list(set(totalpids))
+    with instrument.recorder.span('key lookup'):
+        # copy list of pids
+        totalpids = list(pids)
+        # extend list of serials with serials from android databases
+        for aFile in androidFiles:
+            serials.extend(androidkindlekey.get_serials(aFile))
+        # extend PID list with book-specific PIDs from seriala and kDatabases
+        md1, md2 = mb.getPIDMetaInfo()
+        totalpids.extend(kgenpids.getPidList(md1, md2, serials, kDatabases))
+        # remove any duplicates
+        totalpids = list(set(totalpids))
     print u"Found {1:d} keys to try after {0:.1f} seconds".format(time.time()-starttime, len(totalpids))
     #print totalpids
 
+    # the engines try the PIDs themselves, and count the key attempts, so
+    # this is one span for all of them
     try:
-        mb.processBook(totalpids)
+        with instrument.recorder.span('decrypt', keys=len(totalpids)):
+            if isinstance(mb, mobidedrm.MobiBook):
+                mb.processBook(totalpids)
+            else:
+                # KFX and Topaz pages can be shared out between workers
+                mb.processBook(totalpids, workers)
     except:
         mb.cleanup
         raise
@@ -240,7 +253,7 @@ def GetDecryptedBook(infile, kDatabases, androidFiles, serials, pids, starttime
 
 
 # kDatabaseFiles is a list of files created by kindlekey
-def decryptBook(infile, outdir, kDatabaseFiles, androidFiles, serials, pids):
+def decryptBook(infile, outdir, kDatabaseFiles, androidFiles, serials, pids, workers = 0):
     starttime = time.time()
     kDatabases = []
     for dbfile in kDatabaseFiles:
@@ -256,7 +269,7 @@ def decryptBook(infile, outdir, kDatabaseFiles, androidFiles, serials, pids):
 
 
     try:
-        book = GetDecryptedBook(infile, kDatabases, androidFiles, serials, pids, starttime)
+        book = GetDecryptedBook(infile, kDatabases, androidFiles, serials, pids, starttime, workers)
     except Exception, e:
         print u"Error decrypting book after {1:.1f} seconds: {0}".format(e.args[0],time.time()-starttime)
         traceback.print_exc()
@@ -280,7 +293,17 @@ def decryptBook(infile, outdir, kDatabaseFiles, androidFiles, serials, pids):
     outfilename = outfilename+u"_nodrm"
     outfile = os.path.join(outdir, outfilename + book.getBookExtension())
 
-    book.getFile(outfile)
+    # KFX pages are decrypted as they are written, so this can still fail
+    try:
+        with instrument.recorder.span('write') as span:
+            book.getFile(outfile)
+            span.nbytes = os.path.getsize(outfile)
+    except Exception, e:
+        print u"Error writing book after {1:.1f} seconds: {0}".format(e.args[0],time.time()-starttime)
+        traceback.print_exc()
+        book.cleanup()
+        return 1
+    instrument.recorder.count('bytes out', span.nbytes)
     print u"Saved decrypted book {1:s} after {0:.1f} seconds".format(time.time()-starttime, outfilename)
 
     if book.getBookType()==u"Topaz":
@@ -296,7 +319,7 @@ def decryptBook(infile, outdir, kDatabaseFiles, androidFiles, serials, pids):
 def usage(progname):
     print u"Removes DRM protection from Mobipocket, Amazon KF8, Amazon Print Replica and Amazon Topaz ebooks"
     print u"Usage:"
-    print u"    {0} [-k <kindle.k4i>] [-p <comma separated PIDs>] [-s <comma separated Kindle serial numbers>] [ -a <AmazonSecureStorage.xml|backup.ab> ] <infile> <outdir>".format(progname)
+    print u"    {0} [-k <kindle.k4i>] [-p <comma separated PIDs>] [-s <comma separated Kindle serial numbers>] [ -a <AmazonSecureStorage.xml|backup.ab> ] [-j <workers>] <infile> <outdir>".format(progname)
 
 #
 # Main
@@ -307,7 +330,7 @@ def cli_main():
     print u"K4MobiDeDrm v{0}.\nCopyright © 2008-2017 Apprentice Harper et al.".format(__version__)
 
     try:
-        opts, args = getopt.getopt(argv[1:], "k:p:s:a:")
+        opts, args = getopt.getopt(argv[1:], "k:p:s:a:j:")
     except getopt.GetoptError, err:
         print u"Error in options or arguments: {0}".format(err.args[0])
         usage(progname)
@@ -322,6 +345,7 @@ def cli_main():
     androidFiles = []
     serials = []
     pids = []
+    workers = 0
 
     for o, a in opts:
         if o == "-k":
@@ -340,11 +364,13 @@ def cli_main():
             if a == None:
                 raise DrmException("Invalid parameter for -a")
             androidFiles.append(a)
+        if o == '-j':
+            workers = int(a)
 
     # try with built in Kindle Info files if not on Linux
     k4 = not sys.platform.startswith('linux')
 
-    return decryptBook(infile, outdir, kDatabaseFiles, androidFiles, serials, pids)
+    return decryptBook(infile, outdir, kDatabaseFiles, androidFiles, serials, pids, workers)
 
 
 if __name__ == '__main__':
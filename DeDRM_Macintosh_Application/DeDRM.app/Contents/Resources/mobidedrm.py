@@ -72,6 +72,7 @@ __version__ = u"0.42"
 #  0.40 - moved unicode_argv call inside main for Windows DeDRM compatibility
 #  0.41 - Fixed potential unicode problem in command line calls
 #  0.42 - Added GPL v3 licence. updated/removed some print statements
+#  0.43 - Count the PIDs tried for instrument.py
 
 import sys
 import os
@@ -81,6 +82,10 @@ try:
     from alfcrypto import Pukall_Cipher
 except:
     print u"AlfCrypto not found. Using python PC1 implementation."
+try:
+    from calibre_plugins.dedrm import instrument
+except ImportError:
+    import instrument
 
 # Wrap a stream so that output gets flushed immediately
 # and also make sure that any unicode strings get
@@ -374,6 +379,7 @@ class MobiBook:
         found_key = None
         keyvec1 = '\x72\x38\x33\xB0\xB4\xF2\xE3\xCA\xDF\x09\x01\xD6\xE2\xE0\x3F\x96'
         for pid in pidlist:
+            instrument.recorder.count('key attempts')
             bigpid = pid.ljust(16,'\0')
             temp_key = PC1(keyvec1, bigpid, False)
             temp_key_sum = sum(map(ord,temp_key)) & 0xff
@@ -64,6 +64,7 @@ from Queue import Empty
 from multiprocessing import Process, Queue
 
 from scriptinterface import decryptepub, decryptpdb, decryptpdf, decryptk4mobi
+import instrument
 
 
 # Wrap a stream so that output gets flushed immediately
@@ -613,13 +614,24 @@ class ConvDialog(Toplevel):
         return rv
 
 
+# stage timings and counters go to the sinks named in DEDRM_INSTRUMENT, if any
+def decryptwithinstrument(decrypt, booktype, infile, outdir, rscpath):
+    instrument.configure()
+    instrument.recorder.begin(infile, booktype=booktype, app=u"DeDRM_App", version=__version__)
+    rv = 1
+    try:
+        rv = decrypt(infile, outdir, rscpath)
+    finally:
+        instrument.recorder.end(rv == 0)
+    return rv
+
 # child process starts here
 def processK4MOBI(q, infile, outdir, rscpath):
     add_cp65001_codec()
     set_utf8_default_encoding()
     sys.stdout = QueuedUTF8Stream(sys.stdout, q)
     sys.stderr = QueuedUTF8Stream(sys.stderr, q)
-    rv = decryptk4mobi(infile, outdir, rscpath)
+    rv = decryptwithinstrument(decryptk4mobi, 'kindle', infile, outdir, rscpath)
     sys.exit(rv)
 
 # child process starts here
@@ -628,7 +640,7 @@ def processPDF(q, infile, outdir, rscpath):
     set_utf8_default_encoding()
     sys.stdout = QueuedUTF8Stream(sys.stdout, q)
     sys.stderr = QueuedUTF8Stream(sys.stderr, q)
-    rv = decryptpdf(infile, outdir, rscpath)
+    rv = decryptwithinstrument(decryptpdf, 'pdf', infile, outdir, rscpath)
     sys.exit(rv)
 
 # child process starts here
@@ -637,7 +649,7 @@ def processEPUB(q, infile, outdir, rscpath):
     set_utf8_default_encoding()
     sys.stdout = QueuedUTF8Stream(sys.stdout, q)
     sys.stderr = QueuedUTF8Stream(sys.stderr, q)
-    rv = decryptepub(infile, outdir, rscpath)
+    rv = decryptwithinstrument(decryptepub, 'epub', infile, outdir, rscpath)
     sys.exit(rv)
 
 # child process starts here
@@ -646,7 +658,7 @@ def processPDB(q, infile, outdir, rscpath):
     set_utf8_default_encoding()
     sys.stdout = QueuedUTF8Stream(sys.stdout, q)
     sys.stderr = QueuedUTF8Stream(sys.stderr, q)
-    rv = decryptpdb(infile, outdir, rscpath)
+    rv = decryptwithinstrument(decryptpdb, 'pdb', infile, outdir, rscpath)
     sys.exit(rv)
 
 
@@ -194,8 +194,9 @@ class DeDRM(FileTypePlugin):
         inf = self.temporary_file(u".epub")
         try:
             print u"{0} v{1}: Verifying zip archive integrity".format(PLUGIN_NAME, PLUGIN_VERSION)
-            fr = zipfix.fixZip(path_to_ebook, inf.name)
-            fr.fix()
+            with self.recorder.span('zip repair'):
+                fr = zipfix.fixZip(path_to_ebook, inf.name)
+                fr.fix()
         except Exception, e:
             print u"{0} v{1}: Error \'{2}\' when checking zip archive".format(PLUGIN_NAME, PLUGIN_VERSION, e.args[0])
             raise Exception(e)
@@ -219,12 +220,15 @@ class DeDRM(FileTypePlugin):
                 of = self.temporary_file(u".epub")
 
                 # Give the user key, ebook and TemporaryPersistent file to the decryption function.
-                try:
-                    result = ignobleepub.decryptBook(userkey, inf.name, of.name)
-                except:
-                    print u"{0} v{1}: Exception when trying to decrypt after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION, time.time()-self.starttime)
-                    traceback.print_exc()
-                    result = 1
+                self.recorder.count('key attempts')
+                with self.recorder.span('key attempt', key=keyname_masked) as span:
+                    try:
+                        result = ignobleepub.decryptBook(userkey, inf.name, of.name)
+                    except:
+                        print u"{0} v{1}: Exception when trying to decrypt after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION, time.time()-self.starttime)
+                        traceback.print_exc()
+                        result = 1
+                    span.ok = result == 0
 
                 of.close()
 
@@ -241,20 +245,21 @@ class DeDRM(FileTypePlugin):
             # get the default NOOK Study keys
             defaultkeys = []
 
-            try:
-                if iswindows or isosx:
-                    from calibre_plugins.dedrm.ignoblekey import nookkeys
+            with self.recorder.span('key lookup'):
+                try:
+                    if iswindows or isosx:
+                        from calibre_plugins.dedrm.ignoblekey import nookkeys
 
-                    defaultkeys = nookkeys()
-                else: # linux
-                    from wineutils import WineGetKeys
+                        defaultkeys = nookkeys()
+                    else: # linux
+                        from wineutils import WineGetKeys
 
-                    scriptpath = os.path.join(self.alfdir,u"ignoblekey.py")
-                    defaultkeys = WineGetKeys(scriptpath, u".b64",dedrmprefs['adobewineprefix'])
+                        scriptpath = os.path.join(self.alfdir,u"ignoblekey.py")
+                        defaultkeys = WineGetKeys(scriptpath, u".b64",dedrmprefs['adobewineprefix'])
 
-            except:
-                print u"{0} v{1}: Exception when getting default NOOK Study Key after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION, time.time()-self.starttime)
-                traceback.print_exc()
+                except:
+                    print u"{0} v{1}: Exception when getting default NOOK Study Key after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION, time.time()-self.starttime)
+                    traceback.print_exc()
 
             newkeys = []
             for keyvalue in defaultkeys:
@@ -269,12 +274,15 @@ class DeDRM(FileTypePlugin):
                         of = self.temporary_file(u".epub")
 
                         # Give the user key, ebook and TemporaryPersistent file to the decryption function.
-                        try:
-                            result = ignobleepub.decryptBook(userkey, inf.name, of.name)
-                        except:
-                           print u"{0} v{1}: Exception when trying to decrypt after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION, time.time()-self.starttime)
-                           traceback.print_exc()
-                           result = 1
+                        self.recorder.count('key attempts')
+                        with self.recorder.span('key attempt', key=u"default_key_{0:d}".format(i+1)) as span:
+                            try:
+                                result = ignobleepub.decryptBook(userkey, inf.name, of.name)
+                            except:
+                               print u"{0} v{1}: Exception when trying to decrypt after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION, time.time()-self.starttime)
+                               traceback.print_exc()
+                               result = 1
+                            span.ok = result == 0
 
                         of.close()
 
@@ -312,12 +320,15 @@ class DeDRM(FileTypePlugin):
                 of = self.temporary_file(u".epub")
 
                 # Give the user key, ebook and TemporaryPersistent file to the decryption function.
-                try:
-                    result = ineptepub.decryptBook(userkey, inf.name, of.name)
-                except:
-                    print u"{0} v{1}: Exception when decrypting after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION, time.time()-self.starttime)
-                    traceback.print_exc()
-                    result = 1
+                self.recorder.count('key attempts')
+                with self.recorder.span('key attempt', key=keyname) as span:
+                    try:
+                        result = ineptepub.decryptBook(userkey, inf.name, of.name)
+                    except:
+                        print u"{0} v{1}: Exception when decrypting after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION, time.time()-self.starttime)
+                        traceback.print_exc()
+                        result = 1
+                    span.ok = result == 0
 
                 try:
                     of.close()
@@ -338,22 +349,23 @@ class DeDRM(FileTypePlugin):
             # get the default Adobe keys
             defaultkeys = []
 
-            try:
-                if iswindows or isosx:
-                    from calibre_plugins.dedrm.adobekey import adeptkeys
+            with self.recorder.span('key lookup'):
+                try:
+                    if iswindows or isosx:
+                        from calibre_plugins.dedrm.adobekey import adeptkeys
 
-                    defaultkeys = adeptkeys()
-                else: # linux
-                    from wineutils import WineGetKeys
+                        defaultkeys = adeptkeys()
+                    else: # linux
+                        from wineutils import WineGetKeys
 
-                    scriptpath = os.path.join(self.alfdir,u"adobekey.py")
-                    defaultkeys = WineGetKeys(scriptpath, u".der",dedrmprefs['adobewineprefix'])
+                        scriptpath = os.path.join(self.alfdir,u"adobekey.py")
+                        defaultkeys = WineGetKeys(scriptpath, u".der",dedrmprefs['adobewineprefix'])
 
-                self.default_key = defaultkeys[0]
-            except:
-                print u"{0} v{1}: Exception when getting default Adobe Key after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION, time.time()-self.starttime)
-                traceback.print_exc()
-                self.default_key = u""
+                    self.default_key = defaultkeys[0]
+                except:
+                    print u"{0} v{1}: Exception when getting default Adobe Key after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION, time.time()-self.starttime)
+                    traceback.print_exc()
+                    self.default_key = u""
 
             newkeys = []
             for keyvalue in defaultkeys:
@@ -367,12 +379,15 @@ class DeDRM(FileTypePlugin):
                         of = self.temporary_file(u".epub")
 
                         # Give the user key, ebook and TemporaryPersistent file to the decryption function.
-                        try:
-                            result = ineptepub.decryptBook(userkey, inf.name, of.name)
-                        except:
-                            print u"{0} v{1}: Exception when decrypting after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION, time.time()-self.starttime)
-                            traceback.print_exc()
-                            result = 1
+                        self.recorder.count('key attempts')
+                        with self.recorder.span('key attempt', key=u"default_key_{0:d}".format(i+1)) as span:
+                            try:
+                                result = ineptepub.decryptBook(userkey, inf.name, of.name)
+                            except:
+                                print u"{0} v{1}: Exception when decrypting after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION, time.time()-self.starttime)
+                                traceback.print_exc()
+                                result = 1
+                            span.ok = result == 0
 
                         of.close()
 
@@ -419,12 +434,15 @@ class DeDRM(FileTypePlugin):
             of = self.temporary_file(u".pdf")
 
             # Give the user key, ebook and TemporaryPersistent file to the decryption function.
-            try:
-                result = ineptpdf.decryptBook(userkey, path_to_ebook, of.name)
-            except:
-                print u"{0} v{1}: Exception when decrypting after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION, time.time()-self.starttime)
-                traceback.print_exc()
-                result = 1
+            self.recorder.count('key attempts')
+            with self.recorder.span('key attempt', key=keyname) as span:
+                try:
+                    result = ineptpdf.decryptBook(userkey, path_to_ebook, of.name)
+                except:
+                    print u"{0} v{1}: Exception when decrypting after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION, time.time()-self.starttime)
+                    traceback.print_exc()
+                    result = 1
+                span.ok = result == 0
 
             of.close()
 
@@ -441,22 +459,23 @@ class DeDRM(FileTypePlugin):
         # get the default Adobe keys
         defaultkeys = []
 
-        try:
-            if iswindows or isosx:
-                from calibre_plugins.dedrm.adobekey import adeptkeys
+        with self.recorder.span('key lookup'):
+            try:
+                if iswindows or isosx:
+                    from calibre_plugins.dedrm.adobekey import adeptkeys
 
-                defaultkeys = adeptkeys()
-            else: # linux
-                from wineutils import WineGetKeys
+                    defaultkeys = adeptkeys()
+                else: # linux
+                    from wineutils import WineGetKeys
 
-                scriptpath = os.path.join(self.alfdir,u"adobekey.py")
-                defaultkeys = WineGetKeys(scriptpath, u".der",dedrmprefs['adobewineprefix'])
+                    scriptpath = os.path.join(self.alfdir,u"adobekey.py")
+                    defaultkeys = WineGetKeys(scriptpath, u".der",dedrmprefs['adobewineprefix'])
 
-            self.default_key = defaultkeys[0]
-        except:
-            print u"{0} v{1}: Exception when getting default Adobe Key after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION, time.time()-self.starttime)
-            traceback.print_exc()
-            self.default_key = u""
+                self.default_key = defaultkeys[0]
+            except:
+                print u"{0} v{1}: Exception when getting default Adobe Key after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION, time.time()-self.starttime)
+                traceback.print_exc()
+                self.default_key = u""
 
         newkeys = []
         for keyvalue in defaultkeys:
@@ -470,12 +489,15 @@ class DeDRM(FileTypePlugin):
                     of = self.temporary_file(u".pdf")
 
                     # Give the user key, ebook and TemporaryPersistent file to the decryption function.
-                    try:
-                        result = ineptpdf.decryptBook(userkey, path_to_ebook, of.name)
-                    except:
-                        print u"{0} v{1}: Exception when decrypting after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION, time.time()-self.starttime)
-                        traceback.print_exc()
-                        result = 1
+                    self.recorder.count('key attempts')
+                    with self.recorder.span('key attempt', key=u"default_key_{0:d}".format(i+1)) as span:
+                        try:
+                            result = ineptpdf.decryptBook(userkey, path_to_ebook, of.name)
+                        except:
+                            print u"{0} v{1}: Exception when decrypting after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION, time.time()-self.starttime)
+                            traceback.print_exc()
+                            result = 1
+                        span.ok = result == 0
 
                     of.close()
 
@@ -532,20 +554,21 @@ class DeDRM(FileTypePlugin):
             print u"{0} v{1}: Failed to decrypt with error: {2}".format(PLUGIN_NAME, PLUGIN_VERSION,e.args[0])
             print u"{0} v{1}: Looking for new default Kindle Key after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION, time.time()-self.starttime)
 
-            try:
-                if iswindows or isosx:
-                    from calibre_plugins.dedrm.kindlekey import kindlekeys
+            with self.recorder.span('key lookup'):
+                try:
+                    if iswindows or isosx:
+                        from calibre_plugins.dedrm.kindlekey import kindlekeys
 
-                    defaultkeys = kindlekeys()
-                else: # linux
-                    from wineutils import WineGetKeys
+                        defaultkeys = kindlekeys()
+                    else: # linux
+                        from wineutils import WineGetKeys
 
-                    scriptpath = os.path.join(self.alfdir,u"kindlekey.py")
-                    defaultkeys = WineGetKeys(scriptpath, u".k4i",dedrmprefs['kindlewineprefix'])
-            except:
-                print u"{0} v{1}: Exception when getting default Kindle Key after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION, time.time()-self.starttime)
-                traceback.print_exc()
-                pass
+                        scriptpath = os.path.join(self.alfdir,u"kindlekey.py")
+                        defaultkeys = WineGetKeys(scriptpath, u".k4i",dedrmprefs['kindlewineprefix'])
+                except:
+                    print u"{0} v{1}: Exception when getting default Kindle Key after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION, time.time()-self.starttime)
+                    traceback.print_exc()
+                    pass
 
             newkeys = {}
             for i,keyvalue in enumerate(defaultkeys):
@@ -570,7 +593,15 @@ class DeDRM(FileTypePlugin):
                 raise DeDRMError(u"{0} v{1}: Ultimately failed to decrypt after {2:.1f} seconds. Read the FAQs at Harper's repository: https://github.com/apprenticeharper/DeDRM_tools/blob/master/FAQs.md".format(PLUGIN_NAME, PLUGIN_VERSION,time.time()-self.starttime))
 
         of = self.temporary_file(book.getBookExtension())
-        book.getFile(of.name)
+        # KFX pages are decrypted as they are written, so this can still fail
+        try:
+            with self.recorder.span('write') as span:
+                book.getFile(of.name)
+                span.nbytes = os.path.getsize(of.name)
+        except Exception, e:
+            book.cleanup()
+            print u"{0} v{1}: Failed to write decrypted book after {2:.1f} seconds: {3}".format(PLUGIN_NAME, PLUGIN_VERSION,time.time()-self.starttime,e.args[0])
+            raise DeDRMError(u"{0} v{1}: Failed to write decrypted book after {2:.1f} seconds. Read the FAQs at Harper's repository: https://github.com/apprenticeharper/DeDRM_tools/blob/master/FAQs.md".format(PLUGIN_NAME, PLUGIN_VERSION,time.time()-self.starttime))
         of.close()
         book.cleanup()
         return of.name
@@ -589,7 +620,10 @@ class DeDRM(FileTypePlugin):
             of = self.temporary_file(u".pmlz")
 
             # Give the userkey, ebook and TemporaryPersistent file to the decryption function.
-            result = erdr2pml.decryptBook(path_to_ebook, of.name, True, userkey.decode('hex'))
+            self.recorder.count('key attempts')
+            with self.recorder.span('key attempt', key=keyname_masked) as span:
+                result = erdr2pml.decryptBook(path_to_ebook, of.name, True, userkey.decode('hex'))
+                span.ok = result == 0
 
             of.close()
 
@@ -614,24 +648,36 @@ class DeDRM(FileTypePlugin):
         print u"{0} v{1}: Trying to decrypt {2}".format(PLUGIN_NAME, PLUGIN_VERSION, os.path.basename(path_to_ebook))
         self.starttime = time.time()
 
+        # stage timings and counters go to the sinks named in DEDRM_INSTRUMENT, if any
+        import calibre_plugins.dedrm.instrument as instrument
+        self.recorder = instrument.configure()
+
         booktype = os.path.splitext(path_to_ebook)[1].lower()[1:]
-        if booktype in ['prc','mobi','pobi','azw','azw1','azw3','azw4','tpz','kfx-zip']:
-            # Kindle/Mobipocket
-            decrypted_ebook = self.KindleMobiDecrypt(path_to_ebook)
-        elif booktype == 'pdb':
-            # eReader
-            decrypted_ebook = self.eReaderDecrypt(path_to_ebook)
-            pass
-        elif booktype == 'pdf':
-            # Adobe Adept PDF (hopefully)
-            decrypted_ebook = self.PDFDecrypt(path_to_ebook)
-            pass
-        elif booktype == 'epub':
-            # Adobe Adept or B&N ePub
-            decrypted_ebook = self.ePubDecrypt(path_to_ebook)
-        else:
-            print u"Unknown booktype {0}. Passing back to calibre unchanged".format(booktype)
-            return path_to_ebook
+        decrypted_ebook = None
+        self.recorder.begin(path_to_ebook, booktype=booktype, app=PLUGIN_NAME, version=PLUGIN_VERSION)
+        try:
+            if booktype in ['prc','mobi','pobi','azw','azw1','azw3','azw4','tpz','kfx-zip']:
+                # Kindle/Mobipocket
+                decrypted_ebook = self.KindleMobiDecrypt(path_to_ebook)
+            elif booktype == 'pdb':
+                # eReader
+                decrypted_ebook = self.eReaderDecrypt(path_to_ebook)
+                pass
+            elif booktype == 'pdf':
+                # Adobe Adept PDF (hopefully)
+                decrypted_ebook = self.PDFDecrypt(path_to_ebook)
+                pass
+            elif booktype == 'epub':
+                # Adobe Adept or B&N ePub
+                decrypted_ebook = self.ePubDecrypt(path_to_ebook)
+            else:
+                print u"Unknown booktype {0}. Passing back to calibre unchanged".format(booktype)
+                # passing the book on is not a failure
+                decrypted_ebook = path_to_ebook
+                return decrypted_ebook
+            self.recorder.countfile('bytes out', decrypted_ebook)
+        finally:
+            self.recorder.end(decrypted_ebook is not None)
         print u"{0} v{1}: Finished after {2:.1f} seconds".format(PLUGIN_NAME, PLUGIN_VERSION,time.time()-self.starttime)
         return decrypted_ebook
 
@@ -158,6 +158,13 @@ def _load_libalfcrypto():
             topazCryptoDecrypt(ctx, data, out, len(data))
             return out.raw
 
+        def decrypt_records(self, records, ctx=None):
+            # each record is decrypted from the start of the context, and
+            # the library has no call for more than one record at a time
+            if ctx == None:
+                ctx = self._ctx
+            return [self.decrypt(record, ctx) for record in records]
+
     print u"Using Library AlfCrypto DLL/DYLIB/SO"
     return (AES_CBC, Pukall_Cipher, Topaz_Cipher)
 
@@ -214,19 +221,26 @@ def _load_python_alfcrypto():
             self._ctx = [ctx1, ctx2]
             return [ctx1,ctx2]
 
+        # (m * m * 0x0F902007) & 0xFFFFFFFF for every byte value m
+        _squares = [(m * m * 0x0F902007) & 0xFFFFFFFF for m in xrange(256)]
+
         def decrypt(self, data,  ctx=None):
             if ctx == None:
                 ctx = self._ctx
             ctx1 = ctx[0]
             ctx2 = ctx[1]
-            plainText = ""
-            for dataChar in data:
-                dataByte = ord(dataChar)
-                m = (dataByte ^ ((ctx1 >> 3) &0xFF) ^ ((ctx2<<3) & 0xFF)) &0xFF
+            squares = self._squares
+            plainText = bytearray(data)
+            for i, dataByte in enumerate(plainText):
+                m = (dataByte ^ ((ctx1 >> 3) &0xFF) ^ ((ctx2<<3) & 0xFF))
                 ctx2 = ctx1
-                ctx1 = (((ctx1 >> 2) * (ctx1 >> 7)) &0xFFFFFFFF) ^((m * m * 0x0F902007) &0xFFFFFFFF)
-                plainText += chr(m)
-            return plainText
+                ctx1 = (((ctx1 >> 2) * (ctx1 >> 7)) &0xFFFFFFFF) ^ squares[m]
+                plainText[i] = m
+            return str(plainText)
+
+        def decrypt_records(self, records, ctx=None):
+            # each record is decrypted from the start of the context
+            return [self.decrypt(record, ctx) for record in records]
 
     class AES_CBC(object):
         def __init__(self):
@@ -16,6 +16,7 @@ sys.stdout=Unbuffered(sys.stdout)
 import csv
 import os
 import getopt
+import hashlib
 from struct import pack
 from struct import unpack
 
@@ -42,31 +43,10 @@ else :
 # global switch
 buildXML = False
 
-# Get a 7 bit encoded number from a file
-def readEncodedNumber(file):
-    flag = False
-    c = file.read(1)
-    if (len(c) == 0):
-        return None
-    data = ord(c)
-    if data == 0xFF:
-        flag = True
-        c = file.read(1)
-        if (len(c) == 0):
-            return None
-        data = ord(c)
-    if data >= 0x80:
-        datax = (data & 0x7F)
-        while data >= 0x80 :
-            c = file.read(1)
-            if (len(c) == 0):
-                return None
-            data = ord(c)
-            datax = (datax <<7) + (data & 0x7F)
-        data = datax
-    if flag:
-        data = -data
-    return data
+# Get a 7 bit encoded number from a file, decoded by convert2xml
+readEncodedNumber = convert2xml.readEncodedNumber
+decodeNumber = convert2xml.decodeNumber
+decodeString = convert2xml.decodeString
 
 # Get a length prefixed string from the file
 def lengthPrefixString(data):
@@ -81,30 +61,32 @@ def readString(file):
         return ""
     return unpack(str(stringLength)+"s",sv)[0]
 
-def getMetaArray(metaFile):
+def getMetaArray(metaFile, data=None):
     # parse the meta file
     result = {}
-    fo = file(metaFile,'rb')
-    size = readEncodedNumber(fo)
+    if data is None:
+        data = file(metaFile,'rb').read()
+    size, pos = decodeNumber(data)
     for i in xrange(size):
-        tag = readString(fo)
-        value = readString(fo)
+        tag, pos = decodeString(data, pos)
+        value, pos = decodeString(data, pos)
         result[tag] = value
         # print tag, value
-    fo.close()
     return result
 
 
 # dictionary of all text strings by index value
 class Dictionary(object):
-    def __init__(self, dictFile):
+    def __init__(self, dictFile, data=None):
         self.filename = dictFile
         self.size = 0
-        self.fo = file(dictFile,'rb')
+        if data is None:
+            data = file(dictFile,'rb').read()
         self.stable = []
-        self.size = readEncodedNumber(self.fo)
+        self.size, pos = decodeNumber(data)
         for i in xrange(self.size):
-            self.stable.append(self.escapestr(readString(self.fo)))
+            sv, pos = decodeString(data, pos)
+            self.stable.append(self.escapestr(sv))
         self.pos = 0
     def escapestr(self, str):
         str = str.replace('&','&amp;')
@@ -128,29 +110,10 @@ class Dictionary(object):
 
 class PageDimParser(object):
     def __init__(self, flatxml):
-        self.flatdoc = flatxml.split('\n')
+        self.doc = convert2xml.getFlatDoc(flatxml)
     # find tag if within pos to end inclusive
     def findinDoc(self, tagpath, pos, end) :
-        result = None
-        docList = self.flatdoc
-        cnt = len(docList)
-        if end == -1 :
-            end = cnt
-        else:
-            end = min(cnt,end)
-        foundat = -1
-        for j in xrange(pos, end):
-            item = docList[j]
-            if item.find('=') >= 0:
-                (name, argres) = item.split('=')
-            else :
-                name = item
-                argres = ''
-            if name.endswith(tagpath) :
-                result = argres
-                foundat = j
-                break
-        return foundat, result
+        return self.doc.findinDoc(tagpath, pos, end)
     def process(self):
         (pos, sph) = self.findinDoc('page.h',0,-1)
         (pos, spw) = self.findinDoc('page.w',0,-1)
@@ -166,7 +129,7 @@ def getPageDim(flatxml):
 
 class GParser(object):
     def __init__(self, flatxml):
-        self.flatdoc = flatxml.split('\n')
+        self.doc = convert2xml.getFlatDoc(flatxml)
         self.dpi = 1440
         self.gh = self.getData('info.glyph.h')
         self.gw = self.getData('info.glyph.w')
@@ -190,23 +153,10 @@ class GParser(object):
         elif self.gvtx :
             self.gvtx.append(0)
     def getData(self, path):
-        result = None
-        cnt = len(self.flatdoc)
-        for j in xrange(cnt):
-            item = self.flatdoc[j]
-            if item.find('=') >= 0:
-                (name, argt) = item.split('=')
-                argres = argt.split('|')
-            else:
-                name = item
-                argres = []
-            if (name == path):
-                result = argres
-                break
-        if (len(argres) > 0) :
-            for j in xrange(0,len(argres)):
-                argres[j] = int(argres[j])
-        return result
+        positions = self.doc.exactposinDoc(path)
+        if len(positions) == 0:
+            return None
+        return self.doc.getInts(positions[0])
     def getGlyphDim(self, gly):
         if self.gdpi[gly] == 0:
             return 0, 0
@@ -255,89 +205,139 @@ class GParser(object):
 class GlyphDict(object):
     def __init__(self):
         self.gdict = {}
+        self.gdims = {}
     def lookup(self, id):
         # id='id="gl%d"' % val
         if id in self.gdict:
             return self.gdict[id]
         return None
-    def addGlyph(self, val, path):
+    def lookupDim(self, id):
+        # (width, height) of the glyph, None when not known
+        return self.gdims.get(id)
+    def addGlyph(self, val, path, maxw=None, maxh=None):
         id='id="gl%d"' % val
         self.gdict[id] = path
+        if maxw != None:
+            self.gdims[id] = (maxw, maxh)
 
 
-def generateBook(bookDir, raw, fixedimage):
-    # sanity check Topaz file extraction
-    if not os.path.exists(bookDir) :
-        print "Can not find directory with unencrypted book"
-        return 1
+# in memory store for the files of an unpacked Topaz book, keyed by their
+# path relative to the book directory ('page/page0000.dat', 'svg/toc.xhtml')
+class BookFiles(object):
+    def __init__(self):
+        self.files = {}
+    def __contains__(self, name):
+        return name in self.files
+    def read(self, name):
+        return self.files[name]
+    def write(self, name, data):
+        self.files[name] = data
+    def listdir(self, dirname):
+        prefix = dirname + '/'
+        return sorted([name[len(prefix):] for name in self.files if name.startswith(prefix)])
+    def names(self):
+        return sorted(self.files.keys())
+    def loadDir(self, bookDir):
+        for root, dirs, filenames in os.walk(bookDir):
+            for filename in filenames:
+                fname = os.path.join(root, filename)
+                name = os.path.relpath(fname, bookDir).replace(os.sep, '/')
+                self.files[name] = file(fname, 'rb').read()
+    def saveDir(self, bookDir, names=None):
+        if names == None:
+            names = self.names()
+        for name in names:
+            fname = os.path.join(bookDir, *name.split('/'))
+            dname = os.path.dirname(fname)
+            if not os.path.exists(dname):
+                os.makedirs(dname)
+            file(fname, 'wb').write(self.files[name])
+
+
+# per process state of the page renderers, shared by all pages of a book
+_pageState = None
+
+def _setPageState(dict, classlst, gd, fixedimage, raw, meta_array, scaledpi, glyphatlas):
+    global _pageState
+    _pageState = (dict, classlst, gd, fixedimage, raw, meta_array, scaledpi, glyphatlas)
+
+# worker process side of the parallel page rendering
+def _initPageWorker(dictdata, classlst, gd, fixedimage, raw, meta_array, scaledpi, glyphatlas):
+    _setPageState(Dictionary('dict0000.dat', dictdata), classlst, gd, fixedimage, raw, meta_array, scaledpi, glyphatlas)
+
+# returns the parsed page, debug xml, html, toc entries and svg images of one page
+def _renderPage((fname, data)):
+    (dict, classlst, gd, fixedimage, raw, meta_array, scaledpi, glyphatlas) = _pageState
+    flat_doc = convert2xml.getDoc(dict, fname, data)
+    xml = None
+    if buildXML:
+        xml = convert2xml.getXML(dict, fname, data)
+    images = BookFiles()
+    pagehtml, tocinfo = flatxml2html.convert2HTML(flat_doc, classlst, fname, images, gd, fixedimage)
+    return flat_doc, xml, pagehtml, tocinfo, images.files
+
+def _renderSVG((pageid, previd, nextid, flat_svg)):
+    (dict, classlst, gd, fixedimage, raw, meta_array, scaledpi, glyphatlas) = _pageState
+    return flatxml2svg.convert2SVG(gd, flat_svg, pageid, previd, nextid, 'svg', raw, meta_array, scaledpi, glyphatlas)
+
+
+# with glyphatlas the svg pages refer to the glyph paths in glyphs.svg, and
+# identical fixed region images are kept once; those images still carry
+# their own glyphs, as the html shows them through <img>
+def generateBook(bookDir, raw, fixedimage, files=None, workers=0, glyphatlas=False):
+    global _pageState
+    # with no in memory files given, work from (and write back to) bookDir
+    if files == None:
+        if not os.path.exists(bookDir) :
+            print "Can not find directory with unencrypted book"
+            return 1
+        files = BookFiles()
+        files.loadDir(bookDir)
+        inputs = files.files.copy()
+        rv = generateBook(bookDir, raw, fixedimage, files, workers, glyphatlas)
+        if rv == 0:
+            # only write back what generation added or replaced
+            files.saveDir(bookDir, [name for name in files.names() if inputs.get(name) is not files.read(name)])
+        return rv
 
-    dictFile = os.path.join(bookDir,'dict0000.dat')
-    if not os.path.exists(dictFile) :
+    # sanity check Topaz file extraction
+    if 'dict0000.dat' not in files :
         print "Can not find dict0000.dat file"
         return 1
 
-    pageDir = os.path.join(bookDir,'page')
-    if not os.path.exists(pageDir) :
+    if len(files.listdir('page')) == 0 :
         print "Can not find page directory in unencrypted book"
         return 1
 
-    imgDir = os.path.join(bookDir,'img')
-    if not os.path.exists(imgDir) :
-        print "Can not find image directory in unencrypted book"
-        return 1
-
-    glyphsDir = os.path.join(bookDir,'glyphs')
-    if not os.path.exists(glyphsDir) :
+    if len(files.listdir('glyphs')) == 0 :
         print "Can not find glyphs directory in unencrypted book"
         return 1
 
-    metaFile = os.path.join(bookDir,'metadata0000.dat')
-    if not os.path.exists(metaFile) :
+    if 'metadata0000.dat' not in files :
         print "Can not find metadata0000.dat in unencrypted book"
         return 1
 
-    svgDir = os.path.join(bookDir,'svg')
-    if not os.path.exists(svgDir) :
-        os.makedirs(svgDir)
-
-    if buildXML:
-        xmlDir = os.path.join(bookDir,'xml')
-        if not os.path.exists(xmlDir) :
-            os.makedirs(xmlDir)
-
-    otherFile = os.path.join(bookDir,'other0000.dat')
-    if not os.path.exists(otherFile) :
+    if 'other0000.dat' not in files :
         print "Can not find other0000.dat in unencrypted book"
         return 1
 
     print "Updating to color images if available"
-    spath = os.path.join(bookDir,'color_img')
-    dpath = os.path.join(bookDir,'img')
-    filenames = os.listdir(spath)
-    filenames = sorted(filenames)
-    for filename in filenames:
+    for filename in files.listdir('color_img'):
         imgname = filename.replace('color','img')
-        sfile = os.path.join(spath,filename)
-        dfile = os.path.join(dpath,imgname)
-        imgdata = file(sfile,'rb').read()
-        file(dfile,'wb').write(imgdata)
+        files.write('img/' + imgname, files.read('color_img/' + filename))
 
     print "Creating cover.jpg"
     isCover = False
-    cpath = os.path.join(bookDir,'img')
-    cpath = os.path.join(cpath,'img0000.jpg')
-    if os.path.isfile(cpath):
-        cover = file(cpath, 'rb').read()
-        cpath = os.path.join(bookDir,'cover.jpg')
-        file(cpath, 'wb').write(cover)
+    if 'img/img0000.jpg' in files:
+        files.write('cover.jpg', files.read('img/img0000.jpg'))
         isCover = True
 
 
     print 'Processing Dictionary'
-    dict = Dictionary(dictFile)
+    dict = Dictionary('dict0000.dat', files.read('dict0000.dat'))
 
     print 'Processing Meta Data and creating OPF'
-    meta_array = getMetaArray(metaFile)
+    meta_array = getMetaArray('metadata0000.dat', files.read('metadata0000.dat'))
 
     # replace special chars in title and authors like & < >
     title = meta_array.get('Title','No Title Provided')
@@ -352,13 +352,12 @@ def generateBook(bookDir, raw, fixedimage):
     meta_array['Authors'] = authors
 
     if buildXML:
-        xname = os.path.join(xmlDir, 'metadata.xml')
         mlst = []
         for key in meta_array:
             mlst.append('<meta name="' + key + '" content="' + meta_array[key] + '" />\n')
         metastr = "".join(mlst)
         mlst = None
-        file(xname, 'wb').write(metastr)
+        files.write('xml/metadata.xml', metastr)
 
     print 'Processing StyleSheet'
 
@@ -371,7 +370,7 @@ def generateBook(bookDir, raw, fixedimage):
 
     # also get the size of a normal text page
     # get the total number of pages unpacked as a safety check
-    filenames = os.listdir(pageDir)
+    filenames = files.listdir('page')
     numfiles = len(filenames)
 
     spage = '1'
@@ -386,10 +385,10 @@ def generateBook(bookDir, raw, fixedimage):
 
     # get page height and width from first text page for use in stylesheet scaling
     pname = 'page%04d.dat' % (pnum - 1)
-    fname = os.path.join(pageDir,pname)
-    flat_xml = convert2xml.fromData(dict, fname)
+    fname = 'page/' + pname
+    flat_doc = convert2xml.getDoc(dict, fname, files.read(fname))
 
-    (ph, pw) = getPageDim(flat_xml)
+    (ph, pw) = getPageDim(flat_doc)
     if (ph == '-1') or (ph == '0') : ph = '11000'
     if (pw == '-1') or (pw == '0') : pw = '8500'
     meta_array['pageHeight'] = ph
@@ -400,15 +399,13 @@ def generateBook(bookDir, raw, fixedimage):
     # process other.dat for css info and for map of page files to svg images
     # this map is needed because some pages actually are made up of multiple
     # pageXXXX.xml files
-    xname = os.path.join(bookDir, 'style.css')
-    flat_xml = convert2xml.fromData(dict, otherFile)
+    otherdata = files.read('other0000.dat')
+    flat_doc = convert2xml.getDoc(dict, 'other0000.dat', otherdata)
 
     # extract info.original.pid to get original page information
     pageIDMap = {}
-    pageidnums = stylexml2css.getpageIDMap(flat_xml)
+    pageidnums = stylexml2css.getpageIDMap(flat_doc)
     if len(pageidnums) == 0:
-        filenames = os.listdir(pageDir)
-        numfiles = len(filenames)
         for k in range(numfiles):
             pageidnums.append(k)
     # create a map from page ids to list of page file nums to process for that page
@@ -420,45 +417,43 @@ def generateBook(bookDir, raw, fixedimage):
             pageIDMap[id] = [i]
 
     # now get the css info
-    cssstr , classlst = stylexml2css.convert2CSS(flat_xml, fontsize, ph, pw)
-    file(xname, 'wb').write(cssstr)
+    cssstr , classlst = stylexml2css.convert2CSS(flat_doc, fontsize, ph, pw)
+    files.write('style.css', cssstr)
     if buildXML:
-        xname = os.path.join(xmlDir, 'other0000.xml')
-        file(xname, 'wb').write(convert2xml.getXML(dict, otherFile))
+        files.write('xml/other0000.xml', convert2xml.getXML(dict, 'other0000.dat', otherdata))
 
     print 'Processing Glyphs'
     gd = GlyphDict()
-    filenames = os.listdir(glyphsDir)
-    filenames = sorted(filenames)
-    glyfname = os.path.join(svgDir,'glyphs.svg')
-    glyfile = open(glyfname, 'w')
-    glyfile.write('<?xml version="1.0" standalone="no"?>\n')
-    glyfile.write('<!DOCTYPE svg PUBLIC "-//W3C/DTD SVG 1.1//EN" "http://www.w3.org/Graphics/SVG/1.1/DTD/svg11.dtd">\n')
-    glyfile.write('<svg width="512" height="512" viewBox="0 0 511 511" xmlns="http://www.w3.org/2000/svg" version="1.1">\n')
-    glyfile.write('<title>Glyphs for %s</title>\n' % meta_array['Title'])
-    glyfile.write('<defs>\n')
+    filenames = files.listdir('glyphs')
+    glst = []
+    glst.append('<?xml version="1.0" standalone="no"?>\n')
+    glst.append('<!DOCTYPE svg PUBLIC "-//W3C/DTD SVG 1.1//EN" "http://www.w3.org/Graphics/SVG/1.1/DTD/svg11.dtd">\n')
+    glst.append('<svg width="512" height="512" viewBox="0 0 511 511" xmlns="http://www.w3.org/2000/svg" version="1.1">\n')
+    glst.append('<title>Glyphs for %s</title>\n' % meta_array['Title'])
+    glst.append('<defs>\n')
     counter = 0
     for filename in filenames:
         # print '     ', filename
         print '.',
-        fname = os.path.join(glyphsDir,filename)
-        flat_xml = convert2xml.fromData(dict, fname)
+        fname = 'glyphs/' + filename
+        gdata = files.read(fname)
+        flat_doc = convert2xml.getDoc(dict, fname, gdata)
 
         if buildXML:
-            xname = os.path.join(xmlDir, filename.replace('.dat','.xml'))
-            file(xname, 'wb').write(convert2xml.getXML(dict, fname))
+            files.write('xml/' + filename.replace('.dat','.xml'), convert2xml.getXML(dict, fname, gdata))
 
-        gp = GParser(flat_xml)
+        gp = GParser(flat_doc)
         for i in xrange(0, gp.count):
             path = gp.getPath(i)
             maxh, maxw = gp.getGlyphDim(i)
             fullpath = '<path id="gl%d" d="%s" fill="black" /><!-- width=%d height=%d -->\n' % (counter * 256 + i, path, maxw, maxh)
-            glyfile.write(fullpath)
-            gd.addGlyph(counter * 256 + i, fullpath)
+            glst.append(fullpath)
+            gd.addGlyph(counter * 256 + i, fullpath, maxw, maxh)
         counter += 1
-    glyfile.write('</defs>\n')
-    glyfile.write('</svg>\n')
-    glyfile.close()
+    glst.append('</defs>\n')
+    glst.append('</svg>\n')
+    files.write('svg/glyphs.svg', "".join(glst))
+    glst = None
     print " "
 
 
@@ -486,36 +481,95 @@ def generateBook(bookDir, raw, fixedimage):
     # readability when rendering to the screen.
     scaledpi = 1440.0
 
-    filenames = os.listdir(pageDir)
-    filenames = sorted(filenames)
+    filenames = files.listdir('page')
     numfiles = len(filenames)
 
     xmllst = []
     elst = []
+    svglst = []
+
+    # pages only share the dictionary, stylesheet classes and glyphs, so
+    # with workers > 0 they are rendered by a pool of processes; results
+    # come back in page order either way
+    pool = None
+    if workers > 0:
+        import multiprocessing
+        pool = multiprocessing.Pool(workers, _initPageWorker,
+                                    (files.read('dict0000.dat'), classlst, gd, fixedimage, raw, meta_array, scaledpi, glyphatlas))
+        imap = lambda func, tasks: pool.imap(func, tasks, 4)
+    else:
+        import itertools
+        _setPageState(dict, classlst, gd, fixedimage, raw, meta_array, scaledpi, glyphatlas)
+        imap = itertools.imap
 
-    for filename in filenames:
-        # print '     ', filename
-        print ".",
-        fname = os.path.join(pageDir,filename)
-        flat_xml = convert2xml.fromData(dict, fname)
-
-        # keep flat_xml for later svg processing
-        xmllst.append(flat_xml)
-
-        if buildXML:
-            xname = os.path.join(xmlDir, filename.replace('.dat','.xml'))
-            file(xname, 'wb').write(convert2xml.getXML(dict, fname))
+    # content hash of each fixed region image written so far
+    imagenames = {}
 
-        # first get the html
-        pagehtml, tocinfo = flatxml2html.convert2HTML(flat_xml, classlst, fname, bookDir, gd, fixedimage)
-        elst.append(tocinfo)
-        hlst.append(pagehtml)
+    try:
+        tasks = [('page/' + filename, files.read('page/' + filename)) for filename in filenames]
+        results = imap(_renderPage, tasks)
+        for filename in filenames:
+            # print '     ', filename
+            print ".",
+            flat_doc, xml, pagehtml, tocinfo, images = results.next()
+
+            # keep the parsed page for later svg processing
+            xmllst.append(flat_doc)
+
+            if buildXML:
+                files.write('xml/' + filename.replace('.dat','.xml'), xml)
+
+            # first get the html
+            for name in sorted(images):
+                if glyphatlas:
+                    # point the html at an identical earlier image instead
+                    digest = hashlib.sha1(images[name]).digest()
+                    if digest in imagenames:
+                        pagehtml = pagehtml.replace('"' + name + '"', '"' + imagenames[digest] + '"')
+                        continue
+                    imagenames[digest] = name
+                files.write(name, images[name])
+            elst.append(tocinfo)
+            hlst.append(pagehtml)
+
+        # then the svg page images, which may each combine several page files
+        idlst = sorted(pageIDMap.keys())
+        tasks = []
+        previd = None
+        for j in range(len(idlst)):
+            pageid = idlst[j]
+            if j < len(idlst) - 1:
+                nextid = idlst[j+1]
+            else:
+                nextid = None
+            pagelst = pageIDMap[pageid]
+            if len(pagelst) == 1:
+                flat_svg = xmllst[pagelst[0]]
+            else:
+                flat_svg = convert2xml.FlatDoc()
+                for page in pagelst:
+                    flat_svg.extend(xmllst[page])
+            tasks.append((pageid, previd, nextid, flat_svg))
+            previd = pageid
+        svglst = list(imap(_renderSVG, tasks))
+        tasks = None
+        if pool:
+            pool.close()
+    except:
+        if pool:
+            pool.terminate()
+        raise
+    finally:
+        if pool:
+            pool.join()
+        # let go of this book's dictionary and glyphs
+        _pageState = None
 
     # finish up the html string and output it
     hlst.append('</body>\n</html>\n')
     htmlstr = "".join(hlst)
     hlst = None
-    file(os.path.join(bookDir, htmlFileName), 'wb').write(htmlstr)
+    files.write(htmlFileName, htmlstr)
 
     print " "
     print 'Extracting Table of Contents from Amazon OCR'
@@ -561,7 +615,7 @@ def generateBook(bookDir, raw, fixedimage):
     tlst.append('</body>\n')
     tlst.append('</html>\n')
     tochtml = "".join(tlst)
-    file(os.path.join(svgDir, 'toc.xhtml'), 'wb').write(tochtml)
+    files.write('svg/toc.xhtml', tochtml)
 
 
     # now create index_svg.xhtml that points to all required files
@@ -586,42 +640,27 @@ def generateBook(bookDir, raw, fixedimage):
     idlst = sorted(pageIDMap.keys())
     numids = len(idlst)
     cnt = len(idlst)
-    previd = None
     for j in range(cnt):
         pageid = idlst[j]
-        if j < cnt - 1:
-            nextid = idlst[j+1]
-        else:
-            nextid = None
         print '.',
-        pagelst = pageIDMap[pageid]
-        flst = []
-        for page in pagelst:
-            flst.append(xmllst[page])
-        flat_svg = "".join(flst)
-        flst=None
-        svgxml = flatxml2svg.convert2SVG(gd, flat_svg, pageid, previd, nextid, svgDir, raw, meta_array, scaledpi)
+        svgxml = svglst[j]
         if (raw) :
-            pfile = open(os.path.join(svgDir,'page%04d.svg' % pageid),'w')
+            files.write('svg/page%04d.svg' % pageid, svgxml)
             slst.append('<a href="svg/page%04d.svg">Page %d</a>\n' % (pageid, pageid))
         else :
-            pfile = open(os.path.join(svgDir,'page%04d.xhtml' % pageid), 'w')
+            files.write('svg/page%04d.xhtml' % pageid, svgxml)
             slst.append('<a href="svg/page%04d.xhtml">Page %d</a>\n' % (pageid, pageid))
-        previd = pageid
-        pfile.write(svgxml)
-        pfile.close()
         counter += 1
     slst.append('</div>\n')
     slst.append('<h2><a href="svg/toc.xhtml">Table of Contents</a></h2>\n')
     slst.append('</body>\n</html>\n')
     svgindex = "".join(slst)
     slst = None
-    file(os.path.join(bookDir, 'index_svg.xhtml'), 'wb').write(svgindex)
+    files.write('index_svg.xhtml', svgindex)
 
     print " "
 
     # build the opf file
-    opfname = os.path.join(bookDir, 'book.opf')
     olst = []
     olst.append('<?xml version="1.0" encoding="utf-8"?>\n')
     olst.append('<package xmlns="http://www.idpf.org/2007/opf" unique-identifier="guid_id">\n')
@@ -644,8 +683,7 @@ def generateBook(bookDir, raw, fixedimage):
     olst.append('   <item id="book" href="book.html" media-type="application/xhtml+xml"/>\n')
     olst.append('   <item id="stylesheet" href="style.css" media-type="text/css"/>\n')
     # adding image files to manifest
-    filenames = os.listdir(imgDir)
-    filenames = sorted(filenames)
+    filenames = files.listdir('img')
     for filename in filenames:
         imgname, imgext = os.path.splitext(filename)
         if imgext == '.jpg':
@@ -665,7 +703,7 @@ def generateBook(bookDir, raw, fixedimage):
     olst.append('</package>\n')
     opfstr = "".join(olst)
     olst = None
-    file(opfname, 'wb').write(opfstr)
+    files.write('book.opf', opfstr)
 
     print 'Processing Complete'
 
@@ -674,11 +712,14 @@ def generateBook(bookDir, raw, fixedimage):
 def usage():
     print "genbook.py generates a book from the extract Topaz Files"
     print "Usage:"
-    print "    genbook.py [-r] [-h [--fixed-image] <bookDir>  "
+    print "    genbook.py [-r] [-h] [-j <workers>] [--fixed-image] [--glyph-atlas] <bookDir>  "
     print "  "
     print "Options:"
     print "  -h            :  help - print this usage message"
     print "  -r            :  generate raw svg files (not wrapped in xhtml)"
+    print "  -j <workers>  :  render pages in parallel with this many processes"
+    print "  --glyph-atlas :  refer to the glyphs in glyphs.svg instead of copying them"
+    print "                   into every svg page, and keep identical images only once"
     print "  --fixed-image :  genearate any Fixed Area as an svg image in the html"
     print "  "
 
@@ -689,7 +730,7 @@ def main(argv):
         argv = sys.argv
 
     try:
-        opts, args = getopt.getopt(argv[1:], "rh:",["fixed-image"])
+        opts, args = getopt.getopt(argv[1:], "rhj:",["fixed-image", "glyph-atlas"])
 
     except getopt.GetoptError, err:
         print str(err)
@@ -702,18 +743,24 @@ def main(argv):
 
     raw = 0
     fixedimage = True
+    workers = 0
+    glyphatlas = False
     for o, a in opts:
         if o =="-h":
             usage()
             return 0
         if o =="-r":
             raw = 1
+        if o =="-j":
+            workers = int(a)
         if o =="--fixed-image":
             fixedimage = True
+        if o =="--glyph-atlas":
+            glyphatlas = True
 
     bookDir = args[0]
 
-    rv = generateBook(bookDir, raw, fixedimage)
+    rv = generateBook(bookDir, raw, fixedimage, None, workers, glyphatlas)
     return rv
 
 
@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import with_statement
+
+# instrument.py
+# Copyright © 2018 Apprentice Harper et al.
+
+__license__ = 'GPL v3'
+__version__ = '1.0'
+
+"""
+Stage timings and counters for the decryption of a book.
+
+The calibre plugin and the DeDRM application open a book with
+recorder.begin(), wrap each stage of the work (zip repair, key lookup,
+each key attempt, decrypt, recompress, write) in recorder.span(), count
+bytes and key attempts with recorder.count(), and close the book with
+recorder.end(), which adds a summary of all stages and counters.
+
+Nothing is recorded until a sink is added.  configure() adds the sinks
+named in the DEDRM_INSTRUMENT environment variable, a comma separated
+list of
+
+    jsonl:<path>   append one JSON object per event to a file
+    log            send the events to the 'dedrm' logger
+    memory         keep the events in recorder.sinks[i].events
+
+No key material is ever recorded, only the names of the keys tried.
+"""
+
+import json
+import logging
+import os
+import time
+
+
+ENVIRONMENT_VARIABLE = 'DEDRM_INSTRUMENT'
+
+
+class JSONLinesSink(object):
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'ab')
+
+    def emit(self, event):
+        self.file.write(json.dumps(event, sort_keys=True) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class LoggingSink(object):
+    def __init__(self, logger='dedrm', level=logging.INFO):
+        if not isinstance(logger, logging.Logger):
+            logger = logging.getLogger(logger)
+        self.logger = logger
+        self.level = level
+
+    def emit(self, event):
+        self.logger.log(self.level, u"%s %s", event['event'], json.dumps(event, sort_keys=True))
+
+    def close(self):
+        pass
+
+
+class MemorySink(object):
+    def __init__(self):
+        self.events = []
+
+    def emit(self, event):
+        self.events.append(event)
+
+    def spans(self, name=None):
+        return [event for event in self.events
+                if event['event'] == 'span' and (name is None or event['name'] == name)]
+
+    def close(self):
+        pass
+
+
+# Stands in for a span when nothing is recording, so that instrumented
+# code costs next to nothing by default.
+class NullSpan(object):
+    nbytes = None
+    ok = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+    def __setattr__(self, name, value):
+        pass
+
+NULL_SPAN = NullSpan()
+
+
+class Span(object):
+    def __init__(self, recorder, name, fields):
+        self.recorder = recorder
+        self.name = name
+        self.fields = fields
+        self.nbytes = None
+        # set when an exception is not how the stage reports failure
+        self.ok = None
+
+    def __enter__(self):
+        self.parent = self.recorder.stack[-1].name if self.recorder.stack else None
+        self.depth = len(self.recorder.stack)
+        self.recorder.stack.append(self)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        seconds = time.time() - self.start
+        self.recorder.stack.pop()
+        ok = self.ok if self.ok is not None else exc_type is None
+        self.recorder.addspan(self.name, self.start, seconds, ok, self.nbytes,
+                              self.parent, self.depth, self.fields)
+        return False
+
+
+class Recorder(object):
+    def __init__(self):
+        self.sinks = []
+        self.spec = None
+        self.stack = []
+        self.book = None
+        self.starttime = None
+        self.stages = {}
+        self.counters = {}
+
+    @property
+    def enabled(self):
+        return len(self.sinks) > 0
+
+    def addsink(self, sink):
+        self.sinks.append(sink)
+        return sink
+
+    def removesink(self, sink):
+        self.sinks.remove(sink)
+        sink.close()
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+        self.sinks = []
+        self.spec = None
+
+    def emit(self, event):
+        for sink in self.sinks:
+            try:
+                sink.emit(event)
+            except Exception, e:
+                # a broken sink must never stop a book being decrypted
+                print u"Instrumentation: cannot write event: {0}".format(e)
+
+    def begin(self, path, **fields):
+        self.book = os.path.basename(path)
+        self.starttime = time.time()
+        self.stack = []
+        self.stages = {}
+        self.counters = {}
+        if self.enabled:
+            try:
+                self.count('bytes in', os.path.getsize(path))
+            except OSError:
+                pass
+            event = {'event': 'begin', 'book': self.book, 'time': self.starttime}
+            event.update(fields)
+            self.emit(event)
+
+    def end(self, ok=True, **fields):
+        if self.enabled and self.starttime is not None:
+            event = {'event': 'end', 'book': self.book, 'ok': ok,
+                     'seconds': time.time() - self.starttime,
+                     'stages': self.stages, 'counters': self.counters}
+            event.update(fields)
+            self.emit(event)
+        self.book = None
+        self.starttime = None
+
+    def span(self, name, **fields):
+        # with recorder.span('write') as span: ...; span.nbytes = size
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, fields)
+
+    def addspan(self, name, start, seconds, ok=True, nbytes=None, parent=None, depth=None,
+                fields=None, calls=1):
+        # Records a finished stage.  Stages that run once per file inside
+        # an engine are timed there and added up as one span of several calls.
+        if not self.enabled:
+            return
+        if depth is None:
+            parent = self.stack[-1].name if self.stack else None
+            depth = len(self.stack)
+        stage = self.stages.setdefault(name, {'calls': 0, 'seconds': 0.0, 'bytes': 0})
+        stage['calls'] += calls
+        stage['seconds'] += seconds
+        event = {'event': 'span', 'book': self.book, 'name': name, 'parent': parent, 'depth': depth,
+                 'start': start - self.starttime if self.starttime is not None else 0.0,
+                 'seconds': seconds, 'ok': ok}
+        if calls != 1:
+            event['calls'] = calls
+        if nbytes is not None:
+            stage['bytes'] += nbytes
+            event['bytes'] = nbytes
+        if fields:
+            event.update(fields)
+        self.emit(event)
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def countfile(self, name, path):
+        # count the size of a file written, such as 'bytes out'
+        if self.enabled and os.path.isfile(path):
+            self.count(name, os.path.getsize(path))
+
+
+def makesink(spec):
+    kind, sep, arg = spec.strip().partition(':')
+    if kind == 'jsonl' and arg:
+        return JSONLinesSink(arg)
+    if kind == 'log':
+        return LoggingSink(arg or 'dedrm')
+    if kind == 'memory':
+        return MemorySink()
+    raise ValueError(u"Unknown instrumentation sink {0}".format(spec))
+
+
+def configure(spec=None):
+    # Sets the sinks of the recorder from spec, or from the environment.
+    # Calling it again with the same spec keeps the sinks already open.
+    if spec is None:
+        spec = os.environ.get(ENVIRONMENT_VARIABLE, '')
+    if spec == recorder.spec:
+        return recorder
+    recorder.close()
+    for part in spec.split(','):
+        if part.strip():
+            try:
+                recorder.addsink(makesink(part))
+            except Exception, e:
+                print u"Instrumentation: cannot use {0}: {1}".format(part, e)
+    recorder.spec = spec
+    return recorder
+
+
+recorder = Recorder()
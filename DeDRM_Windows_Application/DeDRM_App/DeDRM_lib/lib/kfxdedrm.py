@@ -5,70 +5,199 @@ from __future__ import with_statement
 
 # Engine to remove drm from Kindle KFX ebooks
 
+import copy
 import os
 import shutil
+import struct
 import zipfile
-
-try:
-    from cStringIO import StringIO
-except ImportError:
-    from StringIO import StringIO
+import zlib
+from cStringIO import StringIO
 
 try:
     from calibre_plugins.dedrm import ion
+    from calibre_plugins.dedrm import instrument
 except ImportError:
     import ion
+    import instrument
 
 
 __license__ = 'GPL v3'
-__version__ = '1.0'
+__version__ = '1.1'
+
+
+# size of the chunks unchanged zip entries are copied in
+COPY_CHUNK = 0x10000
+
+
+# the extra field of a zip entry without its zip64 record, which
+# FileHeader adds again when the sizes need it
+def stripZip64Extra(extra):
+    result = []
+    pos = 0
+    while pos + 4 <= len(extra):
+        tp, ln = struct.unpack('<HH', extra[pos:pos+4])
+        if tp != 1:
+            result.append(extra[pos:pos+4+ln])
+        pos += 4 + ln
+    return ''.join(result)
+
+
+# A file-like writer for one entry of a zip being written, so a decrypted
+# DRMION file can go straight into the output archive a page at a time.
+# Like ZipFile.write, it writes the local header first and patches the
+# CRC and sizes in once the entry is complete, so it also has to guess
+# from the input size whether the header needs room for zip64 sizes.
+# close() raises LargeZipFile when the guess was wrong.
+class ZipEntryWriter(object):
+    def __init__(self, zof, info):
+        zinfo = copy.copy(info)
+        zinfo.flag_bits &= ~0x08    # sizes go in the local header, no data descriptor
+        zinfo.extra = stripZip64Extra(zinfo.extra)
+        zinfo.CRC = 0
+        zinfo.compress_size = 0
+        zinfo.file_size = 0
+        zinfo.header_offset = zof.fp.tell()
+        self.zip64 = zof._allowZip64 and info.file_size * 1.05 > zipfile.ZIP64_LIMIT
+        zof._writecheck(zinfo)
+        zof._didModify = True
+        zof.fp.write(zinfo.FileHeader(self.zip64))
+        if zinfo.compress_type == zipfile.ZIP_DEFLATED:
+            self.cmpr = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        else:
+            self.cmpr = None
+        self.zof = zof
+        self.zinfo = zinfo
+
+    def write(self, data):
+        zinfo = self.zinfo
+        zinfo.file_size += len(data)
+        zinfo.CRC = zlib.crc32(data, zinfo.CRC) & 0xffffffff
+        if self.cmpr is not None:
+            data = self.cmpr.compress(data)
+        zinfo.compress_size += len(data)
+        self.zof.fp.write(data)
+
+    def close(self):
+        zof = self.zof
+        zinfo = self.zinfo
+        if self.cmpr is not None:
+            data = self.cmpr.flush()
+            zinfo.compress_size += len(data)
+            zof.fp.write(data)
+        if not self.zip64 and (zinfo.file_size > zipfile.ZIP64_LIMIT or
+                               zinfo.compress_size > zipfile.ZIP64_LIMIT):
+            raise zipfile.LargeZipFile(u'{0} is too large for its zip header'.format(zinfo.filename))
+        position = zof.fp.tell()
+        zof.fp.seek(zinfo.header_offset, 0)
+        zof.fp.write(zinfo.FileHeader(self.zip64))
+        zof.fp.seek(position, 0)
+        zof.filelist.append(zinfo)
+        zof.NameToInfo[zinfo.filename] = zinfo
+
+
+# copies an entry of zif to zof as it is stored, without decompressing it
+def copyZipEntry(zif, zof, info):
+    zif.fp.seek(info.header_offset, 0)
+    header = zif.fp.read(zipfile.sizeFileHeader)
+    fheader = struct.unpack(zipfile.structFileHeader, header)
+    zif.fp.seek(fheader[zipfile._FH_FILENAME_LENGTH] + fheader[zipfile._FH_EXTRA_FIELD_LENGTH], 1)
+
+    zinfo = copy.copy(info)
+    zinfo.flag_bits &= ~0x08
+    zinfo.extra = stripZip64Extra(zinfo.extra)
+    zinfo.header_offset = zof.fp.tell()
+    zof._writecheck(zinfo)
+    zof._didModify = True
+    zof.fp.write(zinfo.FileHeader())
+    remaining = info.compress_size
+    while remaining > 0:
+        data = zif.fp.read(min(remaining, COPY_CHUNK))
+        if not data:
+            raise zipfile.BadZipfile(u'Truncated entry {0}'.format(info.filename))
+        zof.fp.write(data)
+        remaining -= len(data)
+    zof.filelist.append(zinfo)
+    zof.NameToInfo[zinfo.filename] = zinfo
+
+
+# kinds of the members of a .kfx-zip archive
+MEMBER_DRMION = 'drmion'
+MEMBER_VOUCHER = 'voucher'
+MEMBER_OTHER = 'other'
+
+# bytes read from the start of each member to tell its kind: a voucher is
+# an ION file that imports the ProtectedData symbol table right after the
+# version marker
+MEMBER_PEEK = 256
 
 
 class KFXZipBook:
     def __init__(self, infile):
         self.infile = infile
         self.voucher = None
-        self.decrypted = {}
+        self.members = None
+        self.voucherfile = None
+        self.drmionfiles = set()
+        self.workers = 0
 
     def getPIDMetaInfo(self):
         return (None, None)
 
-    def processBook(self, totalpids):
+    # the DRMION files are only found here; getFile decrypts them straight
+    # into the output archive, one page at a time. With workers > 0 the
+    # pages of each are decrypted and decompressed by that many processes
+    def processBook(self, totalpids, workers=0):
+        self.workers = workers
         with zipfile.ZipFile(self.infile, 'r') as zf:
-            for filename in zf.namelist():
-                data = zf.read(filename)
-                if data.startswith('\xeaDRMION\xee'):
-                    if self.voucher is None:
-                        self.decrypt_voucher(totalpids)
-                    print u'Decrypting KFX DRMION: {0}'.format(filename)
-                    outfile = StringIO()
-                    ion.DrmIon(StringIO(data[8:-8]), lambda name: self.voucher).parse(outfile)
-                    self.decrypted[filename] = outfile.getvalue()
-
-        if not self.decrypted:
+            self.scanMembers(zf)
+            if self.drmionfiles and self.voucher is None:
+                self.decrypt_voucher(totalpids, zf)
+
+        if not self.drmionfiles:
             print(u'The .kfx-zip archive does not contain an encrypted DRMION file')
 
-    def decrypt_voucher(self, totalpids):
-        with zipfile.ZipFile(self.infile, 'r') as zf:
-            for info in zf.infolist():
-                if info.file_size < 0x10000:
-                    data = zf.read(info.filename)
-                    if data.startswith('\xe0\x01\x00\xea') and 'ProtectedData' in data:
-                        break   # found DRM voucher
+    # classifies every member of zf by its first bytes, once per book
+    def scanMembers(self, zf):
+        if self.members is not None:
+            return self.members
+
+        members = {}
+        for info in zf.infolist():
+            with zf.open(info) as fh:
+                data = fh.read(MEMBER_PEEK)
+            if data[:8] == '\xeaDRMION\xee':
+                members[info.filename] = MEMBER_DRMION
+                self.drmionfiles.add(info.filename)
+            elif data[:4] == '\xe0\x01\x00\xea' and 'ProtectedData' in data:
+                members[info.filename] = MEMBER_VOUCHER
+                if self.voucherfile is None:
+                    self.voucherfile = info.filename
             else:
-                raise Exception(u'The .kfx-zip archive contains an encrypted DRMION file without a DRM voucher')
+                members[info.filename] = MEMBER_OTHER
+        self.members = members
+        return members
+
+    def decrypt_voucher(self, totalpids, zf):
+        if self.voucherfile is None:
+            raise Exception(u'The .kfx-zip archive contains an encrypted DRMION file without a DRM voucher')
 
-        print u'Decrypting KFX DRM voucher: {0}'.format(info.filename)
+        data = zf.read(self.voucherfile)
+        print u'Decrypting KFX DRM voucher: {0}'.format(self.voucherfile)
 
+        candidates = []
         for pid in [''] + totalpids:
             for dsn_len,secret_len in [(0,0), (16,0), (16,40), (32,40), (40,40)]:
                 if len(pid) == dsn_len + secret_len:
                     break       # split pid into DSN and account secret
             else:
                 continue
+            candidates.append((pid[:dsn_len], pid[dsn_len:]))
 
+        # the DSN and secret that opened the last voucher likely open this one
+        for dsn, secret in ion.voucherkeys.ordercandidates(candidates):
+            instrument.recorder.count('key attempts')
             try:
-                voucher = ion.DrmIonVoucher(StringIO(data), pid[:dsn_len], pid[dsn_len:])
+                voucher = ion.DrmIonVoucher(data, dsn, secret)
                 voucher.parse()
                 voucher.decryptvoucher()
                 break
@@ -98,11 +227,41 @@ class KFXZipBook:
     def cleanup(self):
         pass
 
+    # the pages are only decrypted here, so a wrong key may not show up
+    # until now; a part written archive is removed before raising
     def getFile(self, outpath):
-        if not self.decrypted:
+        if not self.drmionfiles:
             shutil.copyfile(self.infile, outpath)
-        else:
+            return
+
+        try:
             with zipfile.ZipFile(self.infile, 'r') as zif:
-                with zipfile.ZipFile(outpath, 'w') as zof:
+                with zipfile.ZipFile(outpath, 'w', allowZip64=True) as zof:
                     for info in zif.infolist():
-                        zof.writestr(info, self.decrypted.get(info.filename, zif.read(info.filename)))
+                        if info.filename in self.drmionfiles:
+                            self.decryptFile(zif, zof, info)
+                        else:
+                            copyZipEntry(zif, zof, info)
+        except:
+            if os.path.exists(outpath):
+                os.remove(outpath)
+            raise
+
+    # decrypts the DRMION file of info into the same entry of zof. The
+    # DRMION file itself is read whole, as the parser works on one buffer
+    def decryptFile(self, zif, zof, info):
+        print u'Decrypting KFX DRMION: {0}'.format(info.filename)
+        data = memoryview(zif.read(info.filename))[8:-8]
+        outfile = ZipEntryWriter(zof, info)
+        ion.DrmIon(data, lambda name: self.voucher, self.workers).parse(outfile)
+        try:
+            outfile.close()
+        except zipfile.LargeZipFile:
+            # it grew past the zip64 limit, so write the entry again in one go
+            zof.fp.seek(outfile.zinfo.header_offset, 0)
+            zof.fp.truncate()
+            outfile = StringIO()
+            ion.DrmIon(data, lambda name: self.voucher, self.workers).parse(outfile)
+            zinfo = copy.copy(info)
+            zinfo.extra = stripZip64Extra(zinfo.extra)
+            zof.writestr(zinfo, outfile.getvalue())
@@ -12,6 +12,7 @@ import zipfix
 import ineptpdf
 import erdr2pml
 import k4mobidedrm
+import instrument
 import traceback
 
 def decryptepub(infile, outdir, rscpath):
@@ -21,7 +22,8 @@ def decryptepub(infile, outdir, rscpath):
     name, ext = os.path.splitext(os.path.basename(infile))
     bpath = os.path.dirname(infile)
     zippath = os.path.join(bpath,name + '_temp.zip')
-    rv = zipfix.repairBook(infile, zippath)
+    with instrument.recorder.span('zip repair'):
+        rv = zipfix.repairBook(infile, zippath)
     if rv != 0:
         print "Error while trying to fix epub"
         return rv
@@ -40,15 +42,18 @@ def decryptepub(infile, outdir, rscpath):
             for filename in files:
                 keypath = os.path.join(rscpath, filename)
                 userkey = open(keypath,'rb').read()
-                try:
-                    rv = ineptepub.decryptBook(userkey, zippath, outfile)
-                    if rv == 0:
-                        print "Decrypted Adobe ePub with key file {0}".format(filename)
-                        break
-                except Exception, e:
-                    errlog += traceback.format_exc()
-                    errlog += str(e)
-                    rv = 1
+                instrument.recorder.count('key attempts')
+                with instrument.recorder.span('key attempt', key=filename) as span:
+                    try:
+                        rv = ineptepub.decryptBook(userkey, zippath, outfile)
+                    except Exception, e:
+                        errlog += traceback.format_exc()
+                        errlog += str(e)
+                        rv = 1
+                    span.ok = rv == 0
+                if rv == 0:
+                    print "Decrypted Adobe ePub with key file {0}".format(filename)
+                    break
     # now try with ignoble epub
     elif  ignobleepub.ignobleBook(zippath):
         # try with any keyfiles (*.b64) in the rscpath
@@ -60,15 +65,18 @@ def decryptepub(infile, outdir, rscpath):
                 keypath = os.path.join(rscpath, filename)
                 userkey = open(keypath,'r').read()
                 #print userkey
-                try:
-                    rv = ignobleepub.decryptBook(userkey, zippath, outfile)
-                    if rv == 0:
-                        print "Decrypted B&N ePub with key file {0}".format(filename)
-                        break
-                except Exception, e:
-                    errlog += traceback.format_exc()
-                    errlog += str(e)
-                    rv = 1
+                instrument.recorder.count('key attempts')
+                with instrument.recorder.span('key attempt', key=filename) as span:
+                    try:
+                        rv = ignobleepub.decryptBook(userkey, zippath, outfile)
+                    except Exception, e:
+                        errlog += traceback.format_exc()
+                        errlog += str(e)
+                        rv = 1
+                    span.ok = rv == 0
+                if rv == 0:
+                    print "Decrypted B&N ePub with key file {0}".format(filename)
+                    break
     else:
         encryption = epubtest.encryption(zippath)
         if encryption == "Unencrypted":
@@ -80,6 +88,8 @@ def decryptepub(infile, outdir, rscpath):
     os.remove(zippath)
     if rv != 0:
         print errlog
+    else:
+        instrument.recorder.countfile('bytes out', outfile)
     return rv
 
 
@@ -99,17 +109,22 @@ def decryptpdf(infile, outdir, rscpath):
         for filename in files:
             keypath = os.path.join(rscpath, filename)
             userkey = open(keypath,'rb').read()
-            try:
-                rv = ineptpdf.decryptBook(userkey, infile, outfile)
-                if rv == 0:
-                    break
-            except Exception, e:
-                errlog += traceback.format_exc()
-                errlog += str(e)
-                rv = 1
+            instrument.recorder.count('key attempts')
+            with instrument.recorder.span('key attempt', key=filename) as span:
+                try:
+                    rv = ineptpdf.decryptBook(userkey, infile, outfile)
+                except Exception, e:
+                    errlog += traceback.format_exc()
+                    errlog += str(e)
+                    rv = 1
+                span.ok = rv == 0
+            if rv == 0:
+                break
 
     if rv != 0:
         print errlog
+    else:
+        instrument.recorder.countfile('bytes out', outfile)
     return rv
 
 
@@ -122,20 +137,25 @@ def decryptpdb(infile, outdir, rscpath):
         keydata = file(socialpath,'r').read()
         keydata = keydata.rstrip(os.linesep)
         ar = keydata.split(',')
-        for i in ar:
+        for n, i in enumerate(ar, 1):
             try:
                 name, cc8 = i.split(':')
             except ValueError:
                 print '   Error parsing user supplied social drm data.'
                 return 1
-            try:
-                rv = erdr2pml.decryptBook(infile, outpath, True, erdr2pml.getuser_key(name, cc8))
-            except Exception, e:
-                errlog += traceback.format_exc()
-                errlog += str(e)
-                rv = 1
+            instrument.recorder.count('key attempts')
+            # the name is half of the key, so record only which entry was tried
+            with instrument.recorder.span('key attempt', key=u"sdrmlist.txt #{0:d}".format(n)) as span:
+                try:
+                    rv = erdr2pml.decryptBook(infile, outpath, True, erdr2pml.getuser_key(name, cc8))
+                except Exception, e:
+                    errlog += traceback.format_exc()
+                    errlog += str(e)
+                    rv = 1
+                span.ok = rv == 0
 
             if rv == 0:
+                instrument.recorder.countfile('bytes out', outpath)
                 break
     return rv
 
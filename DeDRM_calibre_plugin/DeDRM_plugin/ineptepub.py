@@ -43,16 +43,18 @@ from __future__ import with_statement
 #   6.4 - Remove erroneous check on DER file sanity
 #   6.5 - Completely remove erroneous check on DER file sanity
 #   6.6 - Import tkFileDialog, don't assume something else will import it.
+#   6.7 - Record decrypt and recompress times for instrument.py
 
 """
 Decrypt Adobe Digital Editions encrypted ePub books.
 """
 
 __license__ = 'GPL v3'
-__version__ = "6.6"
+__version__ = "6.7"
 
 import sys
 import os
+import time
 import traceback
 import zlib
 import zipfile
@@ -60,6 +62,11 @@ from zipfile import ZipInfo, ZipFile, ZIP_STORED, ZIP_DEFLATED
 from contextlib import closing
 import xml.etree.ElementTree as etree
 
+try:
+    from calibre_plugins.dedrm import instrument
+except ImportError:
+    import instrument
+
 # Wrap a stream so that output gets flushed immediately
 # and also make sure that any unicode strings get
 # encoded using "replace" before writing them.
@@ -442,6 +449,10 @@ def decryptBook(userkey, inpath, outpath):
                 except:
                     pass
                 outf.writestr(zi, inf.read('mimetype'))
+                # decrypt and recompress are timed per file and recorded once
+                started = time.time()
+                decrypttime = recompresstime = 0.0
+                nbytes = 0
                 for path in namelist:
                     data = inf.read(path)
                     zi = ZipInfo(path)
@@ -459,7 +470,15 @@ def decryptBook(userkey, inpath, outpath):
                         zi.create_system = oldzi.create_system
                     except:
                         pass
-                    outf.writestr(zi, decryptor.decrypt(path, data))
+                    start = time.time()
+                    data = decryptor.decrypt(path, data)
+                    decrypted = time.time()
+                    outf.writestr(zi, data)
+                    decrypttime += decrypted - start
+                    recompresstime += time.time() - decrypted
+                    nbytes += len(data)
+                instrument.recorder.addspan('decrypt', started, decrypttime, nbytes=nbytes, calls=len(namelist))
+                instrument.recorder.addspan('recompress', started, recompresstime, nbytes=nbytes, calls=len(namelist))
         except:
             print u"Could not decrypt {0:s} because of an exception:\n{1:s}".format(os.path.basename(inpath), traceback.format_exc())
             return 2
@@ -59,6 +59,14 @@ from __future__ import with_statement
 #   8.0.4 - Completely remove erroneous check on DER file sanity
 #   8.0.5 - Do not process DRM-free documents
 #   8.0.6 - Replace use of float by Decimal for greater precision, and import tkFileDialog
+#   8.0.7 - Decrypt stream data incrementally when writing the output file
+#   8.0.8 - Cache per-object keys and RC4 key schedules
+#   8.0.9 - Optionally decrypt objects in several worker processes
+#   8.0.10 - Support all PNG predictors and TIFF predictor 2, in linear time
+#   8.0.11 - Add the missing LZW decoder and speed up ASCII85 decoding
+#   8.0.12 - Optionally pack small objects into compressed object streams on output
+#   8.0.13 - Optionally keep the parsed xref table in a sidecar index file
+#   8.0.14 - Rebuild broken xref tables with a single scan of the whole file
 
 
 """
@@ -66,7 +74,7 @@ Decrypts Adobe ADEPT-encrypted PDF files.
 """
 
 __license__ = 'GPL v3'
-__version__ = "8.0.6"
+__version__ = "8.0.14"
 
 import sys
 import os
@@ -74,10 +82,19 @@ import re
 import zlib
 import struct
 import hashlib
+import getopt
+import mmap
+import time
+from array import array
 from decimal import *
-from itertools import chain, islice
+from itertools import chain, islice, izip
 import xml.etree.ElementTree as etree
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 # Wrap a stream so that output gets flushed immediately
 # and also make sure that any unicode strings get
 # encoded using "replace" before writing them.
@@ -232,6 +249,12 @@ def _load_crypto_libcrypto():
         def __init__(self):
             self._blocksize = 0
             self._key = None
+        def copy(self):
+            # clone the key schedule, so it need not be set up again
+            other = ARC4()
+            other._blocksize = self._blocksize
+            other._key = RC4_KEY.from_buffer_copy(self._key)
+            return other
         def decrypt(self, data):
             out = create_string_buffer(len(data))
             RC4_crypt(self._key, len(data), data, out)
@@ -249,7 +272,9 @@ def _load_crypto_libcrypto():
                 raise ADEPTError('AES improper key used')
                 return
             keyctx = self._keyctx = AES_KEY()
-            self._iv = iv
+            # AES_cbc_encrypt updates the iv in place, so successive
+            # calls to decrypt() continue the same CBC chain
+            self._iv = create_string_buffer(iv, 16)
             rv = AES_set_decrypt_key(userkey, len(userkey) * 8, keyctx)
             if rv < 0:
                 raise ADEPTError('Failed to initialize AES key')
@@ -434,6 +459,18 @@ GEN_XREF_STM = 1
 # This is the value for the current document
 gen_xref_stm = False # will be set in PDFSerializer
 
+# Do we pack small objects into compressed object streams on output?
+# 0 = never
+# 1-9 = yes, with this zlib compression level for the object streams
+#       and the (then always generated) cross reference stream
+
+PACK_OBJ_STM = 0
+
+# Objects serialized to more than this many bytes are written normally
+PACK_MAX_SIZE = 4096
+# Number of objects per generated object stream
+PACK_OBJS_PER_STM = 200
+
 # PDF parsing routines from pdfminer, with changes for EBX_HANDLER
 
 #  Utilities
@@ -1114,31 +1151,188 @@ def stream_value(x):
     return x
 
 # ascii85decode(data)
+# Anything other than the encoding characters (i.e. whitespace) is
+# ignored and decoding stops at the first '~'.  Whole groups are
+# converted in one pass through an array, not one struct.pack at a time.
+A85_IGNORED = ''.join(chr(c) for c in xrange(256)
+                      if not (33 <= c <= 117 or chr(c) == 'z'))
+A85_OFFSET = 33 * (85**4 + 85**3 + 85**2 + 85 + 1)
+
 def ascii85decode(data):
-    n = b = 0
-    out = ''
+    end = data.find('~')
+    if end >= 0:
+        data = data[:end]
+    data = bytearray(data.translate(None, A85_IGNORED).replace('z', '!!!!!'))
+    n = len(data) - len(data) % 5
+    out = array('I', [((((data[i]*85 + data[i+1])*85 + data[i+2])*85
+                        + data[i+3])*85 + data[i+4]) - A85_OFFSET
+                      for i in xrange(0, n, 5)])
+    if sys.byteorder == 'little':
+        out.byteswap()
+    out = out.tostring()
+    if n < len(data) and end >= 0:
+        # partial final group, padded with 'u'
+        b = 0
+        for c in data[n:]:
+            b = b*85 + (c-33)
+        for _ in range(5-(len(data)-n)):
+            b = b*85+84
+        out += struct.pack('>L',b)[:len(data)-n-1]
+    return out
+
+
+# lzwdecode(data)
+# Codes are read from an integer bit buffer a byte at a time,
+# starting at 9 bits and widening (one code early, by default)
+# as the string table grows, up to 12 bits.
+LZW_CLEAR = 256
+LZW_EOD = 257
+
+def lzwdecode(data, earlychange=1):
+    data = bytearray(data)
+    out = bytearray()
+    initial = [chr(c) for c in xrange(256)] + [None, None]
+    table = initial[:]
+    width = 9
+    prev = None
+    bitbuf = nbits = 0
     for c in data:
-        if '!' <= c and c <= 'u':
-            n += 1
-            b = b*85+(ord(c)-33)
-            if n == 5:
-                out += struct.pack('>L',b)
-                n = b = 0
-        elif c == 'z':
-            assert n == 0
-            out += '\0\0\0\0'
-        elif c == '~':
-            if n:
-                for _ in range(5-n):
-                    b = b*85+84
-                out += struct.pack('>L',b)[:n-1]
+        bitbuf = (bitbuf << 8) | c
+        nbits += 8
+        if nbits < width:
+            continue
+        nbits -= width
+        code = bitbuf >> nbits
+        bitbuf &= (1 << nbits) - 1
+        if code == LZW_CLEAR:
+            table = initial[:]
+            width = 9
+            prev = None
+            continue
+        if code == LZW_EOD:
             break
-    return out
+        if prev is None:
+            entry = table[code]
+        else:
+            if code < len(table):
+                entry = table[code]
+                table.append(prev + entry[0])
+            elif code == len(table):
+                entry = prev + prev[0]
+                table.append(entry)
+            else:
+                raise PDFValueError('Invalid LZW code: %d' % code)
+            if width < 12 and len(table) + earlychange >= (1 << width):
+                width += 1
+        out += entry
+        prev = entry
+    return str(out)
+
+
+# Predictors (used for image data and xref streams)
+# Each row of PNG predicted data starts with a byte giving the filter
+# used for that row.  Rows are decoded in place in bytearrays, or with
+# numpy, where available, a run of rows at a time.
+
+def _png_unfilter_row(ft, row, prev, bpp):
+    n = len(row)
+    if ft == 0:
+        # None
+        pass
+    elif ft == 1:
+        # Sub
+        for j in xrange(bpp, n):
+            row[j] = (row[j] + row[j-bpp]) & 255
+    elif ft == 2:
+        # Up
+        row[:] = bytearray([(a + b) & 255 for (a, b) in izip(row, prev)])
+    elif ft == 3:
+        # Average
+        for j in xrange(n):
+            left = row[j-bpp] if j >= bpp else 0
+            row[j] = (row[j] + ((left + prev[j]) >> 1)) & 255
+    elif ft == 4:
+        # Paeth
+        for j in xrange(n):
+            if j >= bpp:
+                a = row[j-bpp]
+                c = prev[j-bpp]
+            else:
+                a = c = 0
+            b = prev[j]
+            p = a + b - c
+            pa = abs(p - a)
+            pb = abs(p - b)
+            pc = abs(p - c)
+            if pa <= pb and pa <= pc:
+                pr = a
+            elif pb <= pc:
+                pr = b
+            else:
+                pr = c
+            row[j] = (row[j] + pr) & 255
+    else:
+        raise PDFValueError('Invalid PNG predictor row type: %r' % ft)
+    return
+
+def _png_unpredict_numpy(data, bpp, rowlen):
+    rows = numpy.frombuffer(data, numpy.uint8).reshape(-1, rowlen + 1)
+    types = rows[:, 0]
+    out = rows[:, 1:].copy()
+    nrows = len(out)
+    prev = numpy.zeros(rowlen, numpy.uint8)
+    # runs of rows with the same filter type
+    bounds = [0] + list(numpy.flatnonzero(numpy.diff(types)) + 1) + [nrows]
+    for (i, j) in izip(bounds, bounds[1:]):
+        ft = types[i]
+        block = out[i:j]
+        if ft == 1 and rowlen % bpp == 0:
+            block = block.reshape(j - i, -1, bpp)
+            block.cumsum(axis=1, dtype=numpy.uint8, out=block)
+        elif ft == 2:
+            # a run of Up rows is a running sum down the columns
+            block[0] += prev
+            block.cumsum(axis=0, dtype=numpy.uint8, out=block)
+        elif ft != 0:
+            prevrow = bytearray(prev.tostring())
+            for k in xrange(i, j):
+                row = bytearray(out[k].tostring())
+                _png_unfilter_row(ft, row, prevrow, bpp)
+                out[k] = numpy.frombuffer(row, numpy.uint8)
+                prevrow = row
+        prev = out[j-1]
+    return out.tostring()
+
+def png_unpredict(data, colors, bpc, columns):
+    bpp = max(1, colors * bpc // 8)
+    rowlen = (colors * bpc * columns + 7) // 8
+    if numpy is not None and data and len(data) % (rowlen + 1) == 0:
+        return _png_unpredict_numpy(data, bpp, rowlen)
+    data = bytearray(data)
+    out = bytearray()
+    prev = bytearray(rowlen)
+    for i in xrange(0, len(data), rowlen + 1):
+        row = data[i+1:i+1+rowlen]
+        _png_unfilter_row(data[i], row, prev, bpp)
+        out += row
+        prev = row
+    return str(out)
+
+def tiff_unpredict(data, colors, bpc, columns):
+    if bpc != 8:
+        raise PDFNotImplementedError(
+            'Unsupported bits per component for TIFF predictor: %r' % bpc)
+    rowlen = colors * columns
+    data = bytearray(data)
+    for i in xrange(0, len(data), rowlen):
+        for j in xrange(i + colors, min(i + rowlen, len(data))):
+            data[j] = (data[j] + data[j-colors]) & 255
+    return str(data)
 
 
 ##  PDFStream type
 class PDFStream(PDFObject):
-    def __init__(self, dic, rawdata, decipher=None):
+    def __init__(self, dic, rawdata, decipher=None, stream_decipher=None):
         length = int_value(dic.get('Length', 0))
         eol = rawdata[length:]
         # quick and dirty fix for false length attribute,
@@ -1154,6 +1348,7 @@ class PDFStream(PDFObject):
         self.dic = dic
         self.rawdata = rawdata
         self.decipher = decipher
+        self.stream_decipher = stream_decipher
         self.data = None
         self.decdata = None
         self.objid = None
@@ -1189,12 +1384,21 @@ class PDFStream(PDFObject):
         filters = self.dic['Filter']
         if not isinstance(filters, list):
             filters = [ filters ]
-        for f in filters:
+        for (i, f) in enumerate(filters):
+            if 'DP' in self.dic:
+                params = self.dic['DP']
+            else:
+                params = self.dic.get('DecodeParms', {})
+            if isinstance(params, list):
+                # one set of parameters per filter
+                params = params[i] if i < len(params) else {}
+            params = dict_value(params)
             if f in LITERALS_FLATE_DECODE:
                 # will get errors if the document is encrypted.
                 data = zlib.decompress(data)
             elif f in LITERALS_LZW_DECODE:
-                data = ''.join(LZWDecoder(StringIO(data)).run())
+                earlychange = int_value(params.get('EarlyChange', 1))
+                data = lzwdecode(data, earlychange)
             elif f in LITERALS_ASCII85_DECODE:
                 data = ascii85decode(data)
             elif f == LITERAL_CRYPT:
@@ -1202,31 +1406,19 @@ class PDFStream(PDFObject):
             else:
                 raise PDFNotImplementedError('Unsupported filter: %r' % f)
             # apply predictors
-            if 'DP' in self.dic:
-                params = self.dic['DP']
-            else:
-                params = self.dic.get('DecodeParms', {})
             if 'Predictor' in params:
                 pred = int_value(params['Predictor'])
-                if pred:
-                    if pred != 12:
+                if pred > 1:
+                    columns = int_value(params.get('Columns', 1))
+                    colors = int_value(params.get('Colors', 1))
+                    bpc = int_value(params.get('BitsPerComponent', 8))
+                    if pred == 2:
+                        data = tiff_unpredict(data, colors, bpc, columns)
+                    elif 10 <= pred <= 15:
+                        data = png_unpredict(data, colors, bpc, columns)
+                    else:
                         raise PDFNotImplementedError(
                             'Unsupported predictor: %r' % pred)
-                    if 'Columns' not in params:
-                        raise PDFValueError(
-                            'Columns undefined for predictor=12')
-                    columns = int_value(params['Columns'])
-                    buf = ''
-                    ent0 = '\x00' * columns
-                    for i in xrange(0, len(data), columns+1):
-                        pred = data[i]
-                        ent1 = data[i+1:i+1+columns]
-                        if pred == '\x02':
-                            ent1 = ''.join(chr((ord(a)+ord(b)) & 255) \
-                                               for (a,b) in zip(ent0,ent1))
-                        buf += ent1
-                        ent0 = ent1
-                    data = buf
         self.data = data
         self.rawdata = None
         return
@@ -1248,6 +1440,35 @@ class PDFStream(PDFObject):
             data = self.decipher(self.objid, self.genno, data)
         return data
 
+    def iter_decdata(self, bufsize=65536):
+        '''
+        Yields the decrypted data in chunks of about bufsize bytes,
+        without building the whole plaintext in memory.
+        '''
+        if self.decdata is not None:
+            yield self.decdata
+            return
+        data = self.rawdata
+        if data is None:
+            # already decoded, the data is all there is, and it must be
+            # written without the filters (see PDFSerializer.stream_dict)
+            if self.data:
+                yield self.data
+            return
+        if not data:
+            return
+        if not self.decipher:
+            yield data
+            return
+        if not self.stream_decipher:
+            yield self.decipher(self.objid, self.genno, data)
+            return
+        decipher = self.stream_decipher(self.objid, self.genno)
+        for i in xrange(0, len(data), bufsize):
+            yield decipher.update(data[i:i+bufsize])
+        yield decipher.finish()
+        return
+
 
 ##  PDF Exceptions
 ##
@@ -1396,6 +1617,185 @@ class PDFXRefStream(object):
         raise KeyError(objid)
 
 
+##  Stream deciphers
+##
+##  These decrypt the data of a single stream incrementally: ciphertext
+##  is fed in with update(), which returns as much plaintext as can be
+##  produced so far, and finish() returns the remainder once all the
+##  data has been fed.
+##
+class RC4StreamDecipher(object):
+
+    def __init__(self, cipher):
+        self.cipher = cipher
+        return
+
+    def update(self, data):
+        return self.cipher.decrypt(data)
+
+    def finish(self):
+        return ''
+
+
+class AESStreamDecipher(object):
+
+    def __init__(self, key):
+        self.key = key
+        self.cipher = None
+        self.pending = ''
+        return
+
+    def update(self, data):
+        if self.pending:
+            data = self.pending + data
+        if self.cipher is None:
+            # the first block is the initialization vector
+            if len(data) < 16:
+                self.pending = data
+                return ''
+            self.cipher = AES.new(self.key, AES.MODE_CBC, data[:16])
+            data = data[16:]
+        # always hold back the last full block, as it carries the padding
+        keep = len(data) % 16 or 16
+        if len(data) <= keep:
+            self.pending = data
+            return ''
+        self.pending = data[-keep:]
+        return self.cipher.decrypt(data[:-keep])
+
+    def finish(self):
+        data = self.pending
+        self.pending = ''
+        data = data[:len(data) - (len(data) % 16)]
+        if self.cipher is None or not data:
+            return ''
+        plaintext = self.cipher.decrypt(data)
+        # remove pkcs#5 aes padding
+        cutter = -1 * ord(plaintext[-1])
+        return plaintext[:cutter]
+
+
+##  PDFXRefIndex
+##
+##  The merged xref table and trailer of a whole document, as saved in
+##  a sidecar index file, so that later runs over the same file need not
+##  parse the xref chain again.  The index records the file size, its
+##  modification time and a hash of its first and last blocks, and is
+##  ignored when any of these no longer match.
+##
+class PDFXRefIndex(object):
+
+    MAGIC = '%DeDRM-xref-index 1'
+
+    def __init__(self, offsets, trailer, xrefstm=False):
+        self.offsets = offsets # objid -> (stmid, index), None if free
+        self.trailer = trailer
+        self.xrefstm = xrefstm
+        return
+
+    def __repr__(self):
+        return '<PDFXRefIndex: objs=%d>' % len(self.offsets)
+
+    def objids(self):
+        return self.offsets.iterkeys()
+
+    def getpos(self, objid):
+        pos = self.offsets[objid]
+        if pos is None:
+            raise KeyError(objid)
+        return pos
+
+    @classmethod
+    def merge(cls, xrefs):
+        offsets = {}
+        trailer = {}
+        for xref in reversed(xrefs):
+            trailer.update(xref.trailer)
+            for objid in xref.objids():
+                offsets[objid] = None
+        for objid in offsets:
+            for xref in xrefs:
+                try:
+                    offsets[objid] = xref.getpos(objid)
+                    break
+                except KeyError:
+                    pass
+        trailer.pop('Prev', None)
+        trailer.pop('XRefStm', None)
+        xrefstm = any(isinstance(xref, PDFXRefStream) for xref in xrefs)
+        return cls(offsets, trailer, xrefstm)
+
+    @staticmethod
+    def fingerprint(fp):
+        pos = fp.tell()
+        st = os.fstat(fp.fileno())
+        hash = hashlib.sha1()
+        fp.seek(0)
+        hash.update(fp.read(65536))
+        fp.seek(max(0, st.st_size - 65536))
+        hash.update(fp.read(65536))
+        fp.seek(pos)
+        return '%d %d %s' % (st.st_size, int(st.st_mtime), hash.hexdigest())
+
+    @classmethod
+    def load(cls, path, fp, doc):
+        try:
+            with open(path, 'rb') as f:
+                lines = f.read().split('\n')
+        except IOError:
+            return None
+        if lines[:2] != [cls.MAGIC, cls.fingerprint(fp)]:
+            return None
+        try:
+            xrefstm = (lines[2] == 'xrefstm 1')
+            offsets = {}
+            i = 3
+            while lines[i] != 'trailer':
+                f = lines[i].split(' ')
+                if f[1] == 'f':
+                    offsets[int(f[0])] = None
+                else:
+                    (objid, stmid, index) = map(int, f)
+                    offsets[objid] = (stmid or None, index)
+                i += 1
+            parser = PDFObjStrmParser('\n'.join(lines[i+1:]), doc)
+            (_, trailer) = parser.nextobject()
+        except (IndexError, ValueError, PSException):
+            return None
+        return cls(offsets, dict_value(trailer), xrefstm)
+
+    def save(self, path, fp):
+        lines = [self.MAGIC, self.fingerprint(fp),
+                 'xrefstm %d' % self.xrefstm]
+        for (objid, pos) in sorted(self.offsets.iteritems()):
+            if pos is None:
+                lines.append('%d f' % objid)
+            else:
+                lines.append('%d %d %d' % (objid, pos[0] or 0, pos[1]))
+        lines.append('trailer')
+        lines.append(self.repr_object(self.trailer))
+        try:
+            with open(path, 'wb') as f:
+                f.write('\n'.join(lines) + '\n')
+        except IOError:
+            pass
+        return
+
+    def repr_object(self, obj):
+        if isinstance(obj, dict):
+            return '<<%s>>' % ''.join('%r %s' % (LIT(k), self.repr_object(v))
+                                      for (k, v) in obj.iteritems())
+        if isinstance(obj, list):
+            return '[%s]' % ' '.join(self.repr_object(v) for v in obj)
+        if isinstance(obj, str):
+            return '<%s>' % obj.encode('hex')
+        if isinstance(obj, bool):
+            return str(obj).lower()
+        if isinstance(obj, PDFObjRef):
+            return '%d %d R' % (obj.objid, obj.genno)
+        return str(obj)
+
+
 ##  PDFDocument
 ##
 ##  A PDFDocument object represents a PDF document.
@@ -1405,7 +1805,8 @@ class PDFXRefStream(object):
 ##
 class PDFDocument(object):
 
-    def __init__(self):
+    def __init__(self, xrefindex=None):
+        self.xrefindex = xrefindex
         self.xrefs = []
         self.objs = {}
         self.parsed_objs = {}
@@ -1414,6 +1815,9 @@ class PDFDocument(object):
         self.parser = None
         self.encryption = None
         self.decipher = None
+        self.stream_decipher = None
+        self.keycache = {}
+        self.rc4cache = {}
         return
 
     # set_parser(parser)
@@ -1428,7 +1832,18 @@ class PDFDocument(object):
         self.ready = True
         # Retrieve the information of each header that was appended
         # (maybe multiple times) at the end of the document.
-        self.xrefs = parser.read_xref()
+        self.xrefs = None
+        if self.xrefindex:
+            index = PDFXRefIndex.load(self.xrefindex, parser.fp, self)
+            if index is not None:
+                if index.xrefstm and GEN_XREF_STM == 1:
+                    global gen_xref_stm
+                    gen_xref_stm = True
+                self.xrefs = [index]
+        if self.xrefs is None:
+            self.xrefs = parser.read_xref()
+            if self.xrefindex:
+                PDFXRefIndex.merge(self.xrefs).save(self.xrefindex, parser.fp)
         for xref in self.xrefs:
             trailer = xref.trailer
             if not trailer: continue
@@ -1489,6 +1904,7 @@ class PDFDocument(object):
         self.decrypt_key = self.genkey_adobe_ps(param)
         self.genkey = self.genkey_v4
         self.decipher = self.decrypt_aes
+        self.stream_decipher = self.decrypt_aes_stream
         self.ready = True
         return
 
@@ -1645,6 +2061,7 @@ class PDFDocument(object):
         self.decrypt_key = bookkey
         self.genkey = self.genkey_v3 if V == 3 else self.genkey_v2
         self.decipher = self.decrypt_rc4
+        self.stream_decipher = self.decrypt_rc4_stream
         self.ready = True
         return
 
@@ -1675,8 +2092,37 @@ class PDFDocument(object):
         key = hash.digest()[:min(len(self.decrypt_key) + 5, 16)]
         return key
 
+    # Every string of an object is deciphered separately, so the
+    # per-object keys (and RC4 key schedules, where the crypto backend
+    # can clone them) are cached.  The caches are simply emptied when
+    # they fill up, as objects are mostly processed one after another.
+    KEY_CACHE_SIZE = 1024
+
+    def getkey(self, objid, genno):
+        try:
+            return self.keycache[(objid, genno)]
+        except KeyError:
+            pass
+        if len(self.keycache) >= self.KEY_CACHE_SIZE:
+            self.keycache.clear()
+        key = self.keycache[(objid, genno)] = self.genkey(objid, genno)
+        return key
+
+    def getrc4(self, objid, genno):
+        try:
+            return self.rc4cache[(objid, genno)].copy()
+        except KeyError:
+            pass
+        cipher = ARC4.new(self.getkey(objid, genno))
+        if not hasattr(cipher, 'copy'):
+            return cipher
+        if len(self.rc4cache) >= self.KEY_CACHE_SIZE:
+            self.rc4cache.clear()
+        self.rc4cache[(objid, genno)] = cipher
+        return cipher.copy()
+
     def decrypt_aes(self, objid, genno, data):
-        key = self.genkey(objid, genno)
+        key = self.getkey(objid, genno)
         ivector = data[:16]
         data = data[16:]
         plaintext = AES.new(key,AES.MODE_CBC,ivector).decrypt(data)
@@ -1687,7 +2133,7 @@ class PDFDocument(object):
         return plaintext
 
     def decrypt_aes256(self, objid, genno, data):
-        key = self.genkey(objid, genno)
+        key = self.getkey(objid, genno)
         ivector = data[:16]
         data = data[16:]
         plaintext = AES.new(key,AES.MODE_CBC,ivector).decrypt(data)
@@ -1698,8 +2144,14 @@ class PDFDocument(object):
         return plaintext
 
     def decrypt_rc4(self, objid, genno, data):
-        key = self.genkey(objid, genno)
-        return ARC4.new(key).decrypt(data)
+        return self.getrc4(objid, genno).decrypt(data)
+
+    # incremental variants of the above, used for large streams
+    def decrypt_aes_stream(self, objid, genno):
+        return AESStreamDecipher(self.getkey(objid, genno))
+
+    def decrypt_rc4_stream(self, objid, genno):
+        return RC4StreamDecipher(self.getrc4(objid, genno))
 
 
     KEYWORD_OBJ = PSKeywordTable.intern('obj')
@@ -1869,7 +2321,8 @@ class PDFParser(PSStackParser):
                 objlen += len(line)
                 data += line
             self.seek(pos+objlen)
-            obj = PDFStream(dic, data, self.doc.decipher)
+            obj = PDFStream(dic, data, self.doc.decipher,
+                            self.doc.stream_decipher)
             self.push((pos, obj))
             return
 
@@ -1899,13 +2352,14 @@ class PDFParser(PSStackParser):
             raise PDFNoValidXRef('Unexpected EOF')
         if isinstance(token, int):
             # XRefStream: PDF-1.5
-            if GEN_XREF_STM == 1:
-                global gen_xref_stm
-                gen_xref_stm = True
             self.seek(pos)
             self.reset()
             xref = PDFXRefStream()
             xref.load(self)
+            # only once it has loaded, a broken file may have any object here
+            if GEN_XREF_STM == 1:
+                global gen_xref_stm
+                gen_xref_stm = True
         else:
             if token is not self.KEYWORD_XREF:
                 raise PDFNoValidXRef('xref not found: pos=%d, token=%r' %
@@ -1933,22 +2387,11 @@ class PDFParser(PSStackParser):
             self.read_xref_from(pos, xrefs)
         except PDFNoValidXRef:
             # fallback
-            self.seek(0)
-            pat = re.compile(r'^(\d+)\s+(\d+)\s+obj\b')
-            offsets = {}
-            xref = PDFXRef()
-            while 1:
-                try:
-                    (pos, line) = self.nextline()
-                except PSEOF:
-                    break
-                if line.startswith('trailer'):
-                    trailerpos = pos # remember last trailer
-                m = pat.match(line)
-                if not m: continue
-                (objid, genno) = m.groups()
-                offsets[int(objid)] = (0, pos)
+            start = time.time()
+            (offsets, trailerpos) = self.scan_objects()
             if not offsets: raise
+            print u"Rebuilt cross reference table: {0:d} objects in {1:.2f} seconds".format(len(offsets), time.time()-start)
+            xref = PDFXRef()
             xref.offsets = offsets
             if trailerpos:
                 self.seek(trailerpos)
@@ -1956,6 +2399,42 @@ class PDFParser(PSStackParser):
                 xrefs.append(xref)
         return xrefs
 
+    # rebuild the xref table of a broken file
+    # The scan looks for the literal "obj", which the regular expression
+    # engine can search for quickly, and then checks for the object
+    # number and generation just before it.
+    OBJ_KEYWORD = re.compile(r'obj\b')
+    OBJ_HEADER = re.compile(r'(?<![0-9])(\d+)\s+(\d+)\s+\Z')
+    def scan_objects(self):
+        '''
+        Finds all the "objid genno obj" markers, wherever they are on
+        their line, and the position of the last trailer, with a single
+        scan over the whole file (memory mapped when possible).  Later
+        definitions of an object replace earlier ones.
+        '''
+        try:
+            data = mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, ValueError, EnvironmentError):
+            self.fp.seek(0)
+            data = self.fp.read()
+        try:
+            offsets = {}
+            for m in self.OBJ_KEYWORD.finditer(data):
+                pos = m.start()
+                head = max(0, pos-64)
+                h = self.OBJ_HEADER.search(data[head:pos])
+                if h:
+                    offsets[int(h.group(1))] = (0, head+h.start())
+            trailerpos = data.rfind('trailer')
+            while 0 < trailerpos and not data[trailerpos-1].isspace():
+                trailerpos = data.rfind('trailer', 0, trailerpos)
+            if trailerpos < 0:
+                trailerpos = None
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
+        return (offsets, trailerpos)
+
 ##  PDFObjStrmParser
 ##
 class PDFObjStrmParser(PDFParser):
@@ -1989,12 +2468,16 @@ class PDFObjStrmParser(PDFParser):
 ### My own code, for which there is none else to blame
 
 class PDFSerializer(object):
-    def __init__(self, inf, userkey):
+    def __init__(self, inf, userkey, pack_level=None, xrefindex=None):
         global GEN_XREF_STM, gen_xref_stm
         gen_xref_stm = GEN_XREF_STM > 1
+        if pack_level is None:
+            pack_level = PACK_OBJ_STM
+        self.pack_level = pack_level
+        self.xrefindex = xrefindex
         self.version = inf.read(8)
         inf.seek(0)
-        self.doc = doc = PDFDocument()
+        self.doc = doc = PDFDocument(xrefindex)
         parser = PDFParser(doc, inf)
         doc.initialize(userkey)
         self.objids = objids = set()
@@ -2011,29 +2494,188 @@ class PDFSerializer(object):
 
     def dump(self, outf):
         self.outf = outf
-        self.write(self.version)
-        self.write('\n%\xe2\xe3\xcf\xd3\n')
+        self.write_header()
         doc = self.doc
         objids = self.objids
         xrefs = {}
         maxobj = max(objids)
         trailer = dict(self.trailer)
         trailer['Size'] = maxobj + 1
+        pack = []
         for objid in objids:
-            obj = doc.getobj(objid)
-            if isinstance(obj, PDFObjStmRef):
-                xrefs[objid] = obj
-                continue
-            if obj is not None:
+            self.dump_object(objid, xrefs, pack)
+        maxobj = self.dump_objstms(pack, maxobj, xrefs)
+        self.dump_xref(xrefs, maxobj, trailer)
+
+    def write_header(self):
+        version = self.version
+        if (gen_xref_stm or self.pack_level) and version < '%PDF-1.5':
+            # object and cross reference streams are new in PDF 1.5
+            version = '%PDF-1.5'
+        self.write(version)
+        self.write('\n%\xe2\xe3\xcf\xd3\n')
+
+    def dump_object(self, objid, xrefs, pack):
+        '''
+        Writes out one object, recording its position in xrefs, or adds
+        its serialized form to pack when it is to go in an object stream.
+        '''
+        obj = self.doc.getobj(objid)
+        if isinstance(obj, PDFObjStmRef):
+            xrefs[objid] = obj
+            return
+        if obj is None:
+            return
+        if self.pack_level:
+            if isinstance(obj, PDFStream):
+                if obj.dic.get('Type') is LITERAL_OBJSTM and not gen_xref_stm:
+                    # all its objects have been extracted
+                    return
+            else:
+                body = self.serialize_body(obj)
+                if len(body) <= PACK_MAX_SIZE:
+                    pack.append((objid, body))
+                    return
+        try:
+            genno = obj.genno
+        except AttributeError:
+            genno = 0
+        xrefs[objid] = (self.tell(), genno)
+        self.serialize_indirect(objid, obj)
+        return
+
+    def dump_objstms(self, pack, maxobj, xrefs):
+        '''
+        Writes the packed objects out in new object streams, numbered
+        after maxobj.  Returns the new highest object number.
+        '''
+        for i in xrange(0, len(pack), PACK_OBJS_PER_STM):
+            maxobj += 1
+            header = []
+            bodies = []
+            pos = 0
+            for (index, (objid, body)) in enumerate(pack[i:i+PACK_OBJS_PER_STM]):
+                xrefs[objid] = PDFObjStmRef(objid, maxobj, index)
+                header.append('%d %d' % (objid, pos))
+                bodies.append(body)
+                pos += len(body) + 1
+            header = ' '.join(header) + '\n'
+            data = zlib.compress(header + '\n'.join(bodies), self.pack_level)
+            dic = {'Type': LITERAL_OBJSTM, 'N': len(bodies),
+                   'First': len(header), 'Length': len(data),
+                   'Filter': LITERALS_FLATE_DECODE[0]}
+            xrefs[maxobj] = (self.tell(), 0)
+            self.serialize_indirect(maxobj, PDFStream(dic, data))
+        return maxobj
+
+    # Write the objects using a pool of worker processes, each of which
+    # serializes runs of neighbouring objects.  Every worker sets up the
+    # document once, when it starts, and is then only sent the object
+    # numbers of each run.  The runs are written out in order and the xref
+    # offsets worked out here, so the output is the same as with dump().
+    def dump_parallel(self, outf, inpath, userkey, workers):
+        global _serializer
+        import multiprocessing
+        self.outf = outf
+        self.write_header()
+        xrefs = {}
+        maxobj = max(self.objids)
+        trailer = dict(self.trailer)
+        trailer['Size'] = maxobj + 1
+        tasks = self.partition_objids(workers * 4)
+        pack = []
+        # forked workers inherit this serializer, with the document already
+        # parsed and its key unwrapped, instead of opening it again
+        _serializer = self
+        try:
+            pool = multiprocessing.Pool(workers, _initSerializeWorker,
+                                        (inpath, userkey, self.pack_level, self.xrefindex))
+        finally:
+            _serializer = None
+        try:
+            for (data, refs, objs) in pool.imap(_serialize_objids, tasks):
+                base = self.tell()
+                for (objid, ref) in refs:
+                    if isinstance(ref, tuple):
+                        xrefs[objid] = PDFObjStmRef(objid, *ref)
+                    else:
+                        xrefs[objid] = (base + ref, 0)
+                if data:
+                    self.write(data)
+                pack.extend(objs)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        maxobj = self.dump_objstms(pack, maxobj, xrefs)
+        self.dump_xref(xrefs, maxobj, trailer)
+
+    def partition_objids(self, nparts):
+        '''
+        Splits the objects into at most nparts runs of neighbouring
+        objects in the input file, of roughly equal size in bytes.
+        Objects inside an object stream go with the stream.
+        '''
+        doc = self.doc
+        def getpos(objid):
+            for xref in doc.xrefs:
                 try:
-                    genno = obj.genno
-                except AttributeError:
-                    genno = 0
-                xrefs[objid] = (self.tell(), genno)
-                self.serialize_indirect(objid, obj)
+                    return xref.getpos(objid)
+                except KeyError:
+                    pass
+            return (None, 0)
+        places = []
+        for objid in self.objids:
+            (stmid, index) = getpos(objid)
+            if stmid:
+                (_, pos) = getpos(stmid)
+                places.append((pos, index, objid))
+            else:
+                places.append((index, -1, objid))
+        places.sort()
+        if not places:
+            return []
+        total = places[-1][0] - places[0][0]
+        size = total // nparts + 1
+        parts = []
+        part = []
+        start = places[0][0]
+        for (pos, _, objid) in places:
+            if part and pos - start >= size:
+                parts.append(part)
+                part = []
+                start = pos
+            part.append(objid)
+        parts.append(part)
+        return parts
+
+    def serialize_objids(self, objids):
+        '''
+        Serializes the given objects into a string.  Returns the string,
+        a list of (objid, ref) pairs, where ref is either the offset of
+        the object in the string or a (stmid, index) pair for objects
+        left in an object stream, and the objects to be packed.
+        '''
+        self.outf = StringIO()
+        self.last = ''
+        xrefs = {}
+        pack = []
+        for objid in objids:
+            self.dump_object(objid, xrefs, pack)
+        refs = []
+        for (objid, ref) in xrefs.iteritems():
+            if isinstance(ref, PDFObjStmRef):
+                refs.append((objid, (ref.stmid, ref.index)))
+            else:
+                refs.append((objid, ref[0]))
+        return (self.outf.getvalue(), refs, pack)
+
+    def dump_xref(self, xrefs, maxobj, trailer):
         startxref = self.tell()
 
-        if not gen_xref_stm:
+        if not (gen_xref_stm or self.pack_level):
             self.write('xref\n')
             self.write('0 %d\n' % (maxobj + 1,))
             for objid in xrange(0, maxobj + 1):
@@ -2094,7 +2736,7 @@ class PDFSerializer(object):
                 data.append(struct.pack('>L', f2)[-fl2:])
                 data.append(struct.pack('>L', f3)[-fl3:])
             index.extend((first, prev - first + 1))
-            data = zlib.compress(''.join(data))
+            data = zlib.compress(''.join(data), self.pack_level or 6)
             dic = {'Type': LITERAL_XREF, 'Size': prev + 1, 'Index': index,
                    'W': [1, fl2, fl3], 'Length': len(data),
                    'Filter': LITERALS_FLATE_DECODE[0],
@@ -2161,13 +2803,14 @@ class PDFSerializer(object):
             ### If we don't generate cross ref streams the object streams
             ### are no longer useful, as we have extracted all objects from
             ### them. Therefore leave them out from the output.
-            if obj.dic.get('Type') == LITERAL_OBJSTM and not gen_xref_stm:
+            if obj.dic.get('Type') == LITERAL_OBJSTM and not gen_xref_stm \
+                   and not self.pack_level:
                 self.write('(deleted)')
             else:
-                data = obj.get_decdata()
-                self.serialize_object(obj.dic)
+                self.serialize_object(self.stream_dict(obj))
                 self.write('stream\n')
-                self.write(data)
+                for data in obj.iter_decdata():
+                    self.write(data)
                 self.write('\nendstream')
         else:
             data = str(obj)
@@ -2175,6 +2818,27 @@ class PDFSerializer(object):
                 self.write(' ')
             self.write(data)
 
+    # the dictionary to write for a stream, which loses its filters when
+    # only the decoded data is left
+    def stream_dict(self, obj):
+        if obj.rawdata is not None or obj.decdata is not None:
+            return obj.dic
+        dic = dict(obj.dic)
+        for key in ('Filter', 'DecodeParms', 'DP'):
+            dic.pop(key, None)
+        dic['Length'] = len(obj.data or '')
+        return dic
+
+    def serialize_body(self, obj):
+        (outf, last) = (self.outf, self.last)
+        self.outf = StringIO()
+        self.last = ''
+        try:
+            self.serialize_object(obj)
+            return self.outf.getvalue()
+        finally:
+            (self.outf, self.last) = (outf, last)
+
     def serialize_indirect(self, objid, obj):
         self.write('%d 0 obj' % (objid,))
         self.serialize_object(obj)
@@ -2183,14 +2847,30 @@ class PDFSerializer(object):
         self.write('endobj\n')
 
 
+# worker process side of PDFSerializer.dump_parallel
+_serializer = None
+
+def _initSerializeWorker(inpath, userkey, pack_level, xrefindex):
+    global _serializer
+    # the input stays open for as long as the worker runs
+    inf = open(inpath, 'rb')
+    if _serializer is not None:
+        # forked from the parent, only the file position must not be shared
+        _serializer.doc.parser.fp = inf
+    else:
+        _serializer = PDFSerializer(inf, userkey, pack_level, xrefindex)
+
+def _serialize_objids(objids):
+    return _serializer.serialize_objids(objids)
 
 
-def decryptBook(userkey, inpath, outpath):
+def decryptBook(userkey, inpath, outpath, workers=0, pack_level=None,
+                xrefindex=None):
     if RSA is None:
         raise ADEPTError(u"PyCrypto or OpenSSL must be installed.")
     with open(inpath, 'rb') as inf:
         #try:
-        serializer = PDFSerializer(inf, userkey)
+        serializer = PDFSerializer(inf, userkey, pack_level, xrefindex)
         #except:
         #    print u"Error serializing pdf {0}. Probably wrong key.".format(os.path.basename(inpath))
         #    return 2
@@ -2198,7 +2878,10 @@ def decryptBook(userkey, inpath, outpath):
         with open(outpath, 'wb') as outf:
             # help construct to make sure the method runs to the end
             try:
-                serializer.dump(outf)
+                if workers > 1:
+                    serializer.dump_parallel(outf, inpath, userkey, workers)
+                else:
+                    serializer.dump(outf)
             except Exception, e:
                 print u"error writing pdf: {0}".format(e.args[0])
                 return 2
@@ -2210,12 +2893,27 @@ def cli_main():
     sys.stderr=SafeUnbuffered(sys.stderr)
     argv=unicode_argv()
     progname = os.path.basename(argv[0])
-    if len(argv) != 4:
-        print u"usage: {0} <keyfile.der> <inbook.pdf> <outbook.pdf>".format(progname)
+    try:
+        opts, args = getopt.getopt(argv[1:], "j:z:x:")
+    except getopt.GetoptError, err:
+        print err.args[0]
+        args = []
+    workers = 0
+    pack_level = None
+    xrefindex = None
+    for o, a in opts:
+        if o == "-j":
+            workers = int(a)
+        elif o == "-z":
+            pack_level = int(a)
+        elif o == "-x":
+            xrefindex = a
+    if len(args) != 3:
+        print u"usage: {0} [-j <workers>] [-z <level>] [-x <xref index file>] <keyfile.der> <inbook.pdf> <outbook.pdf>".format(progname)
         return 1
-    keypath, inpath, outpath = argv[1:]
+    keypath, inpath, outpath = args
     userkey = open(keypath,'rb').read()
-    result = decryptBook(userkey, inpath, outpath)
+    result = decryptBook(userkey, inpath, outpath, workers, pack_level, xrefindex)
     if result == 0:
         print u"Successfully decrypted {0:s} as {1:s}".format(os.path.basename(inpath),os.path.basename(outpath))
     return result
@@ -12,11 +12,6 @@ import os
 import os.path
 import struct
 
-try:
-    from cStringIO import StringIO
-except ImportError:
-    from StringIO import StringIO
-
 from Crypto.Cipher import AES
 from Crypto.Util.py3compat import bchr, bord
 
@@ -80,6 +75,118 @@ def _assert(test, msg="Exception"):
         raise Exception(msg)
 
 
+# the value of one item of a memoryview, a 1 byte string on Python 2
+if isinstance(memoryview(b"\x00")[0], int):
+    _byte = int
+else:
+    _byte = ord
+
+
+# decode the VarUInt (or with signed the VarInt) at pos of buf, the last
+# byte has the high bit set and a VarInt has its sign in the 0x40 bit of
+# the first byte; returns the value and the position after it
+def _decodevaruint(buf, pos, signed=False):
+    try:
+        b = _byte(buf[pos])
+        pos += 1
+        if signed:
+            negative = ((b & 0x40) != 0)
+            result = (b & 0x3F)
+        else:
+            negative = False
+            result = (b & 0x7F)
+
+        i = 0
+        while (b & 0x80) == 0 and i < 4:
+            b = _byte(buf[pos])
+            pos += 1
+            result = (result << 7) | (b & 0x7F)
+            i += 1
+    except IndexError:
+        raise EOFError()
+
+    _assert(i < 4 or (b & 0x80) != 0, "int overflow")
+
+    if negative:
+        return -result, pos
+    return result, pos
+
+
+# the values of a list, sexp or struct held in buf, read lazily without a
+# parser: yields (fieldid, annotations, typeid, value) for each of them,
+# where fieldid is SID_UNKNOWN outside a struct and value is a view of the
+# value's bytes, or None for a null value. Nothing is copied or decoded,
+# values that are not used are skipped over by their length.
+# Most VarUInts here are one or two bytes, which are decoded inline.
+def scancontainer(buf, isstruct):
+    byte = _byte
+    pos = 0
+    end = len(buf)
+    fieldid = SID_UNKNOWN
+    try:
+        while pos < end:
+            if isstruct:
+                b = byte(buf[pos])
+                if b & 0x80:
+                    fieldid = b & 0x7F
+                    pos += 1
+                else:
+                    fieldid, pos = _decodevaruint(buf, pos)
+            annotations = []
+            while True:
+                b = byte(buf[pos])
+                pos += 1
+                tid = b >> 4
+                ln = b & 0xF
+                isnull = (ln == LEN_IS_NULL)
+                if ln == LEN_IS_VAR_LEN or (tid == TID_STRUCT and ln == 1):
+                    # lengths of one or two bytes, anything longer is rare
+                    b = byte(buf[pos])
+                    pos += 1
+                    ln = b & 0x7F
+                    if not b & 0x80:
+                        b = byte(buf[pos])
+                        pos += 1
+                        ln = (ln << 7) | (b & 0x7F)
+                        if not b & 0x80:
+                            ln, pos = _decodevaruint(buf, pos - 2)
+                if tid != TID_TYPEDECL or isnull:
+                    break
+                # annotation wrapper, the value follows the annotations
+                b = byte(buf[pos])
+                if b & 0x80:
+                    aend = pos + 1 + (b & 0x7F)
+                    pos += 1
+                else:
+                    alen, pos = _decodevaruint(buf, pos)
+                    aend = pos + alen
+                while pos < aend:
+                    b = byte(buf[pos])
+                    if b & 0x80:
+                        annotations.append(b & 0x7F)
+                        pos += 1
+                    else:
+                        a, pos = _decodevaruint(buf, pos)
+                        annotations.append(a)
+
+            if isnull:
+                yield (fieldid, annotations, tid, None)
+                continue
+            # checked here rather than with _assert, which costs a call
+            # for every value
+            if tid == TID_BOOLEAN:
+                ln = 0
+            elif tid == TID_NULL:
+                raise Exception("Unexpected null type")
+            start = pos
+            pos += ln
+            if pos > end:
+                raise Exception("Value overruns its container")
+            yield (fieldid, annotations, tid, buf[start:pos])
+    except IndexError:
+        raise EOFError()
+
+
 class SystemSymbols(object):
     ION = '$ion'
     ION_1_0 = '$ion_1_0'
@@ -129,6 +236,7 @@ class SymbolTable(object):
         self.table[SID_SYMBOLS] = SystemSymbols.SYMBOLS
         self.table[SID_MAX_ID] = SystemSymbols.MAX_ID
         self.table[SID_ION_SHARED_SYMBOL_TABLE] = SystemSymbols.ION_SHARED_SYMBOL_TABLE
+        self.idcache = {}
 
     def findbyid(self, sid):
         if sid < 1:
@@ -139,13 +247,23 @@ class SymbolTable(object):
         else:
             return ""
 
+    # the ids of all the symbols named in the tuple names, resolved once
+    # per table so that callers can compare ids instead of names
+    def findids(self, names):
+        ids = self.idcache.get(names)
+        if ids is None:
+            ids = frozenset(sid for (sid, name) in enumerate(self.table) if name in names)
+            self.idcache[names] = ids
+        return ids
+
     def import_(self, table, maxid):
-        for i in range(maxid):
-            self.table.append(table.symnames[i])
+        self.table.extend(table.symnames[:maxid])
+        self.idcache = {}
 
     def importunknown(self, name, maxid):
         for i in range(maxid):
             self.table.append("%s#%d" % (name, i + 1))
+        self.idcache = {}
 
 
 class ParserState:
@@ -173,8 +291,12 @@ class BinaryIonParser(object):
         self.annotations = []
         self.catalog = []
 
-        self.stream = stream
-        self.initpos = stream.tell()
+        # the parser works over one buffer with an integer cursor, a stream
+        # is read into memory from its current position
+        if hasattr(stream, "read"):
+            stream = stream.read()
+        self.buffer = memoryview(stream)
+        self.pos = 0
         self.reset()
         self.symbols = SymbolTable()
 
@@ -185,11 +307,14 @@ class BinaryIonParser(object):
         self.eof = False
         self.isinstruct = False
         self.containerstack = []
-        self.stream.seek(self.initpos)
+        self.pos = 0
 
     def addtocatalog(self, name, version, symbols):
         self.catalog.append(IonCatalogItem(name, version, symbols))
 
+    def addcatalogitem(self, item):
+        self.catalog.append(item)
+
     def hasnext(self):
         while self.needhasnext and not self.eof:
             self.hasnextraw()
@@ -266,7 +391,7 @@ class BinaryIonParser(object):
             nextrem -= self.valuelen
             if nextrem < 0:
                 nextrem = 0
-        self.push(self.parenttid, self.stream.tell() + self.valuelen, nextrem)
+        self.push(self.parenttid, self.pos + self.valuelen, nextrem)
 
         self.isinstruct = (self.valuetid == TID_STRUCT)
         if self.isinstruct:
@@ -293,7 +418,7 @@ class BinaryIonParser(object):
         self.needhasnext = True
 
         self.clearvalue()
-        curpos = self.stream.tell()
+        curpos = self.pos
         if rec.nextpos > curpos:
             self.skip(rec.nextpos - curpos)
         else:
@@ -302,14 +427,19 @@ class BinaryIonParser(object):
         self.localremaining = rec.remaining
 
     def read(self, count=1):
+        return self.readview(count).tobytes()
+
+    def readview(self, count):
+        # the next count bytes as a view into the buffer
         if self.localremaining != -1:
             self.localremaining -= count
             _assert(self.localremaining >= 0)
 
-        result = self.stream.read(count)
-        if len(result) == 0:
+        pos = self.pos
+        if count <= 0 or pos >= len(self.buffer):
             raise EOFError()
-        return result
+        self.pos = min(pos + count, len(self.buffer))
+        return self.buffer[pos:self.pos]
 
     def readfieldid(self):
         if self.localremaining != -1 and self.localremaining < 1:
@@ -326,10 +456,10 @@ class BinaryIonParser(object):
                 return -1
             self.localremaining -= 1
 
-        b = self.stream.read(1)
-        if len(b) < 1:
+        if self.pos >= len(self.buffer):
             return -1
-        b = bord(b)
+        b = _byte(self.buffer[self.pos])
+        self.pos += 1
         result = b >> 4
         ln = b & 0xF
 
@@ -354,34 +484,16 @@ class BinaryIonParser(object):
         return result
 
     def readvarint(self):
-        b = bord(self.read())
-        negative = ((b & 0x40) != 0)
-        result = (b & 0x3F)
-
-        i = 0
-        while (b & 0x80) == 0 and i < 4:
-            b = bord(self.read())
-            result = (result << 7) | (b & 0x7F)
-            i += 1
-
-        _assert(i < 4 or (b & 0x80) != 0, "int overflow")
-
-        if negative:
-            return -result
-        return result
-
-    def readvaruint(self):
-        b = bord(self.read())
-        result = (b & 0x7F)
-
-        i = 0
-        while (b & 0x80) == 0 and i < 4:
-            b = bord(self.read())
-            result = (result << 7) | (b & 0x7F)
-            i += 1
-
-        _assert(i < 4 or (b & 0x80) != 0, "int overflow")
+        return self.readvaruint(True)
 
+    def readvaruint(self, signed=False):
+        start = self.pos
+        try:
+            result, self.pos = _decodevaruint(self.buffer, start, signed)
+        finally:
+            if self.localremaining != -1:
+                self.localremaining -= (self.pos - start)
+        _assert(self.localremaining == -1 or self.localremaining >= 0)
         return result
 
     def readdecimal(self):
@@ -423,7 +535,7 @@ class BinaryIonParser(object):
             if self.localremaining < 0:
                 raise EOFError()
 
-        self.stream.seek(count, os.SEEK_CUR)
+        self.pos += count
 
     def parsesymboltable(self):
         self.next() # shouldn't do anything?
@@ -521,13 +633,25 @@ class BinaryIonParser(object):
             result = "SYMBOL#%d" % self.value
         return result
 
+    def scanvalues(self):
+        # Moves past the current container and returns an iterator over its
+        # values, read lazily from the buffer by scancontainer
+        _assert(self.valuetid in [TID_STRUCT, TID_LIST, TID_SEXP] and self.state == ParserState.BeforeValue and
+                not self.valueisnull, "Not a container")
+
+        buf = self.buffer[self.pos:self.pos + self.valuelen]
+        self.skip(self.valuelen)
+        self.state = ParserState.AfterValue
+        return scancontainer(buf, self.valuetid == TID_STRUCT)
+
     def lobvalue(self):
         _assert(self.valuetid in [TID_CLOB, TID_BLOB], "Not a LOB type: %s" % self.getfieldname())
 
         if self.valueisnull:
             return None
 
-        result = self.read(self.valuelen)
+        # a view into the parser's buffer, not a copy
+        result = self.readview(self.valuelen)
         self.state = ParserState.AfterValue
         return result
 
@@ -560,8 +684,8 @@ class BinaryIonParser(object):
             else:
                 _assert(self.valuelen <= 4, "int too long: %d" % self.valuelen)
                 v = 0
-                for i in range(self.valuelen - 1, -1, -1):
-                    v = (v | (bord(self.read()) << (i * 8)))
+                for b in self.readview(self.valuelen).tobytes():
+                    v = (v << 8) | bord(b)
 
                 if self.valuetid == TID_NEGINT:
                     self.value = -v
@@ -585,8 +709,8 @@ class BinaryIonParser(object):
 
     def loadannotations(self):
         ln = self.readvaruint()
-        maxpos = self.stream.tell() + ln
-        while self.stream.tell() < maxpos:
+        maxpos = self.pos + ln
+        while self.pos < maxpos:
             self.annotations.append(self.readvaruint())
         self.valuetid = self.readtypeid()
 
@@ -716,8 +840,11 @@ SYM_NAMES = [ 'com.amazon.drm.Envelope@1.0',
               'com.amazon.drm.PlainText@2.0', 'compression_algorithm',
               'com.amazon.drm.Compressed@1.0', 'priority', 'refines']
 
+# built once, every parser of the process shares it
+PROTECTED_DATA = IonCatalogItem("ProtectedData", 1, SYM_NAMES)
+
 def addprottable(ion):
-    ion.addtocatalog("ProtectedData", 1, SYM_NAMES)
+    ion.addcatalogitem(PROTECTED_DATA)
 
 
 def pkcs7pad(msg, blocklen):
@@ -736,6 +863,51 @@ def pkcs7unpad(msg, blocklen):
     return msg[:-paddinglen]
 
 
+# Keys derived from voucher lock parameters, shared by all the vouchers of
+# the process: the books of one account are locked to the same DSN and
+# account secret, so their voucher keys are the same. Least recently used
+# keys are dropped beyond maxsize.
+class VoucherKeyCache(object):
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.keys = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lastsuccess = None
+
+    def getkey(self, params, derive):
+        key = self.keys.pop(params, None)
+        if key is None:
+            self.misses += 1
+            key = derive()
+        else:
+            self.hits += 1
+        self.keys[params] = key
+        while len(self.keys) > self.maxsize:
+            self.keys.popitem(last=False)
+        return key
+
+    # (dsn, secret) of the last voucher that decrypted, to be tried first
+    def succeeded(self, dsn, secret):
+        self.lastsuccess = (dsn, secret)
+
+    def ordercandidates(self, candidates):
+        candidates = list(candidates)
+        if self.lastsuccess in candidates:
+            candidates.remove(self.lastsuccess)
+            candidates.insert(0, self.lastsuccess)
+        return candidates
+
+    def clear(self):
+        self.keys.clear()
+        self.hits = 0
+        self.misses = 0
+        self.lastsuccess = None
+
+
+voucherkeys = VoucherKeyCache(64)
+
+
 class DrmIonVoucher(object):
     envelope = None
     voucher = None
@@ -760,10 +932,9 @@ class DrmIonVoucher(object):
         self.envelope = BinaryIonParser(voucherenv)
         addprottable(self.envelope)
 
-    def decryptvoucher(self):
+    def derivekey(self):
         shared = "PIDv3" + self.encalgorithm + self.enctransformation + self.hashalgorithm
 
-        self.lockparams.sort()
         for param in self.lockparams:
             if param == "ACCOUNT_SECRET":
                 shared += param + self.secret
@@ -774,12 +945,18 @@ class DrmIonVoucher(object):
 
         sharedsecret = shared.encode("UTF-8")
 
-        key = hmac.new(sharedsecret, sharedsecret[:5], digestmod=hashlib.sha256).digest()
+        return hmac.new(sharedsecret, sharedsecret[:5], digestmod=hashlib.sha256).digest()
+
+    def decryptvoucher(self):
+        self.lockparams.sort()
+        params = (self.dsn, self.secret, self.encalgorithm, self.enctransformation, self.hashalgorithm,
+                  tuple(self.lockparams))
+        key = voucherkeys.getkey(params, self.derivekey)
         aes = AES.new(key[:32], AES.MODE_CBC, self.cipheriv[:16])
         b = aes.decrypt(self.ciphertext)
         b = pkcs7unpad(b, 16)
 
-        self.drmkey = BinaryIonParser(StringIO(b))
+        self.drmkey = BinaryIonParser(b)
         addprottable(self.drmkey)
 
         _assert(self.drmkey.hasnext() and self.drmkey.next() == TID_LIST and self.drmkey.gettypename() == "com.amazon.drm.KeySet@1.0",
@@ -799,12 +976,13 @@ class DrmIonVoucher(object):
                 elif self.drmkey.getfieldname() == "format":
                     _assert(self.drmkey.stringvalue() == "RAW", "Unknown key format: %s" % self.drmkey.stringvalue())
                 elif self.drmkey.getfieldname() == "encoded":
-                    self.secretkey = self.drmkey.lobvalue()
+                    self.secretkey = self.drmkey.lobvalue().tobytes()
 
             self.drmkey.stepout()
             break
 
         self.drmkey.stepout()
+        voucherkeys.succeeded(self.dsn, self.secret)
 
     def parse(self):
         self.envelope.reset()
@@ -817,7 +995,7 @@ class DrmIonVoucher(object):
             self.envelope.next()
             field = self.envelope.getfieldname()
             if field == "voucher":
-                self.voucher = BinaryIonParser(StringIO(self.envelope.lobvalue()))
+                self.voucher = BinaryIonParser(self.envelope.lobvalue())
                 addprottable(self.voucher)
                 continue
             elif field != "strategy":
@@ -890,19 +1068,39 @@ class DrmIonVoucher(object):
         return self.license_type
 
 
+ENVELOPE_METADATA_TYPES = ("com.amazon.drm.EnvelopeMetadata@1.0", "com.amazon.drm.EnvelopeMetadata@2.0")
+ENCRYPTED_PAGE_TYPES = ("com.amazon.drm.EncryptedPage@1.0", "com.amazon.drm.EncryptedPage@2.0")
+
+# pages collected per worker process before they are decrypted
+PAGES_PER_WORKER = 64
+
+
 class DrmIon(object):
     ion = None
     voucher = None
     vouchername = ""
     key = b""
     onvoucherrequired = None
+    workers = 0
 
-    def __init__(self, ionstream, onvoucherrequired):
+    def __init__(self, ionstream, onvoucherrequired, workers=0):
         self.ion = BinaryIonParser(ionstream)
         addprottable(self.ion)
         self.onvoucherrequired = onvoucherrequired
+        self.workers = workers
+        self.pages = []
+        self.pool = None
 
     def parse(self, outpages):
+        try:
+            self.parseenvelope(outpages)
+            self.processpages(outpages)
+        finally:
+            if self.pool is not None:
+                self.pool.terminate()
+                self.pool = None
+
+    def parseenvelope(self, outpages):
         self.ion.reset()
 
         _assert(self.ion.hasnext(), "DRMION envelope is empty")
@@ -914,47 +1112,61 @@ class DrmIon(object):
             if self.ion.gettypename() == "enddoc":
                 break
 
-            self.ion.stepin()
-            while self.ion.hasnext():
-                self.ion.next()
-
-                if self.ion.gettypename() in ["com.amazon.drm.EnvelopeMetadata@1.0", "com.amazon.drm.EnvelopeMetadata@2.0"]:
-                    self.ion.stepin()
-                    while self.ion.hasnext():
-                        self.ion.next()
-                        if self.ion.getfieldname() != "encryption_voucher":
+            # envelopes hold thousands of pages, so their values are read
+            # straight from the buffer instead of stepping through them, and
+            # symbols are compared by id
+            symbols = self.ion.symbols
+            metadatatypes = symbols.findids(ENVELOPE_METADATA_TYPES)
+            pagetypes = symbols.findids(ENCRYPTED_PAGE_TYPES)
+            compressedtypes = symbols.findids(("com.amazon.drm.Compressed@1.0",))
+            voucherfields = symbols.findids(("encryption_voucher",))
+            ciphertextfields = symbols.findids(("cipher_text",))
+            cipherivfields = symbols.findids(("cipher_iv",))
+
+            for (fieldid, annotations, tid, value) in self.ion.scanvalues():
+                if len(annotations) == 0:
+                    continue
+
+                if annotations[0] in metadatatypes:
+                    if tid != TID_STRUCT or value is None:
+                        continue
+                    for (fieldid, annotations, tid, value) in scancontainer(value, True):
+                        if fieldid not in voucherfields:
                             continue
 
+                        _assert(tid == TID_STRING, "Not a string")
+                        if value is None:
+                            vouchername = ""
+                        else:
+                            vouchername = value.tobytes().decode("UTF-8")
                         if self.vouchername == "":
-                            self.vouchername = self.ion.stringvalue()
+                            self.vouchername = vouchername
                             self.voucher = self.onvoucherrequired(self.vouchername)
                             self.key = self.voucher.secretkey
                             _assert(self.key is not None, "Unable to obtain secret key from voucher")
                         else:
-                            _assert(self.vouchername == self.ion.stringvalue(),
+                            _assert(self.vouchername == vouchername,
                                     "Unexpected: Different vouchers required for same file?")
 
-                    self.ion.stepout()
-
-                elif self.ion.gettypename() in ["com.amazon.drm.EncryptedPage@1.0", "com.amazon.drm.EncryptedPage@2.0"]:
+                elif annotations[0] in pagetypes:
+                    if tid not in [TID_STRUCT, TID_LIST, TID_SEXP] or value is None:
+                        continue
                     decompress = False
                     ct = None
                     civ = None
-                    self.ion.stepin()
-                    while self.ion.hasnext():
-                        self.ion.next()
-                        if self.ion.gettypename() == "com.amazon.drm.Compressed@1.0":
+                    for (fieldid, annotations, tid, value) in scancontainer(value, tid == TID_STRUCT):
+                        if len(annotations) > 0 and annotations[0] in compressedtypes:
                             decompress = True
-                        if self.ion.getfieldname() == "cipher_text":
-                            ct = self.ion.lobvalue()
-                        elif self.ion.getfieldname() == "cipher_iv":
-                            civ = self.ion.lobvalue()
+                        if fieldid in ciphertextfields:
+                            _assert(tid in [TID_CLOB, TID_BLOB], "Not a LOB type: cipher_text")
+                            ct = value
+                        elif fieldid in cipherivfields:
+                            _assert(tid in [TID_CLOB, TID_BLOB], "Not a LOB type: cipher_iv")
+                            civ = value
 
                     if ct is not None and civ is not None:
                         self.processpage(ct, civ, outpages, decompress)
-                    self.ion.stepout()
 
-            self.ion.stepout()
             if not self.ion.hasnext():
                 break
             self.ion.next()
@@ -963,23 +1175,97 @@ class DrmIon(object):
         self.ion.print_(lst)
 
     def processpage(self, ct, civ, outpages, decompress):
-        aes = AES.new(self.key[:16], AES.MODE_CBC, civ[:16])
-        msg = pkcs7unpad(aes.decrypt(ct), 16)
-
-        if not decompress:
-            outpages.write(msg)
+        if self.workers > 0:
+            # decrypted in batches, see processpages
+            self.pages.append((ct.tobytes(), civ.tobytes(), decompress))
+            if len(self.pages) >= self.workers * PAGES_PER_WORKER:
+                self.processpages(outpages)
             return
 
-        _assert(msg[0] == b"\x00", "LZMA UseFilter not supported")
+        decryptpage(self.key, ct, civ, decompress, outpages.write)
 
-        if calibre_lzma is not None:
-            with calibre_lzma.decompress(msg[1:], bufsize=0x1000000) as f:
-                f.seek(0)
-                outpages.write(f.read())
+    # pages are independent once the key is known, so with workers > 0 they
+    # are decrypted and decompressed by a pool of processes; they are
+    # written to outpages in order either way
+    def processpages(self, outpages):
+        pages = self.pages
+        self.pages = []
+        if not pages:
             return
 
-        decomp = lzma.LZMADecompressor(format=lzma.FORMAT_ALONE)
-        while not decomp.eof:
-            segment = decomp.decompress(msg[1:])
-            msg = b"" # Contents were internally buffered after the first call
-            outpages.write(segment)
+        if self.pool is None:
+            import multiprocessing
+            self.pool = multiprocessing.Pool(self.workers, _initPageWorker, (self.key,))
+        for msg in self.pool.imap(_decryptPageTask, pages, 16):
+            outpages.write(msg)
+
+
+# the plain text of one EncryptedPage, passed to write in one or more parts
+def decryptpage(key, ct, civ, decompress, write):
+    aes = AES.new(key[:16], AES.MODE_CBC, civ[:16])
+    msg = pkcs7unpad(aes.decrypt(ct), 16)
+
+    if not decompress:
+        write(msg)
+        return
+
+    _assert(msg[0] == b"\x00", "LZMA UseFilter not supported")
+    decompresspage(msg, write)
+
+
+# compressed bytes fed to the LZMA decompressor at a time
+LZMA_CHUNK = 0x10000
+# output buffer of the calibre decompressor when the page size is unknown,
+# and the largest one allocated otherwise
+LZMA_BUFFER = 0x10000
+LZMA_MAX_BUFFER = 0x1000000
+
+# a file-like object passing what is written to it on to write
+class PageWriter(object):
+    def __init__(self, write):
+        self.write = write
+
+
+# Decompresses the LZMA "alone" stream that follows the filter byte of msg,
+# writing the output in chunks as it is produced. The stream header holds
+# the uncompressed size (-1 when unknown), which sizes the output buffer.
+def decompresspage(msg, write):
+    _assert(len(msg) >= 14, "Truncated LZMA header")
+    (props, dictsize, size) = struct.unpack_from(b"<BIq", msg, 1)
+
+    if calibre_lzma is not None:
+        if size < 0:
+            bufsize = LZMA_BUFFER
+        else:
+            bufsize = max(1, min(size, LZMA_MAX_BUFFER))
+        # the decompressor hands each output buffer to outfile.write
+        calibre_lzma.decompress(msg[1:], outfile=PageWriter(write), bufsize=bufsize)
+        return
+
+    decomp = lzma.LZMADecompressor(format=lzma.FORMAT_ALONE)
+    pos = 1
+    while pos < len(msg) and not decomp.eof:
+        segment = decomp.decompress(msg[pos:pos + LZMA_CHUNK])
+        pos += LZMA_CHUNK
+        if segment:
+            write(segment)
+    if not decomp.eof:
+        # Contents may still be buffered after the last of the input
+        segment = decomp.decompress(b"")
+        if segment:
+            write(segment)
+    _assert(decomp.eof, "Truncated LZMA page")
+
+
+# worker process side of DrmIon.processpages
+_pageKey = None
+
+def _initPageWorker(key):
+    global _pageKey
+    _pageKey = key
+
+def _decryptPageTask(page):
+    (ct, civ, decompress) = page
+    parts = []
+    decryptpage(_pageKey, ct, civ, decompress, parts.append)
+    return b"".join(parts)
@@ -10,11 +10,16 @@ import re
 from struct import pack
 from struct import unpack
 
+if 'calibre' in sys.modules:
+    from calibre_plugins.dedrm import convert2xml
+else:
+    import convert2xml
+
 debug = False
 
 class DocParser(object):
     def __init__(self, flatxml, fontsize, ph, pw):
-        self.flatdoc = flatxml.split('\n')
+        self.doc = convert2xml.getFlatDoc(flatxml)
         self.fontsize = int(fontsize)
         self.ph = int(ph) * 1.0
         self.pw = int(pw) * 1.0
@@ -49,39 +54,12 @@ class DocParser(object):
 
     # find tag if within pos to end inclusive
     def findinDoc(self, tagpath, pos, end) :
-        result = None
-        docList = self.flatdoc
-        cnt = len(docList)
-        if end == -1 :
-            end = cnt
-        else:
-            end = min(cnt,end)
-        foundat = -1
-        for j in xrange(pos, end):
-            item = docList[j]
-            if item.find('=') >= 0:
-                (name, argres) = item.split('=',1)
-            else :
-                name = item
-                argres = ''
-            if name.endswith(tagpath) :
-                result = argres
-                foundat = j
-                break
-        return foundat, result
+        return self.doc.findinDoc(tagpath, pos, end)
 
 
     # return list of start positions for the tagpath
     def posinDoc(self, tagpath):
-        startpos = []
-        pos = 0
-        res = ""
-        while res != None :
-            (foundpos, res) = self.findinDoc(tagpath, pos, -1)
-            if res != None :
-                startpos.append(foundpos)
-            pos = foundpos + 1
-        return startpos
+        return self.doc.posinDoc(tagpath)
 
     # returns a vector of integers for the tagpath
     def getData(self, tagpath, pos, end, clean=False):
@@ -89,6 +67,8 @@ class DocParser(object):
             digits_only = re.compile(r'''([0-9]+)''')
         argres=[]
         (foundat, argt) = self.findinDoc(tagpath, pos, end)
+        if (argt != None) and not clean:
+            return self.doc.getInts(foundat)
         if (argt != None) and (len(argt) > 0) :
             argList = argt.split('|')
             for strval in argList:
@@ -7,12 +7,18 @@
 # Changelog
 #  4.9  - moved unicode_argv call inside main for Windows DeDRM compatibility
 #  5.0  - Fixed potential unicode problem with command line interface
+#  5.1  - Keep extracted records and generated files in memory, no temporary directory
+#  5.2  - Optionally render the pages with a pool of worker processes (-j)
+#  5.3  - Share the encoded number decoder with convert2xml
+#  5.4  - Optional glyph atlas output (--glyph-atlas)
+#  5.5  - Set up the book key cipher context once, decrypt each section in one batch
+#  5.6  - Count the PIDs tried for instrument.py
 
-__version__ = '5.0'
+__version__ = '5.6'
 
 import sys
 import os, csv, getopt
-import zlib, zipfile, tempfile, shutil
+import zlib, zipfile
 import traceback
 from struct import pack
 from struct import unpack
@@ -79,50 +85,31 @@ debug = False
 if 'calibre' in sys.modules:
     inCalibre = True
     from calibre_plugins.dedrm import kgenpids
+    from calibre_plugins.dedrm import convert2xml
+    from calibre_plugins.dedrm import instrument
 else:
     inCalibre = False
     import kgenpids
+    import convert2xml
+    import instrument
 
 
 class DrmException(Exception):
     pass
 
 
-# recursive zip creation support routine
-def zipUpDir(myzip, tdir, localname):
-    currentdir = tdir
-    if localname != u"":
-        currentdir = os.path.join(currentdir,localname)
-    list = os.listdir(currentdir)
-    for file in list:
-        afilename = file
-        localfilePath = os.path.join(localname, afilename)
-        realfilePath = os.path.join(currentdir,file)
-        if os.path.isfile(realfilePath):
-            myzip.write(realfilePath, localfilePath)
-        elif os.path.isdir(realfilePath):
-            zipUpDir(myzip, tdir, localfilePath)
+# zip up one directory of the in memory book files
+def zipUpDir(myzip, files, localname):
+    for filename in files.listdir(localname):
+        localfilePath = localname + u"/" + filename
+        myzip.writestr(localfilePath, files.read(localfilePath))
 
 #
 # Utility routines
 #
 
-# Get a 7 bit encoded number from file
-def bookReadEncodedNumber(fo):
-    flag = False
-    data = ord(fo.read(1))
-    if data == 0xFF:
-        flag = True
-        data = ord(fo.read(1))
-    if data >= 0x80:
-        datax = (data & 0x7F)
-        while data >= 0x80 :
-            data = ord(fo.read(1))
-            datax = (datax <<7) + (data & 0x7F)
-        data = datax
-    if flag:
-        data = -data
-    return data
+# Get a 7 bit encoded number from file, same encoding as the book records
+bookReadEncodedNumber = convert2xml.readEncodedNumber
 
 # Get a length prefixed string from file
 def bookReadString(fo):
@@ -147,6 +134,10 @@ def topazCryptoInit(key):
 # decrypt data with the context prepared by topazCryptoInit()
 def topazCryptoDecrypt(data, ctx):
     return Topaz_Cipher().decrypt(data, ctx)
+
+# decrypt a list of records, each with the context prepared by topazCryptoInit()
+def topazCryptoDecryptRecords(records, ctx):
+    return Topaz_Cipher().decrypt_records(records, ctx)
 #     ctx1 = ctx[0]
 #     ctx2 = ctx[1]
 #     plainText = ""
@@ -196,12 +187,13 @@ def decryptDkeyRecords(data,PID):
 class TopazBook:
     def __init__(self, filename):
         self.fo = file(filename, 'rb')
-        self.outdir = tempfile.mkdtemp()
-        # self.outdir = 'rawdat'
+        # genbook.BookFiles holding the records and the generated book
+        self.files = None
         self.bookPayloadOffset = 0
         self.bookHeaderRecords = {}
         self.bookMetadata = {}
         self.bookKey = None
+        self.bookKeyCtx = None
         magic = unpack('4s',self.fo.read(4))[0]
         if magic != 'TPZ0':
             raise DrmException(u"Parse Error : Invalid Header, not a Topaz file")
@@ -270,10 +262,54 @@ class TopazBook:
 
     def setBookKey(self, key):
         self.bookKey = key
+        # every record is decrypted from this same starting context
+        self.bookKeyCtx = topazCryptoInit(key)
 
     def getBookPayloadRecord(self, name, index):
         # Get a record in the book payload, given its name and index.
         # decrypted and decompressed if necessary
+        record, encrypted, compressed = self.readBookPayloadRecord(name, index)
+
+        if encrypted:
+            record = topazCryptoDecrypt(record, self.getBookKeyCtx())
+
+        if compressed:
+            record = zlib.decompress(record)
+
+        return record
+
+    def getBookPayloadRecords(self, name):
+        # Get all the records of a name in the book payload, in index order,
+        # decrypting the encrypted ones in one batch
+        records = []
+        encrypted = []
+        compressed = []
+        for index in range(0, len(self.bookHeaderRecords[name])):
+            record, isencrypted, iscompressed = self.readBookPayloadRecord(name, index)
+            records.append(record)
+            compressed.append(iscompressed)
+            if isencrypted:
+                encrypted.append(index)
+
+        if len(encrypted) > 0:
+            plain = topazCryptoDecryptRecords([records[index] for index in encrypted], self.getBookKeyCtx())
+            for index, record in zip(encrypted, plain):
+                records[index] = record
+
+        for index in range(0, len(records)):
+            if compressed[index]:
+                records[index] = zlib.decompress(records[index])
+
+        return records
+
+    def getBookKeyCtx(self):
+        if not self.bookKey:
+            raise DrmException("Error: Attempt to decrypt without bookKey")
+        return self.bookKeyCtx
+
+    def readBookPayloadRecord(self, name, index):
+        # Read a record in the book payload as stored, given its name and index.
+        # returns the record and whether it is encrypted and compressed
         encrypted = False
         compressed = False
         try:
@@ -301,35 +337,26 @@ class TopazBook:
         else:
             record = self.fo.read(self.bookHeaderRecords[name][index][1])
 
-        if encrypted:
-            if self.bookKey:
-                ctx = topazCryptoInit(self.bookKey)
-                record = topazCryptoDecrypt(record,ctx)
-            else :
-                raise DrmException("Error: Attempt to decrypt without bookKey")
-
-        if compressed:
-            record = zlib.decompress(record)
-
-        return record
+        return record, encrypted, compressed
 
-    def processBook(self, pidlst):
+    def processBook(self, pidlst, workers=0, glyphatlas=False):
         raw = 0
         fixedimage=True
+        if inCalibre:
+            from calibre_plugins.dedrm import genbook
+        else:
+            import genbook
+
         try:
             keydata = self.getBookPayloadRecord('dkey', 0)
         except DrmException, e:
             print u"no dkey record found, book may not be encrypted"
             print u"attempting to extrct files without a book key"
-            self.createBookDirectory()
+            self.files = genbook.BookFiles()
             self.extractFiles()
             print u"Successfully Extracted Topaz contents"
-            if inCalibre:
-                from calibre_plugins.dedrm import genbook
-            else:
-                import genbook
 
-            rv = genbook.generateBook(self.outdir, raw, fixedimage)
+            rv = genbook.generateBook(None, raw, fixedimage, self.files, workers, glyphatlas)
             if rv == 0:
                 print u"Book Successfully generated."
             return rv
@@ -340,6 +367,7 @@ class TopazBook:
             # use 8 digit pids here
             pid = pid[0:8]
             print u"Trying: {0}".format(pid)
+            instrument.recorder.count('key attempts')
             bookKeys = []
             data = keydata
             try:
@@ -355,39 +383,16 @@ class TopazBook:
             raise DrmException(u"No key found in {0:d} keys tried. Read the FAQs at Harper's repository: https://github.com/apprenticeharper/DeDRM_tools/blob/master/FAQs.md".format(len(pidlst)))
 
         self.setBookKey(bookKey)
-        self.createBookDirectory()
-        self.extractFiles() 
+        self.files = genbook.BookFiles()
+        self.extractFiles()
         print u"Successfully Extracted Topaz contents"
-        if inCalibre:
-            from calibre_plugins.dedrm import genbook
-        else:
-            import genbook
 
-        rv = genbook.generateBook(self.outdir, raw, fixedimage)
+        rv = genbook.generateBook(None, raw, fixedimage, self.files, workers, glyphatlas)
         if rv == 0:
             print u"Book Successfully generated"
         return rv
 
-    def createBookDirectory(self):
-        outdir = self.outdir
-        # create output directory structure
-        if not os.path.exists(outdir):
-            os.makedirs(outdir)
-        destdir =  os.path.join(outdir,u"img")
-        if not os.path.exists(destdir):
-            os.makedirs(destdir)
-        destdir =  os.path.join(outdir,u"color_img")
-        if not os.path.exists(destdir):
-            os.makedirs(destdir)
-        destdir =  os.path.join(outdir,u"page")
-        if not os.path.exists(destdir):
-            os.makedirs(destdir)
-        destdir =  os.path.join(outdir,u"glyphs")
-        if not os.path.exists(destdir):
-            os.makedirs(destdir)
-
     def extractFiles(self):
-        outdir = self.outdir
         for headerRecord in self.bookHeaderRecords:
             name = headerRecord
             if name != 'dkey':
@@ -395,32 +400,32 @@ class TopazBook:
                 if name == 'img': ext = u".jpg"
                 if name == 'color' : ext = u".jpg"
                 print u"Processing Section: {0}\n. . .".format(name),
-                for index in range (0,len(self.bookHeaderRecords[name])) :
+                destdir = u""
+                if name == 'img':
+                    destdir = u"img/"
+                if name == 'color':
+                    destdir = u"color_img/"
+                if name == 'page':
+                    destdir = u"page/"
+                if name == 'glyphs':
+                    destdir = u"glyphs/"
+                records = self.getBookPayloadRecords(name)
+                for index in range (0,len(records)) :
                     fname = u"{0}{1:04d}{2}".format(name,index,ext)
-                    destdir = outdir
-                    if name == 'img':
-                        destdir =  os.path.join(outdir,u"img")
-                    if name == 'color':
-                        destdir =  os.path.join(outdir,u"color_img")
-                    if name == 'page':
-                        destdir =  os.path.join(outdir,u"page")
-                    if name == 'glyphs':
-                        destdir =  os.path.join(outdir,u"glyphs")
-                    outputFile = os.path.join(destdir,fname)
                     print u".",
-                    record = self.getBookPayloadRecord(name,index)
+                    record = records[index]
                     if record != '':
-                        file(outputFile, 'wb').write(record)
+                        self.files.write(destdir + fname, record)
                 print u" "
 
     def getFile(self, zipname):
         htmlzip = zipfile.ZipFile(zipname,'w',zipfile.ZIP_DEFLATED, False)
-        htmlzip.write(os.path.join(self.outdir,u"book.html"),u"book.html")
-        htmlzip.write(os.path.join(self.outdir,u"book.opf"),u"book.opf")
-        if os.path.isfile(os.path.join(self.outdir,u"cover.jpg")):
-            htmlzip.write(os.path.join(self.outdir,u"cover.jpg"),u"cover.jpg")
-        htmlzip.write(os.path.join(self.outdir,u"style.css"),u"style.css")
-        zipUpDir(htmlzip, self.outdir, u"img")
+        htmlzip.writestr(u"book.html", self.files.read(u"book.html"))
+        htmlzip.writestr(u"book.opf", self.files.read(u"book.opf"))
+        if u"cover.jpg" in self.files:
+            htmlzip.writestr(u"cover.jpg", self.files.read(u"cover.jpg"))
+        htmlzip.writestr(u"style.css", self.files.read(u"style.css"))
+        zipUpDir(htmlzip, self.files, u"img")
         htmlzip.close()
 
     def getBookType(self):
@@ -431,19 +436,18 @@ class TopazBook:
 
     def getSVGZip(self, zipname):
         svgzip = zipfile.ZipFile(zipname,'w',zipfile.ZIP_DEFLATED, False)
-        svgzip.write(os.path.join(self.outdir,u"index_svg.xhtml"),u"index_svg.xhtml")
-        zipUpDir(svgzip, self.outdir, u"svg")
-        zipUpDir(svgzip, self.outdir, u"img")
+        svgzip.writestr(u"index_svg.xhtml", self.files.read(u"index_svg.xhtml"))
+        zipUpDir(svgzip, self.files, u"svg")
+        zipUpDir(svgzip, self.files, u"img")
         svgzip.close()
 
     def cleanup(self):
-        if os.path.isdir(self.outdir):
-            shutil.rmtree(self.outdir, True)
+        self.files = None
 
 def usage(progname):
     print u"Removes DRM protection from Topaz ebooks and extracts the contents"
     print u"Usage:"
-    print u"    {0} [-k <kindle.k4i>] [-p <comma separated PIDs>] [-s <comma separated Kindle serial numbers>] <infile> <outdir>".format(progname)
+    print u"    {0} [-k <kindle.k4i>] [-p <comma separated PIDs>] [-s <comma separated Kindle serial numbers>] [-j <workers>] [--glyph-atlas] <infile> <outdir>".format(progname)
 
 # Main
 def cli_main():
@@ -452,7 +456,7 @@ def cli_main():
     print u"TopazExtract v{0}.".format(__version__)
 
     try:
-        opts, args = getopt.getopt(argv[1:], "k:p:s:x")
+        opts, args = getopt.getopt(argv[1:], "k:p:s:j:x", ["glyph-atlas"])
     except getopt.GetoptError, err:
         print u"Error in options or arguments: {0}".format(err.args[0])
         usage(progname)
@@ -474,6 +478,8 @@ def cli_main():
     kDatabaseFiles = []
     serials = []
     pids = []
+    workers = 0
+    glyphatlas = False
 
     for o, a in opts:
         if o == '-k':
@@ -488,6 +494,10 @@ def cli_main():
             if a == None :
                 raise DrmException("Invalid parameter for -s")
             serials = [serial.replace(" ","") for serial in a.split(',')]
+        if o == '-j':
+            workers = int(a)
+        if o == '--glyph-atlas':
+            glyphatlas = True
 
     bookname = os.path.splitext(os.path.basename(infile))[0]
 
@@ -499,7 +509,7 @@ def cli_main():
 
     try:
         print u"Decrypting Book"
-        tb.processBook(pids)
+        tb.processBook(pids, workers, glyphatlas)
 
         print u"   Creating HTML ZIP Archive"
         zipname = os.path.join(outdir, bookname + u"_nodrm.htmlz")
@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# bench_engines.py
+# Times every decryption engine end to end on synthetic books.
+
+"""
+Decrypts a synthetic book with known keys with each of the DeDRM
+engines: mobidedrm, topazextract, ineptepub, ignobleepub, ineptpdf
+(with an RC4 and an AES book), kfxdedrm, erdr2pml and obok.  Each is
+timed stage by stage (opening the book, finding the key, decrypting,
+writing the output) where its interface allows, and its output is
+checked against the plain text.  When more than one engine is run,
+each runs in a fresh interpreter and reports its own peak memory.
+
+Usage: bench_engines.py [scale [engine ...]]
+"""
+
+import base64
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import zipfile
+
+import benchutil
+import fixtures
+
+# obok is a standalone tool, outside the calibre plugin
+OBOK_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                         os.pardir, 'Other_Tools', 'Kobo'))
+
+
+def write_file(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+    return path
+
+
+def check_zip(path, files):
+    with zipfile.ZipFile(path, 'r') as zf:
+        for name, data in files.items():
+            assert zf.read(name) == data, name
+
+
+def bench_mobidedrm(tmpdir, scale):
+    import mobidedrm
+    book, plain = fixtures.make_mobi_book(nrecords=100 * scale)
+    inpath = write_file(os.path.join(tmpdir, 'book.mobi'), book)
+    outpath = os.path.join(tmpdir, 'book_nodrm.mobi')
+    state = {}
+
+    def open_book():
+        state['book'] = mobidedrm.MobiBook(inpath)
+
+    result = benchutil.report_stages('mobidedrm', len(book), [
+        ('open', open_book),
+        ('find key and decrypt', lambda: state['book'].processBook([mobidedrm.checksumPid('ABCDEFGH')])),
+        ('write', lambda: state['book'].getFile(outpath))])
+    with open(outpath, 'rb') as f:
+        assert plain in f.read()
+    return result
+
+
+def bench_topazextract(tmpdir, scale):
+    import topazextract
+    book = fixtures.make_topaz_book(npages=10 * scale)
+    inpath = write_file(os.path.join(tmpdir, 'book.tpz'), book)
+    outpath = os.path.join(tmpdir, 'book_nodrm.htmlz')
+    state = {}
+
+    def open_book():
+        state['book'] = topazextract.TopazBook(inpath)
+
+    def process():
+        assert state['book'].processBook(['ABCDEFGH']) == 0
+
+    result = benchutil.report_stages('topazextract', len(book), [
+        ('open', open_book),
+        ('find key, decrypt and convert', process),
+        ('write', lambda: state['book'].getFile(outpath))])
+    state['book'].cleanup()
+    with zipfile.ZipFile(outpath, 'r') as zf:
+        assert 'book.html' in zf.namelist()
+    return result
+
+
+def bench_ineptepub(tmpdir, scale):
+    import ineptepub
+    key = fixtures.RSAKey()
+    book, files = fixtures.make_adept_epub(key, nchapters=10 * scale)
+    inpath = write_file(os.path.join(tmpdir, 'adept.epub'), book)
+    outpath = os.path.join(tmpdir, 'adept_nodrm.epub')
+
+    def decrypt():
+        assert ineptepub.decryptBook(key.der, inpath, outpath) == 0
+
+    result = benchutil.report_stages('ineptepub', len(book), [('decrypt and write', decrypt)])
+    check_zip(outpath, files)
+    return result
+
+
+def bench_ignobleepub(tmpdir, scale):
+    import ignobleepub
+    userkey = 'B&N user key 16b'
+    book, files = fixtures.make_ignoble_epub(userkey, nchapters=10 * scale)
+    inpath = write_file(os.path.join(tmpdir, 'ignoble.epub'), book)
+    outpath = os.path.join(tmpdir, 'ignoble_nodrm.epub')
+
+    def decrypt():
+        assert ignobleepub.decryptBook(base64.b64encode(userkey), inpath, outpath) == 0
+
+    result = benchutil.report_stages('ignobleepub', len(book), [('decrypt and write', decrypt)])
+    check_zip(outpath, files)
+    return result
+
+
+def bench_ineptpdf(tmpdir, scale):
+    import ineptpdf
+    key = fixtures.RSAKey()
+    book = fixtures.make_ebx_pdf(key, npages=20 * scale, imagesize=20000)
+    inpath = write_file(os.path.join(tmpdir, 'adept.pdf'), book)
+    outpath = os.path.join(tmpdir, 'adept_nodrm.pdf')
+
+    def decrypt():
+        assert ineptpdf.decryptBook(key.der, inpath, outpath) == 0
+
+    return benchutil.report_stages('ineptpdf', len(book), [('decrypt and write', decrypt)])
+
+
+def bench_ineptpdf_aes(tmpdir, scale):
+    import ineptpdf
+    book = fixtures.make_aps_pdf(npages=20 * scale, imagesize=20000)
+    inpath = write_file(os.path.join(tmpdir, 'aps.pdf'), book)
+    outpath = os.path.join(tmpdir, 'aps_nodrm.pdf')
+
+    def decrypt():
+        # Adobe.APS books need no user key
+        assert ineptpdf.decryptBook(None, inpath, outpath) == 0
+
+    return benchutil.report_stages('ineptpdf (AES)', len(book), [('decrypt and write', decrypt)])
+
+
+def bench_kfxdedrm(tmpdir, scale):
+    import kfxdedrm
+    book, files = fixtures.make_kfx_zip('K' * 16, npages=500 * scale, pagesize=1024, nfiles=2)
+    inpath = write_file(os.path.join(tmpdir, 'book.kfx-zip'), book)
+    outpath = os.path.join(tmpdir, 'book_nodrm.kfx-zip')
+    state = {}
+
+    def open_book():
+        state['book'] = kfxdedrm.KFXZipBook(inpath)
+
+    result = benchutil.report_stages('kfxdedrm', len(book), [
+        ('open', open_book),
+        ('find voucher and key', lambda: state['book'].processBook([])),
+        ('decrypt and write', lambda: state['book'].getFile(outpath))])
+    check_zip(outpath, files)
+    return result
+
+
+def bench_erdr2pml(tmpdir, scale):
+    import erdr2pml
+    userkey = erdr2pml.getuser_key('Synthetic Reader', '4111111111111111')
+    book, plain = fixtures.make_ereader_pdb(userkey, npages=20 * scale)
+    inpath = write_file(os.path.join(tmpdir, 'book.pdb'), book)
+    state = {}
+
+    def open_book():
+        state['sect'] = erdr2pml.Sectionizer(inpath, 'PNRdPPrs')
+
+    def find_key():
+        state['reader'] = erdr2pml.EreaderProcessor(state['sect'], userkey)
+
+    def decrypt():
+        state['text'] = state['reader'].getText()
+
+    result = benchutil.report_stages('erdr2pml', len(book), [
+        ('open', open_book),
+        ('find key', find_key),
+        ('decrypt', decrypt)])
+    assert state['text'] == plain
+    return result
+
+
+def bench_obok(tmpdir, scale):
+    if OBOK_DIR not in sys.path:
+        sys.path.insert(0, OBOK_DIR)
+    import obok
+    userkey = 'kobo user key 16'
+    book, rows, files = fixtures.make_kobo_kepub(userkey, nchapters=10 * scale)
+    inpath = write_file(os.path.join(tmpdir, 'volume0'), book)
+    db = sqlite3.connect(':memory:')
+    db.execute('CREATE TABLE content (contentid TEXT)')
+    db.execute('CREATE TABLE content_keys (volumeid TEXT, elementid TEXT, elementkey TEXT)')
+    db.execute('INSERT INTO content VALUES (?)', ('volume0',))
+    db.executemany('INSERT INTO content_keys VALUES (?, ?, ?)', rows)
+
+    class Library(object):
+        userkeys = [userkey]
+
+    state = {}
+
+    def find_keys():
+        state['book'] = obok.KoboBook('volume0', u'Synthetic Kepub', inpath, 'kepub', db.cursor())
+        assert len(state['book'].encryptedfiles) == len(rows)
+
+    def decrypt():
+        # obok writes the book to the current directory
+        cwd = os.getcwd()
+        os.chdir(tmpdir)
+        try:
+            assert obok.decrypt_book(state['book'], Library()) == 0
+        finally:
+            os.chdir(cwd)
+
+    result = benchutil.report_stages('obok', len(book), [
+        ('find keys', find_keys),
+        ('decrypt and write', decrypt)])
+    check_zip(os.path.join(tmpdir, 'Synthetic Kepub.epub'), files)
+    return result
+
+
+ENGINES = [('mobidedrm', bench_mobidedrm), ('topazextract', bench_topazextract),
+           ('ineptepub', bench_ineptepub), ('ignobleepub', bench_ignobleepub),
+           ('ineptpdf', bench_ineptpdf), ('ineptpdf_aes', bench_ineptpdf_aes),
+           ('kfxdedrm', bench_kfxdedrm), ('erdr2pml', bench_erdr2pml),
+           ('obok', bench_obok)]
+
+
+def main():
+    scale = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    names = sys.argv[2:] or [name for (name, bench) in ENGINES]
+    if len(names) > 1:
+        return run_engines(scale, names)
+    results = []
+    for name, bench in ENGINES:
+        if name not in names:
+            continue
+        tmpdir = tempfile.mkdtemp()
+        try:
+            results.append(bench(tmpdir, scale))
+        except ImportError, e:
+            # some engines need modules that are not always installed
+            print u"{0}: not available: {1}".format(name, e)
+        finally:
+            shutil.rmtree(tmpdir)
+    return results
+
+
+def run_engines(scale, names):
+    # one fresh interpreter per engine, so that its peak resident set
+    # size is its own rather than the largest of all of them
+    import run_benchmarks
+    results = []
+    for name, bench in ENGINES:
+        if name not in names:
+            continue
+        result = run_benchmarks.run_benchmark('bench_engines', [str(scale), name])
+        if 'error' in result:
+            print u"{0} failed: {1}".format(name, result['error'])
+            results.append({'name': name, 'error': result['error']})
+            continue
+        for engine in result['results']:
+            engine['peak_rss_kb'] = result['peak_rss_kb']
+            print u"{0}: peak RSS {1:d} kB".format(engine['name'], engine['peak_rss_kb'])
+            results.append(engine)
+    return results
+
+
+if __name__ == '__main__':
+    main()
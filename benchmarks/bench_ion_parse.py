@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# bench_ion_parse.py
+# Measures how fast ion parses a DRMION envelope.
+
+"""
+Walks the pages of a synthetic DRMION envelope with the generic
+BinaryIonParser state machine and with the container scan DrmIon.parse
+uses, then times a complete DrmIon.parse including the AES decryption
+of the pages, in process and with a pool of worker processes, and
+checks the decrypted text.
+"""
+
+import multiprocessing
+import sys
+from cStringIO import StringIO
+
+import benchutil
+import fixtures
+import ion
+
+SECRETKEY = 'K' * 16
+
+
+class Voucher(object):
+    secretkey = SECRETKEY
+
+
+def step_envelope(doc):
+    # stepping through every value, as DrmIon.parse used to do
+    parser = ion.BinaryIonParser(doc)
+    ion.addprottable(parser)
+    parser.next()
+    parser.next()
+    parser.stepin()
+    npages = 0
+    while parser.hasnext():
+        parser.next()
+        if parser.gettypename() != "com.amazon.drm.EncryptedPage@1.0":
+            continue
+        parser.stepin()
+        while parser.hasnext():
+            parser.next()
+            parser.lobvalue()
+        parser.stepout()
+        npages += 1
+    return npages
+
+
+def scan_envelope(doc):
+    drmion = ion.DrmIon(doc, lambda name: Voucher)
+    drmion.processpage = lambda ct, civ, outpages, decompress: outpages.append(ct)
+    pages = []
+    drmion.parse(pages)
+    return len(pages)
+
+
+def main():
+    npages = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    pagesize = int(sys.argv[2]) if len(sys.argv) > 2 else 256
+    workers = int(sys.argv[3]) if len(sys.argv) > 3 else multiprocessing.cpu_count()
+    doc, plain = fixtures.make_drmion(SECRETKEY, npages, pagesize)
+    print u"input: {0:d} pages of {1:d} bytes, {2:d} bytes of ION".format(npages, pagesize, len(doc))
+
+    results = []
+    t, count = benchutil.best_time(lambda: step_envelope(doc))
+    assert count == npages
+    results.append(benchutil.report('step through envelope', len(doc), t))
+    t, count = benchutil.best_time(lambda: scan_envelope(doc))
+    assert count == npages
+    results.append(benchutil.report('scan envelope', len(doc), t))
+
+    def parse(workers):
+        out = StringIO()
+        ion.DrmIon(doc, lambda name: Voucher, workers).parse(out)
+        return out.getvalue()
+
+    t, text = benchutil.best_time(lambda: parse(0))
+    assert text == plain
+    results.append(benchutil.report('DrmIon.parse (with decryption)', len(doc), t))
+    t, text = benchutil.best_time(lambda: parse(workers))
+    assert text == plain
+    results.append(benchutil.report('DrmIon.parse, {0:d} workers'.format(workers), len(doc), t))
+    return results
+
+
+if __name__ == '__main__':
+    main()
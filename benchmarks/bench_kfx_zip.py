@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# bench_kfx_zip.py
+# Measures decrypting a whole .kfx-zip archive with kfxdedrm.
+
+"""
+Decrypts a synthetic .kfx-zip archive with kfxdedrm.KFXZipBook, from
+processBook to the output archive written by getFile, checks every
+entry of the output and reports the peak memory of a fresh process
+doing only the decryption.
+"""
+
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import zipfile
+
+import benchutil
+import fixtures
+import kfxdedrm
+
+SECRETKEY = 'K' * 16
+
+
+def decrypt(infile, outfile):
+    book = kfxdedrm.KFXZipBook(infile)
+    book.processBook([])
+    book.getFile(outfile)
+
+
+def peak_memory(infile, outfile):
+    # run in a new interpreter, so the fixture does not count
+    output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--decrypt', infile, outfile])
+    return int(output.splitlines()[-1])
+
+
+def main():
+    npages = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    pagesize = int(sys.argv[2]) if len(sys.argv) > 2 else 4096
+    nfiles = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+    data, expected = fixtures.make_kfx_zip(SECRETKEY, npages=npages, pagesize=pagesize, nfiles=nfiles)
+    print u"input: {0:d} DRMION files of {1:d} pages of {2:d} bytes, {3:d} bytes".format(nfiles, npages, pagesize, len(data))
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        infile = os.path.join(tmpdir, 'book.kfx-zip')
+        outfile = os.path.join(tmpdir, 'book_nodrm.kfx-zip')
+        with open(infile, 'wb') as f:
+            f.write(data)
+        del data
+
+        results = []
+        t, _ = benchutil.best_time(lambda: decrypt(infile, outfile))
+        result = benchutil.report('KFXZipBook processBook and getFile', os.path.getsize(infile), t)
+        result['peak_rss_kb'] = peak_memory(infile, outfile)
+        print u"{0:<40s} {1:>10d} kB peak memory".format('', result['peak_rss_kb'])
+        results.append(result)
+
+        with zipfile.ZipFile(outfile, 'r') as zf:
+            for name, plain in expected.items():
+                assert zf.read(name) == plain
+    finally:
+        shutil.rmtree(tmpdir)
+    return results
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--decrypt']:
+        decrypt(sys.argv[2], sys.argv[3])
+        print resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    else:
+        main()
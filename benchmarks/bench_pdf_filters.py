@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# bench_pdf_filters.py
+# Micro-benchmarks for the stream filters of ineptpdf.
+
+"""
+Times the LZW, ASCII85 and predictor decoders of ineptpdf on
+synthetic data, and checks that they round-trip.
+"""
+
+import random
+import struct
+import sys
+
+import benchutil
+import ineptpdf
+
+
+def lzwencode(data):
+    # Plain PDF LZW encoder (EarlyChange 1), used to build fixtures.
+    table = dict((chr(i), i) for i in xrange(256))
+    out = []
+    bitbuf = nbits = 0
+    width = 9
+    def emit(code):
+        out.append((code, width))
+    emit(ineptpdf.LZW_CLEAR)
+    prefix = ''
+    for c in data:
+        s = prefix + c
+        if s in table:
+            prefix = s
+            continue
+        emit(table[prefix])
+        table[s] = len(table) + 2
+        prefix = c
+        if len(table) + 2 >= (1 << width):
+            if width == 12:
+                emit(ineptpdf.LZW_CLEAR)
+                table = dict((chr(i), i) for i in xrange(256))
+                width = 9
+            else:
+                width += 1
+    if prefix:
+        emit(table[prefix])
+    emit(ineptpdf.LZW_EOD)
+    result = bytearray()
+    for (code, w) in out:
+        bitbuf = (bitbuf << w) | code
+        nbits += w
+        while nbits >= 8:
+            nbits -= 8
+            result.append((bitbuf >> nbits) & 255)
+            bitbuf &= (1 << nbits) - 1
+    if nbits:
+        result.append((bitbuf << (8 - nbits)) & 255)
+    return str(result)
+
+
+def ascii85encode(data):
+    out = []
+    pad = -len(data) % 4
+    padded = data + '\0' * pad
+    for i in xrange(0, len(padded), 4):
+        (b,) = struct.unpack('>L', padded[i:i+4])
+        if b == 0 and i + 4 <= len(data):
+            out.append('z')
+            continue
+        group = []
+        for _ in xrange(5):
+            group.append(chr(b % 85 + 33))
+            b //= 85
+        out.append(''.join(reversed(group)))
+        if len(out) % 16 == 0:
+            out.append('\n')
+    if pad:
+        out[-1] = out[-1][:5 - pad]
+    return ''.join(out) + '~>'
+
+
+def pngencode_up(rows):
+    out = []
+    prev = '\0' * len(rows[0])
+    for row in rows:
+        out.append('\x02' + ''.join(chr((ord(a) - ord(b)) & 255) for (a, b) in zip(row, prev)))
+        prev = row
+    return ''.join(out)
+
+
+def sample_text(size):
+    words = ['BT', 'ET', 'Tf', 'Tj', 'TJ', '/F1', '12', '0', 'g', 're', 'f', '(Hello)', 'q', 'Q']
+    rnd = random.Random(42)
+    out = []
+    n = 0
+    while n < size:
+        w = rnd.choice(words)
+        out.append(w)
+        n += len(w) + 1
+    return ' '.join(out)[:size]
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    results = []
+    text = sample_text(size)
+
+    lzw = lzwencode(text)
+    t, decoded = benchutil.best_time(lambda: ineptpdf.lzwdecode(lzw))
+    assert decoded == text
+    results.append(benchutil.report('lzwdecode', len(text), t))
+
+    rnd = random.Random(7)
+    binary = ''.join(chr(rnd.randrange(256)) for _ in xrange(size))
+    a85 = ascii85encode(binary)
+    t, decoded = benchutil.best_time(lambda: ineptpdf.ascii85decode(a85))
+    assert decoded == binary
+    results.append(benchutil.report('ascii85decode', len(binary), t))
+
+    # xref stream style data: 5 byte rows with the Up filter
+    rows = [struct.pack('>BLB', 1, i * 97, 0)[:5] for i in xrange(size // 5)]
+    png = pngencode_up(rows)
+    t, decoded = benchutil.best_time(lambda: ineptpdf.png_unpredict(png, 1, 8, 5))
+    assert decoded == ''.join(rows)
+    results.append(benchutil.report('png_unpredict (Up, 5 columns)', len(decoded), t))
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# bench_pdf_output.py
+# Compares the size and write time of ineptpdf output modes.
+
+"""
+Decrypts a synthetic ADEPT PDF with many small objects, writing it
+with a classic xref table and with objects packed into compressed
+object streams at several zlib levels.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+
+import benchutil
+import fixtures
+import ineptpdf
+
+
+def main():
+    npages = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    key = fixtures.RSAKey()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        inpath = os.path.join(tmpdir, 'in.pdf')
+        with open(inpath, 'wb') as f:
+            f.write(fixtures.make_ebx_pdf(key, npages, imagesize=2000, nstrings=40))
+        print u"input: {0:d} pages, {1:d} bytes".format(npages, os.path.getsize(inpath))
+        results = []
+        for level in (0, 1, 6, 9):
+            outpath = os.path.join(tmpdir, 'out%d.pdf' % level)
+            t, _ = benchutil.best_time(
+                lambda: ineptpdf.decryptBook(key.der, inpath, outpath, pack_level=level))
+            size = os.path.getsize(outpath)
+            name = 'classic xref' if level == 0 else 'object streams, level %d' % level
+            result = benchutil.report(name, size, t)
+            result['output_size'] = size
+            results.append(result)
+        return results
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# bench_pdf_repair.py
+# Measures how fast ineptpdf rebuilds the xref table of a damaged PDF.
+
+"""
+Loads the cross reference table of a synthetic ADEPT PDF as it is, and
+with its startxref offset damaged so that ineptpdf has to rebuild the
+table by scanning the whole file for objects, then decrypts the damaged
+file and checks that the output matches that of the intact one.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+
+import benchutil
+import fixtures
+import ineptpdf
+
+
+# points startxref at the start of the file, where there is no xref
+def damage_xref(data):
+    pos = data.rindex('startxref')
+    return data[:pos] + 'startxref\n0\n%%EOF\n'
+
+
+def load_xref(path):
+    with open(path, 'rb') as f:
+        doc = ineptpdf.PDFDocument()
+        ineptpdf.PDFParser(doc, f)
+        return len(doc.xrefs[0].offsets)
+
+
+def main():
+    npages = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    key = fixtures.RSAKey()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        data = fixtures.make_ebx_pdf(key, npages, imagesize=2000, nstrings=40)
+        inpath = os.path.join(tmpdir, 'in.pdf')
+        with open(inpath, 'wb') as f:
+            f.write(data)
+        badpath = os.path.join(tmpdir, 'damaged.pdf')
+        with open(badpath, 'wb') as f:
+            f.write(damage_xref(data))
+        print u"input: {0:d} pages, {1:d} bytes".format(npages, len(data))
+
+        results = []
+        t, count = benchutil.best_time(lambda: load_xref(inpath))
+        results.append(benchutil.report('read xref table', len(data), t))
+        t, rebuilt = benchutil.best_time(lambda: load_xref(badpath))
+        assert rebuilt >= count - 1, (rebuilt, count)
+        results.append(benchutil.report('rebuild xref table by scanning', len(data), t))
+
+        goodout = os.path.join(tmpdir, 'good.pdf')
+        badout = os.path.join(tmpdir, 'repaired.pdf')
+        ineptpdf.decryptBook(key.der, inpath, goodout)
+        t, _ = benchutil.best_time(lambda: ineptpdf.decryptBook(key.der, badpath, badout))
+        with open(goodout, 'rb') as good, open(badout, 'rb') as bad:
+            assert good.read() == bad.read()
+        results.append(benchutil.report('decrypt damaged PDF', len(data), t))
+        return results
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
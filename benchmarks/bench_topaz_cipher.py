@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# bench_topaz_cipher.py
+# Compares the Topaz cipher backends of alfcrypto.
+
+"""
+Decrypts a set of Topaz book records with the native libalfcrypto
+cipher and with the pure Python fallback, one record at a time and
+in one batch, and checks that all of them agree.
+"""
+
+import sys
+
+import benchutil
+import alfcrypto
+import fixtures
+
+
+BOOKKEY = 'bookkey!'
+
+
+def legacy_decrypt(data, ctx):
+    # The pure Python decrypt loop before the bytearray fast path.
+    ctx1 = ctx[0]
+    ctx2 = ctx[1]
+    plainText = ""
+    for dataChar in data:
+        dataByte = ord(dataChar)
+        m = (dataByte ^ ((ctx1 >> 3) &0xFF) ^ ((ctx2<<3) & 0xFF)) &0xFF
+        ctx2 = ctx1
+        ctx1 = (((ctx1 >> 2) * (ctx1 >> 7)) &0xFFFFFFFF) ^((m * m * 0x0F902007) &0xFFFFFFFF)
+        plainText += chr(m)
+    return plainText
+
+
+def run_backend(label, cipherclass, records, results, expected=None):
+    nbytes = sum(len(record) for record in records)
+
+    def per_record():
+        # a fresh context for every record, as topazextract used to do
+        return [cipherclass().decrypt(record, cipherclass().ctx_init(BOOKKEY)) for record in records]
+
+    def batch():
+        cipher = cipherclass()
+        return cipher.decrypt_records(records, cipher.ctx_init(BOOKKEY))
+
+    t, plain = benchutil.best_time(per_record)
+    if expected is not None:
+        assert plain == expected
+    results.append(benchutil.report(label + ', per record', nbytes, t))
+    t, batched = benchutil.best_time(batch)
+    assert batched == plain
+    results.append(benchutil.report(label + ', batch', nbytes, t))
+    return plain
+
+
+def main():
+    nrecords = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    records = [fixtures.random_bytes(size, seed) for seed in xrange(nrecords)]
+    print u"input: {0:d} records of {1:d} bytes".format(nrecords, size)
+
+    results = []
+    try:
+        native = alfcrypto._load_libalfcrypto()[2]
+    except Exception, e:
+        print u"native cipher not available: {0}".format(e)
+        native = None
+    python = alfcrypto._load_python_alfcrypto()[2]
+
+    expected = None
+    if native is not None:
+        expected = run_backend('native', native, records, results)
+    expected = run_backend('python', python, records, results, expected)
+
+    ctx = python().ctx_init(BOOKKEY)
+    t, plain = benchutil.best_time(lambda: [legacy_decrypt(record, ctx) for record in records])
+    assert plain == expected
+    results.append(benchutil.report('python, string concatenation', sum(len(r) for r in records), t))
+    return results
+
+
+if __name__ == '__main__':
+    main()
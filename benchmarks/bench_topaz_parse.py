@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# bench_topaz_parse.py
+# Measures how fast convert2xml decodes Topaz page records.
+
+"""
+Parses the pages of a synthetic Topaz book with convert2xml.PageParser
+and reports the decoding rate in bytes and in tokens (7 bit encoded
+numbers) per second.
+"""
+
+import sys
+
+import benchutil
+import convert2xml
+import fixtures
+
+# length of the 'p\x00__PAGE_\x00\x00' header of the fixture pages
+PAGE_HEADER = 11
+
+
+def count_tokens(pages):
+    count = 0
+    for data in pages:
+        pos = PAGE_HEADER
+        while pos < len(data):
+            val, pos = convert2xml.decodeNumber(data, pos)
+            count += 1
+    return count
+
+
+def report_tokens(result, ntokens):
+    rate = ntokens / result['seconds'] if result['seconds'] > 0 else float('inf')
+    print u"{0:<40s} {1:>10d} tokens {2:>14.0f} tokens/s".format('', ntokens, rate)
+    result['tokens'] = ntokens
+    result['tokens_per_s'] = rate
+    return result
+
+
+def main():
+    npages = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    sections = fixtures.make_topaz_sections(npages)
+    pages = sections['page']
+    dict = convert2xml.Dictionary('dict0000.dat', sections['dict'][0])
+    nbytes = sum(len(data) for data in pages)
+    ntokens = count_tokens(pages)
+    print u"input: {0:d} pages, {1:d} bytes".format(npages, nbytes)
+
+    def parse():
+        for i, data in enumerate(pages):
+            convert2xml.PageParser('page%04d.dat' % i, dict, False, True, data).parse()
+
+    def getdoc():
+        for i, data in enumerate(pages):
+            convert2xml.getDoc(dict, 'page%04d.dat' % i, data)
+
+    results = []
+    t, _ = benchutil.best_time(parse)
+    results.append(report_tokens(benchutil.report('PageParser.parse', nbytes, t), ntokens))
+    t, _ = benchutil.best_time(getdoc)
+    results.append(report_tokens(benchutil.report('getDoc (parse and flatten)', nbytes, t), ntokens))
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# benchutil.py
+# Shared helpers for the benchmark scripts in this directory.
+
+"""
+Common timing and reporting code for the DeDRM benchmarks.
+"""
+
+import os
+import sys
+import time
+
+# The benchmarks exercise the modules of the calibre plugin directly.
+PLUGIN_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                           os.pardir, 'DeDRM_calibre_plugin', 'DeDRM_plugin'))
+if PLUGIN_DIR not in sys.path:
+    sys.path.insert(0, PLUGIN_DIR)
+
+
+def best_time(func, repeat=3):
+    # Best wall-clock time of several calls, and the last result.
+    best = None
+    result = None
+    for _ in xrange(repeat):
+        start = time.time()
+        result = func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def report(name, nbytes, seconds):
+    rate = nbytes / seconds / 1e6 if seconds > 0 else float('inf')
+    print u"{0:<40s} {1:>10d} bytes {2:>9.4f} s {3:>9.2f} MB/s".format(name, nbytes, seconds, rate)
+    return {'name': name, 'bytes': nbytes, 'seconds': seconds, 'mb_per_s': rate}
+
+
+def time_stages(stages, repeat=3):
+    # Runs the (name, func) stages of a pipeline in order, several times,
+    # and returns the stage times of the fastest run and its total.
+    best = None
+    for _ in xrange(repeat):
+        times = []
+        for name, func in stages:
+            start = time.time()
+            func()
+            times.append((name, time.time() - start))
+        total = sum(t for (name, t) in times)
+        if best is None or total < best[1]:
+            best = (times, total)
+    return best
+
+
+def report_stages(name, nbytes, stages, repeat=3):
+    # report() for a pipeline, with the time of each of its stages.
+    times, total = time_stages(stages, repeat)
+    result = report(name, nbytes, total)
+    for stage, t in times:
+        print u"    {0:<36s} {1:>21.4f} s".format(stage, t)
+    result['stages'] = [{'name': stage, 'seconds': t} for (stage, t) in times]
+    return result
@@ -0,0 +1,859 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# fixtures.py
+# Builds synthetic DRM-protected books with known keys, for benchmarking.
+
+"""
+Synthetic fixtures for the DeDRM benchmarks.  Everything is generated
+offline from a fixed seed, so runs are repeatable.
+"""
+
+import base64
+import hashlib
+import hmac
+import random
+import struct
+import zlib
+
+import benchutil
+import convert2xml
+import ineptpdf
+
+
+# RSA keys, as used by Adobe ADEPT
+
+def _is_probable_prime(n, rnd):
+    if n < 2:
+        return False
+    for p in (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37):
+        if n % p == 0:
+            return n == p
+    d = n - 1
+    s = 0
+    while d % 2 == 0:
+        d //= 2
+        s += 1
+    for _ in xrange(20):
+        x = pow(rnd.randrange(2, n - 1), d, n)
+        if x in (1, n - 1):
+            continue
+        for _ in xrange(s - 1):
+            x = pow(x, 2, n)
+            if x == n - 1:
+                break
+        else:
+            return False
+    return True
+
+
+def _random_prime(bits, rnd):
+    while True:
+        n = rnd.getrandbits(bits) | (1 << (bits - 1)) | 1
+        if _is_probable_prime(n, rnd):
+            return n
+
+
+def _der_length(n):
+    if n < 0x80:
+        return chr(n)
+    s = ('%x' % n)
+    s = ('0' * (len(s) % 2) + s).decode('hex')
+    return chr(0x80 | len(s)) + s
+
+
+def _der_integer(n):
+    s = '%x' % n
+    s = ('0' * (len(s) % 2) + s).decode('hex')
+    if ord(s[0]) & 0x80:
+        s = '\0' + s
+    return '\x02' + _der_length(len(s)) + s
+
+
+def _der_sequence(items):
+    body = ''.join(items)
+    return '\x30' + _der_length(len(body)) + body
+
+
+def _modinv(a, m):
+    # extended Euclid
+    old_r, r = a, m
+    old_s, s = 1, 0
+    while r:
+        q = old_r // r
+        old_r, r = r, old_r - q * r
+        old_s, s = s, old_s - q * s
+    return old_s % m
+
+
+class RSAKey(object):
+    def __init__(self, bits=1024, seed=1):
+        rnd = random.Random(seed)
+        e = 65537
+        while True:
+            p = _random_prime(bits // 2, rnd)
+            q = _random_prime(bits // 2, rnd)
+            phi = (p - 1) * (q - 1)
+            if p != q and phi % e:
+                break
+        self.n = p * q
+        self.e = e
+        self.d = _modinv(e, phi)
+        self.size = (self.n.bit_length() + 7) // 8
+        self.der = _der_sequence([_der_integer(x) for x in
+                                  (0, self.n, e, self.d, p, q, self.d % (p - 1),
+                                   self.d % (q - 1), _modinv(q, p))])
+
+    def encrypt(self, message):
+        # PKCS#1 v1.5 type 2 padding, as ADEPT expects
+        rnd = random.Random(len(message))
+        padlen = self.size - 3 - len(message)
+        padding = ''.join(chr(rnd.randrange(1, 256)) for _ in xrange(padlen))
+        block = '\x00\x02' + padding + '\x00' + message
+        c = pow(int(block.encode('hex'), 16), self.e, self.n)
+        return ('%x' % c).rjust(2 * self.size, '0').decode('hex')
+
+
+def rc4(key, data):
+    # RC4 is symmetric, so the decrypting cipher encrypts as well
+    return ineptpdf.ARC4.new(key).decrypt(data)
+
+
+def random_bytes(size, seed=0):
+    rnd = random.Random(seed)
+    return ''.join(struct.pack('<Q', rnd.getrandbits(64)) for _ in xrange(size // 8 + 1))[:size]
+
+
+def make_ebx_pdf(rsakey, npages=50, imagesize=100000, nstrings=20, bookkey='0123456789abcdef'):
+    '''
+    Returns an ADEPT (EBX_HANDLER) RC4-encrypted PDF with npages pages,
+    each with an image stream of imagesize random bytes, a compressed
+    content stream and nstrings encrypted strings.
+    '''
+    def genkey(objid):
+        key = bookkey + struct.pack('<L', objid)[:3] + struct.pack('<L', 0)[:2]
+        return hashlib.md5(key).digest()[:min(len(bookkey) + 5, 16)]
+    def encrypt(objid, data):
+        return rc4(genkey(objid), data)
+    license = ('<license xmlns="http://ns.adobe.com/adept"><encryptedKey>%s'
+               '</encryptedKey></license>' % base64.b64encode(rsakey.encrypt(bookkey)))
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -15)
+    license = compressor.compress(license) + compressor.flush()
+    return make_encrypted_pdf('<</Filter/EBX_HANDLER/V 2/Length 128/ADEPT_LICENSE(%s)>>'
+                              % base64.b64encode(license), encrypt, npages, imagesize, nstrings)
+
+
+# principal key ineptpdf holds for Adobe.APS books from bibliothek-digital.de
+APS_PRINCIPAL_KEY = base64.b64decode('rRwGv2tbpKov1krvv7PO0ws9S436/lArPlfipz5Pqhw=')
+
+def make_aps_pdf(npages=50, imagesize=100000, nstrings=20, bookkey='0123456789abcdef'):
+    '''
+    Returns an Adobe.APS AES-128-encrypted PDF (V 4, key derived with
+    'sAlT'), laid out as make_ebx_pdf. Its keys are wrapped with the
+    principal key ineptpdf knows, so no user key is needed to decrypt it.
+    '''
+    def genkey(objid):
+        key = bookkey + struct.pack('<L', objid)[:3] + struct.pack('<L', 0)[:2] + 'sAlT'
+        return hashlib.md5(key).digest()[:min(len(bookkey) + 5, 16)]
+    def encrypt(objid, data):
+        iv = random_bytes(16, objid)
+        return iv + aes_cbc_encrypt(genkey(objid), iv, data)
+    policykey = random_bytes(16, 1)
+    policyiv = random_bytes(16, 2)
+    keys = aes_cbc_encrypt(hashlib.sha256(APS_PRINCIPAL_KEY).digest(), '\0' * 16, bookkey + policykey)
+    edcdata = ['0'] * 10
+    edcdata[2] = base64.b64encode(policyiv)
+    edcdata[9] = base64.b64encode(keys)
+    policy = aes_cbc_encrypt(policykey, policyiv, '<policy/>')
+    return make_encrypted_pdf('<</Filter/Adobe.APS/V 4/Length 128/EDCData(%s)/PDRLLic(%s)/PDRLPol(%s)>>'
+                              % (base64.b64encode('\n'.join(edcdata)),
+                                 base64.b64encode('<license issuer="bibliothek-digital.de"/>'),
+                                 base64.b64encode(policy)), encrypt, npages, imagesize, nstrings)
+
+
+def make_encrypted_pdf(encryptdict, encrypt, npages, imagesize, nstrings):
+    # the pages of make_ebx_pdf, with strings and streams encrypted by
+    # encrypt(objid, data) and the given Encrypt dictionary
+    def hexstring(objid, s):
+        return '<%s>' % encrypt(objid, s).encode('hex')
+
+    objs = {}
+    objs[1] = '<</Type/Catalog/Pages 2 0 R>>'
+    kids = []
+    n = 3
+    for p in xrange(npages):
+        (page, content, image) = (n, n + 1, n + 2)
+        n += 3
+        kids.append('%d 0 R' % page)
+        strings = ' '.join(hexstring(page, 'string %d %d' % (p, i)) for i in xrange(nstrings))
+        objs[page] = ('<</Type/Page/Parent 2 0 R/Contents %d 0 R/Names[%s]'
+                      '/Resources<</XObject<</Im0 %d 0 R>>>>>>' % (content, strings, image))
+        data = encrypt(content, zlib.compress(('BT /F1 12 Tf (Hello page %d) Tj ET\n' % p) * 50))
+        objs[content] = ('<</Length %d/Filter/FlateDecode>>' % len(data), data)
+        data = encrypt(image, random_bytes(imagesize, p))
+        objs[image] = ('<</Type/XObject/Subtype/Image/Width 100/Height 100/Length %d>>' % len(data),
+                       data)
+    objs[2] = '<</Type/Pages/Kids[%s]/Count %d>>' % (' '.join(kids), npages)
+    encryptid = n
+    n += 1
+    objs[encryptid] = encryptdict
+
+    out = ['%PDF-1.4\n']
+    pos = len(out[0])
+    offsets = {}
+    for objid in sorted(objs):
+        obj = objs[objid]
+        if isinstance(obj, tuple):
+            s = '%d 0 obj\n%sstream\n%s\nendstream\nendobj\n' % ((objid,) + obj)
+        else:
+            s = '%d 0 obj\n%s\nendobj\n' % (objid, obj)
+        offsets[objid] = pos
+        out.append(s)
+        pos += len(s)
+    out.append('xref\n0 %d\n0000000000 65535 f \n' % n)
+    out.extend('%010d 00000 n \n' % offsets[objid] for objid in xrange(1, n))
+    out.append('trailer\n<</Size %d/Root 1 0 R/Encrypt %d 0 R/ID[<0123><0123>]>>\n'
+               'startxref\n%d\n%%%%EOF\n' % (n, encryptid, pos))
+    return ''.join(out)
+
+
+# Topaz books, as read by topazextract and genbook
+
+def encode_number(n):
+    if n < 0:
+        return '\xff' + encode_number(-n)
+    groups = [n & 0x7F]
+    n >>= 7
+    while n:
+        groups.append((n & 0x7F) | 0x80)
+        n >>= 7
+    if groups[-1] == 0xFF:
+        groups.append(0x80)
+    return ''.join(chr(g) for g in reversed(groups))
+
+
+def encode_string(s):
+    return encode_number(len(s)) + s
+
+
+def topaz_encrypt(key, data):
+    ctx1 = 0x0CAFFE19E
+    for c in key:
+        ctx2 = ctx1
+        ctx1 = ((((ctx1 >> 2) * (ctx1 >> 7)) & 0xFFFFFFFF) ^ (ord(c) * ord(c) * 0x0F902007) & 0xFFFFFFFF)
+    out = []
+    for c in data:
+        m = ord(c)
+        out.append(chr((m ^ ((ctx1 >> 3) & 0xFF) ^ ((ctx2 << 3) & 0xFF)) & 0xFF))
+        ctx2 = ctx1
+        ctx1 = (((ctx1 >> 2) * (ctx1 >> 7)) & 0xFFFFFFFF) ^ ((m * m * 0x0F902007) & 0xFFFFFFFF)
+    return ''.join(out)
+
+
+class TopazEncoder(object):
+    # Writes page, glyph and stylesheet records in the token grammar
+    # that convert2xml.PageParser reads, sharing one string table.
+
+    def __init__(self):
+        self.tags = convert2xml.PageParser.token_tags
+        self.strings = ['', 'info']
+        self.index = {'': 0, 'info': 1}
+
+    def lookup(self, s):
+        if s not in self.index:
+            # indices that the parser treats as markers are kept free
+            while len(self.strings) in (0x72, 0x74, 0x76):
+                self.strings.append('unused%d' % len(self.strings))
+            self.index[s] = len(self.strings)
+            self.strings.append(s)
+        return self.index[s]
+
+    def spec(self, path):
+        parts = path.split('.')
+        for j in xrange(len(parts)):
+            tkn = '.'.join(parts[j:])
+            if tkn in self.tags:
+                return self.tags[tkn]
+        raise KeyError(path)
+
+    def node(self, path, name, subtags=(), args=(), implied=False):
+        num_args, argtype, has_sub, splcase = self.spec(path)
+        out = []
+        if not implied:
+            out.append(encode_number(self.lookup(name)))
+        if has_sub:
+            out.append(encode_number(len(subtags)))
+            for sub in subtags:
+                out.append(self.node(path + '.' + sub[0], *sub))
+        if num_args > 0:
+            if argtype in ('text', 'scalar_text'):
+                args = [self.lookup(a) for a in args]
+            if argtype.startswith('scalar'):
+                out.extend(encode_number(a) for a in args)
+            else:
+                out.append(encode_number(0x76) + encode_number(len(args)) + encode_number(0))
+                out.extend(encode_number(a) for a in args)
+        return ''.join(out)
+
+    def snippets(self, snippets):
+        out = [encode_number(0x72), encode_number(len(snippets))]
+        for snip in snippets:
+            out.append(self.node(snip[0], *snip))
+        return ''.join(out)
+
+    def dictionary(self):
+        return encode_number(len(self.strings)) + ''.join(encode_string(s) for s in self.strings)
+
+
+WORDS = ('the quick brown fox jumps over lazy dog and then runs into woods where '
+         'nobody has ever seen such a sight before today').split()
+
+
+def make_topaz_pages(enc, npages, nwords, nglyphs, seed=0):
+    rnd = random.Random(seed)
+    pages = []
+    for p in xrange(npages):
+        words = [rnd.choice(WORDS) for _ in xrange(nwords)]
+        firstglyph = []
+        gx, gy, gid = [], [], []
+        for w in xrange(nwords):
+            firstglyph.append(len(gid))
+            for c in words[w]:
+                gid.append(rnd.randrange(nglyphs))
+                gx.append(100 + (len(gid) * 90) % 8000)
+                gy.append(200 + (w // 10) * 250)
+        info = enc.node('info', 'info', [
+            ('word', [('ocrText', (), words), ('firstGlyph', (), firstglyph),
+                      ('lastGlyph', (), firstglyph[1:] + [len(gid)]),
+                      ('bl', (), [0] * nwords)]),
+            ('glyph', [('x', (), gx), ('y', (), gy), ('glyphID', (), gid)]),
+        ], implied=True)
+        snips = [('page', [('type', (), ['text']), ('h', (), [11000]), ('w', (), [8500])], [1, 2, 3])]
+        npara = nwords // 20
+        paras = []
+        for i in xrange(npara):
+            paras.append(('paragraph', [('class', (), ['body_%d' % (i % 3)]),
+                                        ('firstWord', (), [i * 20]),
+                                        ('lastWord', (), [(i + 1) * 20])], []))
+        snips.append(('region', [('type', (), ['text']), ('x', (), [0]), ('y', (), [0]),
+                                 ('h', (), [9000]), ('w', (), [8500])],
+                      range(4, 4 + npara - 1)))
+        snips.append(('region', [('type', (), ['fixed']), ('x', (), [0]), ('y', (), [9000]),
+                                 ('h', (), [1000]), ('w', (), [8500])], [4 + npara - 1]))
+        snips.append(('region', [('type', (), ['graphic'])], [4 + npara]))
+        snips.extend(paras)
+        snips.append(('img', [('x', (), [100]), ('y', (), [100]), ('h', (), [500]),
+                              ('w', (), [500]), ('src', (), [p % 2])], []))
+        pages.append('p\x00__PAGE_\x00\x00' + info + enc.snippets(snips))
+    return pages
+
+
+def make_topaz_glyphs(enc, nglyphs, seed=0):
+    rnd = random.Random(seed)
+    vx, vy, vlen, gvtx, glen = [], [], [], [], []
+    for g in xrange(nglyphs):
+        gvtx.append(len(vx))
+        glen.append(len(vlen))
+        npts = rnd.choice((4, 5, 7))
+        for _ in xrange(npts):
+            vx.append(rnd.randrange(600))
+            vy.append(rnd.randrange(800))
+        vlen.append(npts - 1)
+    info = enc.node('info', 'info', [
+        ('glyph', [('h', (), [800] * nglyphs), ('w', (), [600] * nglyphs),
+                   ('use', (), [1] * nglyphs), ('vtx', (), gvtx), ('len', (), glen),
+                   ('dpi', (), [1440] * nglyphs)]),
+        ('vtx', [('x', (), vx), ('y', (), vy)]),
+        ('len', [('n', (), vlen)]),
+    ], implied=True)
+    return 'g\x00__GLYPH\x00\x00\x00' + info
+
+
+def make_topaz_other(enc):
+    snips = [('book', [], [1]), ('stylesheet', [], [2, 3, 4])]
+    for i in xrange(3):
+        snips.append(('style', [('_tag', (), ['paragraph']), ('class', (), ['body_%d' % i])],
+                      [5 + 2 * i, 6 + 2 * i]))
+    for i in xrange(3):
+        snips.append(('rule', [('attr', (), ['margin-top']), ('value', (), ['%d' % (i * 10)])], []))
+        snips.append(('rule', [('attr', (), ['align']), ('value', (), ['justify'])], []))
+    return enc.snippets(snips)
+
+
+def make_topaz_sections(npages=20, nwords=200, nglyphs=80, seed=0):
+    '''
+    Returns the decrypted records of a Topaz book, by section name:
+    npages pages of nwords words each, set in a font of nglyphs glyphs.
+    '''
+    enc = TopazEncoder()
+    sections = {}
+    sections['page'] = make_topaz_pages(enc, npages, nwords, nglyphs, seed)
+    sections['glyphs'] = [make_topaz_glyphs(enc, nglyphs, seed)]
+    sections['other'] = [make_topaz_other(enc)]
+    sections['img'] = [('\xff\xd8jpeg%d' % i) * 1000 for i in xrange(2)]
+    sections['color'] = [('\xff\xd8color%d' % i) * 1000 for i in xrange(1)]
+    sections['dict'] = [enc.dictionary()]
+    return sections
+
+
+def make_topaz_book(npages=20, nwords=200, nglyphs=80, pid='ABCDEFGH', bookkey='bookkey!', seed=0):
+    '''
+    Returns a PID-encrypted Topaz (.tpz) book built from
+    make_topaz_sections, whose book key is stored for pid.
+    '''
+    sections = make_topaz_sections(npages, nwords, nglyphs, seed)
+    meta = [('Title', 'Synthetic Topaz Book'), ('Authors', 'A. Writer'), ('ASIN', 'B000000000'),
+            ('UpdateTime', '2020-01-01'), ('firstTextPage', '1')]
+
+    dkeyrec = topaz_encrypt(pid, 'PID' + chr(8) + pid + chr(8) + bookkey + 'pid')
+    payload = []
+    pos = 0
+    headers = []
+
+    order = ['dkey', 'metadata', 'dict', 'other', 'glyphs', 'page', 'img', 'color']
+    for name in order:
+        recs = []
+        if name == 'dkey':
+            data = chr(1) + chr(len(dkeyrec)) + dkeyrec
+            chunk = encode_string(name) + encode_number(0) + data
+            recs.append((pos, len(data), 0))
+            payload.append(chunk)
+            pos += len(chunk)
+        elif name == 'metadata':
+            # the flags byte doubles as record index 0
+            data = chr(len(meta)) + ''.join(encode_string(k) + encode_string(v) for (k, v) in meta)
+            chunk = encode_string(name) + chr(0) + data
+            recs.append((pos, len(data), 0))
+            payload.append(chunk)
+            pos += len(chunk)
+        else:
+            for index, raw in enumerate(sections[name]):
+                comp = zlib.compress(raw)
+                data = topaz_encrypt(bookkey, comp)
+                chunk = encode_string(name) + encode_number(-index - 1) + data
+                recs.append((pos, len(raw), len(comp)))
+                payload.append(chunk)
+                pos += len(chunk)
+        headers.append((name, recs))
+    head = [encode_number(len(headers))]
+    for name, recs in headers:
+        head.append('\x63' + encode_string(name) + encode_number(len(recs)))
+        for rec in recs:
+            head.append(''.join(encode_number(v) for v in rec))
+    return 'TPZ0' + ''.join(head) + '\x64' + ''.join(payload)
+
+
+# Amazon ION, as read by ion.BinaryIonParser, and KFX DRMION books
+
+ION_VERSION_MARKER = '\xe0\x01\x00\xea'
+
+# the ProtectedData symbols, which follow the ten system symbols
+ION_PROTECTED_SYMBOLS = [
+    'com.amazon.drm.Envelope@1.0',
+    'com.amazon.drm.EnvelopeMetadata@1.0', 'size', 'page_size',
+    'encryption_key', 'encryption_transformation',
+    'encryption_voucher', 'signing_key', 'signing_algorithm',
+    'signing_voucher', 'com.amazon.drm.EncryptedPage@1.0',
+    'cipher_text', 'cipher_iv', 'com.amazon.drm.Signature@1.0',
+    'data', 'com.amazon.drm.EnvelopeIndexTable@1.0', 'length',
+    'offset', 'algorithm', 'encoded', 'encryption_algorithm',
+    'hashing_algorithm', 'expires', 'format', 'id',
+    'lock_parameters', 'strategy', 'com.amazon.drm.Key@1.0',
+    'com.amazon.drm.KeySet@1.0', 'com.amazon.drm.PIDv3@1.0',
+    'com.amazon.drm.PlainTextPage@1.0',
+    'com.amazon.drm.PlainText@1.0', 'com.amazon.drm.PrivateKey@1.0',
+    'com.amazon.drm.PublicKey@1.0', 'com.amazon.drm.SecretKey@1.0',
+    'com.amazon.drm.Voucher@1.0', 'public_key', 'private_key',
+    'com.amazon.drm.KeyPair@1.0', 'com.amazon.drm.ProtectedData@1.0',
+    'doctype', 'com.amazon.drm.EnvelopeIndexTableOffset@1.0',
+    'enddoc', 'license_type', 'license', 'watermark', 'key', 'value',
+    'com.amazon.drm.License@1.0', 'category', 'metadata',
+    'categorized_metadata', 'com.amazon.drm.CategorizedMetadata@1.0',
+    'com.amazon.drm.VoucherEnvelope@1.0', 'mac', 'voucher',
+    'com.amazon.drm.ProtectedData@2.0',
+    'com.amazon.drm.Envelope@2.0',
+    'com.amazon.drm.EnvelopeMetadata@2.0',
+    'com.amazon.drm.EncryptedPage@2.0',
+    'com.amazon.drm.PlainText@2.0', 'compression_algorithm',
+    'com.amazon.drm.Compressed@1.0', 'priority', 'refines']
+ION_SYMBOLS = dict((name, 10 + i) for (i, name) in enumerate(ION_PROTECTED_SYMBOLS))
+ION_SYMBOLS.update({'$ion_symbol_table': 3, 'name': 4, 'version': 5, 'imports': 6, 'max_id': 8})
+
+
+def ion_varuint(n):
+    out = [chr(0x80 | (n & 0x7F))]
+    n >>= 7
+    while n:
+        out.append(chr(n & 0x7F))
+        n >>= 7
+    return ''.join(reversed(out))
+
+
+def ion_value(tid, body):
+    if len(body) < 14:
+        return chr((tid << 4) | len(body)) + body
+    return chr((tid << 4) | 14) + ion_varuint(len(body)) + body
+
+
+def ion_uint(n):
+    body = ''
+    while n:
+        body = chr(n & 0xFF) + body
+        n >>= 8
+    return body
+
+
+def ion_int(n):
+    return ion_value(2, ion_uint(n))
+
+
+def ion_symbol(name):
+    return ion_value(7, ion_uint(ION_SYMBOLS[name]))
+
+
+def ion_string(s):
+    return ion_value(8, s)
+
+
+def ion_blob(data):
+    return ion_value(0xA, data)
+
+
+def ion_list(values):
+    return ion_value(0xB, ''.join(values))
+
+
+def ion_struct(fields):
+    body = ''.join(ion_varuint(ION_SYMBOLS[name]) + value for (name, value) in fields)
+    if len(body) == 1:
+        # a struct of length 1 would mean a sorted struct
+        return chr(0xDE) + ion_varuint(1) + body
+    return ion_value(0xD, body)
+
+
+def ion_annotate(names, value):
+    annots = ''.join(ion_varuint(ION_SYMBOLS[name]) for name in names)
+    return ion_value(0xE, ion_varuint(len(annots)) + annots + value)
+
+
+def ion_document(values):
+    # version marker, then a symbol table importing the ProtectedData symbols
+    table = ion_annotate(['$ion_symbol_table'], ion_struct([
+        ('imports', ion_list([ion_struct([('name', ion_string('ProtectedData')),
+                                          ('version', ion_int(1)),
+                                          ('max_id', ion_int(len(ION_PROTECTED_SYMBOLS)))])]))]))
+    return ION_VERSION_MARKER + table + ''.join(values)
+
+
+def aes_cbc_encrypt(key, iv, data):
+    from Crypto.Cipher import AES
+    padlen = 16 - len(data) % 16
+    return AES.new(key, AES.MODE_CBC, iv).encrypt(data + chr(padlen) * padlen)
+
+
+def make_kfx_voucher(secretkey, dsn='', secret='', license_type='Purchase', seed=0):
+    '''
+    Returns a KFX DRM voucher (VoucherEnvelope) holding secretkey,
+    locked to the device serial dsn and the account secret.
+    '''
+    rnd = random.Random(seed)
+    keyset = ion_document([ion_annotate(['com.amazon.drm.KeySet@1.0'], ion_list([
+        ion_annotate(['com.amazon.drm.SecretKey@1.0'], ion_struct([
+            ('algorithm', ion_string('AES')), ('format', ion_string('RAW')),
+            ('encoded', ion_blob(secretkey))]))]))])
+    algorithms = ('AES', 'AES/CBC/PKCS5Padding', 'SHA-256')
+    lockparams = []
+    shared = 'PIDv3' + ''.join(algorithms)
+    if secret:
+        lockparams.append('ACCOUNT_SECRET')
+        shared += 'ACCOUNT_SECRET' + secret
+    if dsn:
+        lockparams.append('CLIENT_ID')
+        shared += 'CLIENT_ID' + dsn
+    key = hmac.new(shared, shared[:5], digestmod=hashlib.sha256).digest()
+    iv = ''.join(chr(rnd.randrange(256)) for _ in xrange(16))
+    voucher = ion_document([ion_annotate(['com.amazon.drm.Voucher@1.0'], ion_struct([
+        ('cipher_iv', ion_blob(iv)),
+        ('cipher_text', ion_blob(aes_cbc_encrypt(key[:32], iv, keyset))),
+        ('license', ion_annotate(['com.amazon.drm.License@1.0'], ion_struct([
+            ('license_type', ion_string(license_type))]))),
+    ]))])
+    return ion_document([ion_annotate(['com.amazon.drm.VoucherEnvelope@1.0'], ion_struct([
+        ('voucher', ion_blob(voucher)),
+        ('strategy', ion_annotate(['com.amazon.drm.PIDv3@1.0'], ion_struct([
+            ('encryption_algorithm', ion_string(algorithms[0])),
+            ('encryption_transformation', ion_string(algorithms[1])),
+            ('hashing_algorithm', ion_string(algorithms[2])),
+            ('lock_parameters', ion_list([ion_string(p) for p in lockparams])),
+        ]))),
+    ]))])
+
+
+def make_drmion(secretkey, npages=1000, pagesize=1024, vouchername='voucher0', seed=0):
+    '''
+    Returns the ION of a DRMION envelope (without the DRMION header and
+    trailer) of npages uncompressed pages of pagesize bytes, each
+    encrypted with secretkey, and the plain text of all the pages.
+    '''
+    rnd = random.Random(seed)
+    plain = []
+    pages = []
+    for p in xrange(npages):
+        data = random_bytes(pagesize, seed + p)
+        iv = ''.join(chr(rnd.randrange(256)) for _ in xrange(16))
+        plain.append(data)
+        pages.append(ion_annotate(['com.amazon.drm.EncryptedPage@1.0'], ion_struct([
+            ('cipher_text', ion_blob(aes_cbc_encrypt(secretkey[:16], iv, data))),
+            ('cipher_iv', ion_blob(iv))])))
+    metadata = ion_annotate(['com.amazon.drm.EnvelopeMetadata@1.0'], ion_struct([
+        ('encryption_voucher', ion_string(vouchername))]))
+    envelope = ion_annotate(['com.amazon.drm.Envelope@1.0'], ion_list([metadata] + pages))
+    doc = ion_document([ion_annotate(['doctype'], ion_symbol('doctype')), envelope,
+                        ion_annotate(['enddoc'], ion_symbol('enddoc'))])
+    return doc, ''.join(plain)
+
+
+def make_kfx_zip(secretkey, dsn='', secret='', npages=1000, pagesize=1024, nfiles=1):
+    '''
+    Returns a .kfx-zip archive of nfiles DRMION files, their voucher and
+    an unencrypted resource file, and the expected contents of each of
+    the files after decryption.
+    '''
+    import zipfile
+    from cStringIO import StringIO
+    out = StringIO()
+    expected = {}
+    zf = zipfile.ZipFile(out, 'w', zipfile.ZIP_STORED)
+    zf.writestr('voucher.voucher', make_kfx_voucher(secretkey, dsn, secret))
+    for i in xrange(nfiles):
+        doc, plain = make_drmion(secretkey, npages, pagesize, seed=i * npages)
+        name = 'book%d.kfx' % i
+        zf.writestr(name, '\xeaDRMION\xee' + doc + '\x00' * 8)
+        expected[name] = plain
+    resource = random_bytes(pagesize, nfiles * npages) * 16
+    zf.writestr('resource.bin', resource, zipfile.ZIP_DEFLATED)
+    expected['resource.bin'] = resource
+    zf.close()
+    return out.getvalue(), expected
+
+
+# Palm database containers, used by MOBI and eReader books
+
+def make_palmdb(name, ident, sections):
+    '''
+    Returns a Palm database named name, of type and creator ident (8
+    bytes), holding the given sections.
+    '''
+    header = name.ljust(32, '\0')[:32] + '\0' * 28 + ident + '\0' * 8 + struct.pack('>H', len(sections))
+    pos = len(header) + 8 * len(sections) + 2
+    table = []
+    for i, section in enumerate(sections):
+        table.append(struct.pack('>LL', pos, 2 * i))
+        pos += len(section)
+    return header + ''.join(table) + '\0\0' + ''.join(sections)
+
+
+# MOBI books, as read by mobidedrm
+
+MOBI_KEYVEC1 = '\x72\x38\x33\xB0\xB4\xF2\xE3\xCA\xDF\x09\x01\xD6\xE2\xE0\x3F\x96'
+
+
+def make_mobi_book(pid='ABCDEFGH', nrecords=200, recordsize=4096, bookkey='mobibookkey12345', seed=0):
+    '''
+    Returns a MOBI book of nrecords uncompressed text records of
+    recordsize bytes, PC1-encrypted for the 8 character PID pid, and the
+    plain text of all the records.
+    '''
+    import mobidedrm
+    rnd = random.Random(seed)
+    title = 'Synthetic MOBI Book'
+    mobi_length = 0xE8
+
+    # the DRM voucher: the book key, encrypted with a key made from the PID
+    pidkey = mobidedrm.PC1(MOBI_KEYVEC1, pid.ljust(16, '\0'), False)
+    verification = rnd.getrandbits(32)
+    cookie = mobidedrm.PC1(pidkey, struct.pack('>LL16sLL', verification, 1, bookkey, 0, 0), False)
+    drm = struct.pack('>LLLBxxx32s', verification, 0x30, 1, sum(map(ord, pidkey)) & 0xFF, cookie)
+
+    sect0 = bytearray(16 + mobi_length)
+    struct.pack_into('>HHLHHH', sect0, 0, 1, 0, nrecords * recordsize, nrecords, recordsize, 2)
+    struct.pack_into('>4sLLL', sect0, 0x10, 'MOBI', mobi_length, 2, 65001)
+    struct.pack_into('>LL', sect0, 0x54, len(sect0), len(title))
+    struct.pack_into('>L', sect0, 0x68, 6)
+    struct.pack_into('>LLLL', sect0, 0xA8, len(sect0) + len(title), 1, len(drm), 0)
+    sect0 = str(sect0) + title + drm
+
+    plain = []
+    records = []
+    for i in xrange(nrecords):
+        text = ''.join(rnd.choice(WORDS) + ' ' for _ in xrange(recordsize // 4))[:recordsize]
+        plain.append(text)
+        records.append(mobidedrm.PC1(bookkey, text, False))
+    book = make_palmdb(title.replace(' ', '_'), 'BOOKMOBI', [sect0] + records + ['\xe9\x8e\r\n'])
+    return book, ''.join(plain)
+
+
+# ePubs, as read by ineptepub, ignobleepub and obok
+
+EPUB_CONTAINER = ('<?xml version="1.0"?>\n'
+                  '<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">'
+                  '<rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>'
+                  '</rootfiles></container>')
+
+
+def make_epub_contents(nchapters=20, chaptersize=20000, nimages=5, imagesize=50000, seed=0):
+    '''
+    Returns the files of an ePub as a list of (name, data) pairs, the
+    package files first, and the names of the chapters and images.
+    '''
+    rnd = random.Random(seed)
+    files = []
+    content = []
+    manifest = []
+    for i in xrange(nchapters):
+        body = []
+        size = 0
+        while size < chaptersize:
+            para = '<p>%s</p>\n' % ' '.join(rnd.choice(WORDS) for _ in xrange(60))
+            body.append(para)
+            size += len(para)
+        name = 'OEBPS/chapter%03d.xhtml' % i
+        files.append((name, '<?xml version="1.0" encoding="utf-8"?>\n'
+                            '<html xmlns="http://www.w3.org/1999/xhtml"><body>\n%s</body></html>\n'
+                            % ''.join(body)))
+        content.append(name)
+        manifest.append('<item id="c%d" href="chapter%03d.xhtml" media-type="application/xhtml+xml"/>' % (i, i))
+    for i in xrange(nimages):
+        name = 'OEBPS/image%03d.jpg' % i
+        files.append((name, '\xff\xd8\xff\xe0' + random_bytes(imagesize - 4, seed + i)))
+        content.append(name)
+        manifest.append('<item id="i%d" href="image%03d.jpg" media-type="image/jpeg"/>' % (i, i))
+    opf = ('<?xml version="1.0"?>\n<package xmlns="http://www.idpf.org/2007/opf" version="2.0">'
+           '<metadata><dc:title xmlns:dc="http://purl.org/dc/elements/1.1/">Synthetic ePub</dc:title></metadata>'
+           '<manifest>%s</manifest><spine>%s</spine></package>'
+           % (''.join(manifest), ''.join('<itemref idref="c%d"/>' % i for i in xrange(nchapters))))
+    package = [('mimetype', 'application/epub+zip'), ('META-INF/container.xml', EPUB_CONTAINER),
+               ('OEBPS/content.opf', opf)]
+    return package + files, content
+
+
+def make_zip(files):
+    import zipfile
+    from cStringIO import StringIO
+    out = StringIO()
+    zf = zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED)
+    for name, data in files:
+        zf.writestr(name, data, zipfile.ZIP_STORED if name == 'mimetype' else zipfile.ZIP_DEFLATED)
+    zf.close()
+    return out.getvalue()
+
+
+def make_drm_epub(bookkey, encryptedkey, seed=0, **kwds):
+    '''
+    Returns an ePub whose chapters and images are encrypted with the AES
+    book key the way ADEPT and Barnes & Noble do it, with encryptedkey
+    (base64) in its rights.xml, and the plain files of the ePub.
+    '''
+    rnd = random.Random(seed)
+    files, content = make_epub_contents(seed=seed, **kwds)
+    encryption = ['<encryption xmlns="urn:oasis:names:tc:opendocument:xmlns:container" '
+                  'xmlns:enc="http://www.w3.org/2001/04/xmlenc#">']
+    out = []
+    for name, data in files:
+        if name in content:
+            encryption.append('<enc:EncryptedData><enc:EncryptionMethod Algorithm='
+                              '"http://www.w3.org/2001/04/xmlenc#aes128-cbc"/><enc:CipherData>'
+                              '<enc:CipherReference URI="%s"/></enc:CipherData></enc:EncryptedData>' % name)
+            # the first block is a random IV, the rest raw deflate
+            compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+            iv = ''.join(chr(rnd.randrange(256)) for _ in xrange(16))
+            data = aes_cbc_encrypt(bookkey, '\0' * 16, iv + compressor.compress(data) + compressor.flush())
+        out.append((name, data))
+    encryption.append('</encryption>')
+    rights = ('<?xml version="1.0"?>\n<adept:rights xmlns:adept="http://ns.adobe.com/adept">'
+              '<adept:licenseToken><adept:encryptedKey>%s</adept:encryptedKey></adept:licenseToken>'
+              '</adept:rights>' % encryptedkey)
+    out[1:1] = [('META-INF/rights.xml', rights), ('META-INF/encryption.xml', ''.join(encryption))]
+    return make_zip(out), dict(files)
+
+
+def make_adept_epub(rsakey, bookkey='0123456789abcdef', seed=0, **kwds):
+    '''
+    Returns an ADEPT ePub whose book key is encrypted with rsakey, and
+    its plain files.
+    '''
+    return make_drm_epub(bookkey, base64.b64encode(rsakey.encrypt(bookkey)), seed, **kwds)
+
+
+def make_ignoble_epub(userkey, bookkey='0123456789abcdef', seed=0, **kwds):
+    '''
+    Returns a Barnes & Noble ePub whose book key is encrypted with the
+    16 byte userkey, and its plain files.
+    '''
+    return make_drm_epub(bookkey, base64.b64encode(aes_cbc_encrypt(userkey, '\0' * 16, '\0' * 16 + bookkey)),
+                         seed, **kwds)
+
+
+def make_kobo_kepub(userkey, volumeid='volume0', seed=0, **kwds):
+    '''
+    Returns a Kobo kepub whose chapters and images are encrypted with
+    page keys, the (volumeid, elementid, elementkey) rows of its page
+    keys, encrypted with the 16 byte userkey, as Kobo keeps them in its
+    content_keys table, and the plain files of the kepub.
+    '''
+    from Crypto.Cipher import AES
+    rnd = random.Random(seed)
+    files, content = make_epub_contents(seed=seed, **kwds)
+    out = []
+    rows = []
+    for name, data in files:
+        if name in content:
+            pagekey = ''.join(chr(rnd.randrange(256)) for _ in xrange(16))
+            rows.append((volumeid, name, base64.b64encode(AES.new(userkey, AES.MODE_ECB).encrypt(pagekey))))
+            padlen = 16 - len(data) % 16
+            data = AES.new(pagekey, AES.MODE_ECB).encrypt(data + chr(padlen) * padlen)
+        out.append((name, data))
+    return make_zip(out), rows, dict(files)
+
+
+# eReader books, as read by erdr2pml
+
+def des_ecb_encrypt(key, data):
+    from Crypto.Cipher import DES
+    return DES.new(key, DES.MODE_ECB).encrypt(data)
+
+
+def make_ereader_pdb(user_key, npages=50, pagesize=4096, contentkey='contkey!', seed=0):
+    '''
+    Returns an eReader (version 260) book of npages text pages of about
+    pagesize bytes, encrypted for user_key (see erdr2pml.getuser_key),
+    and its plain text.
+    '''
+    import erdr2pml
+    rnd = random.Random(seed)
+    plain = []
+    pages = []
+    for i in xrange(npages):
+        text = ''.join(rnd.choice(WORDS) + ' ' for _ in xrange(pagesize // 4))[:pagesize]
+        plain.append(text)
+        data = zlib.compress(text)
+        data += '\0' * (-len(data) % 8)
+        pages.append(des_ecb_encrypt(erdr2pml.fixKey(contentkey), data))
+
+    # the DRM record, shuffled and encrypted with the key in its first 8
+    # bytes, is appended to the first text page
+    cookie = bytearray(248)
+    struct.pack_into('>HHL', cookie, 0, 13, npages + 1, (1 << 9) | (1 << 7) | (1 << 10))
+    struct.pack_into('>8s20s', cookie, 44, des_ecb_encrypt(erdr2pml.fixKey(user_key), contentkey),
+                     hashlib.sha1(contentkey).digest())
+    shuf = 3
+    shuffled = []
+    j = 0
+    for i in xrange(len(cookie)):
+        j = (j + shuf) % len(cookie)
+        shuffled.append(chr(cookie[j]))
+    trailer = struct.pack('>LL', shuf, len(cookie) + 8)
+    pages[0] += des_ecb_encrypt(erdr2pml.fixKey(pages[0][:8]), ''.join(shuffled) + trailer)
+
+    sect0 = struct.pack('>H', 260) + '\0' * 130
+    return make_palmdb('Synthetic_eReader_Book', 'PNRdPPrs', [sect0] + pages), ''.join(plain)
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# run_benchmarks.py
+# Runs all benchmark scripts in this directory and collects the results.
+
+"""
+Runs every bench_*.py script (or the ones named on the command line)
+in a fresh interpreter, so that the peak memory of each is measured on
+its own, and optionally writes all results as JSON for comparison
+between runs.
+
+Usage: run_benchmarks.py [--json results.json] [name ...]
+"""
+
+import getopt
+import glob
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+RESULT_MARKER = '@@BENCHMARK RESULT@@'
+
+# run in the child interpreter: one benchmark, then its results and
+# peak resident set size (kilobytes on Linux) as JSON after the marker
+CHILD_CODE = '''
+import json, resource, sys
+sys.path.insert(0, {dir!r})
+sys.argv = [{name!r} + '.py'] + {args!r}
+results = __import__({name!r}).main()
+print {marker!r}
+print json.dumps({{'results': results,
+                  'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}})
+'''
+
+
+def find_benchmarks():
+    return sorted(os.path.splitext(os.path.basename(path))[0]
+                  for path in glob.glob(os.path.join(BENCH_DIR, 'bench_*.py')))
+
+
+def run_benchmark(name, args=()):
+    env = dict(os.environ)
+    env['PYTHONIOENCODING'] = 'utf-8'
+    code = CHILD_CODE.format(dir=BENCH_DIR, name=name, args=list(args), marker=RESULT_MARKER)
+    start = time.time()
+    proc = subprocess.Popen([sys.executable, '-c', code], cwd=BENCH_DIR, env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = proc.communicate()[0]
+    elapsed = time.time() - start
+    output, marker, data = output.partition(RESULT_MARKER)
+    sys.stdout.write(output)
+    if proc.returncode != 0 or not marker:
+        lines = output.strip().splitlines()
+        return {'error': lines[-1] if lines else 'exit status {0:d}'.format(proc.returncode)}
+    result = json.loads(data)
+    result['seconds'] = elapsed
+    return result
+
+
+def usage(progname):
+    print u"Usage: {0} [--json results.json] [name ...]".format(progname)
+    print u"Benchmarks: {0}".format(u", ".join(find_benchmarks()))
+
+
+def main(argv=sys.argv):
+    progname = os.path.basename(argv[0])
+    try:
+        opts, args = getopt.getopt(argv[1:], "hj:", ["help", "json="])
+    except getopt.GetoptError, err:
+        print u"Error in options or arguments: {0}".format(err.args[0])
+        usage(progname)
+        return 1
+    jsonpath = None
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage(progname)
+            return 0
+        if o in ("-j", "--json"):
+            jsonpath = a
+
+    names = find_benchmarks()
+    if args:
+        wanted = [a if a.startswith('bench_') else 'bench_' + a for a in args]
+        unknown = [a for a in wanted if a not in names]
+        if unknown:
+            print u"Unknown benchmarks: {0}".format(u", ".join(unknown))
+            usage(progname)
+            return 1
+        names = wanted
+
+    report = {'python': sys.version.split()[0], 'platform': platform.platform(),
+              'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'benchmarks': {}}
+    failed = 0
+    for name in names:
+        print u"=== {0}".format(name)
+        result = run_benchmark(name)
+        if 'error' in result:
+            failed += 1
+            print u"{0} failed: {1}".format(name, result['error'])
+        else:
+            print u"{0}: {1:.1f} s, peak RSS {2:d} kB".format(name, result['seconds'], result['peak_rss_kb'])
+        report['benchmarks'][name] = result
+
+    if jsonpath:
+        with open(jsonpath, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print u"Results written to {0}".format(jsonpath)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())